@@ -832,9 +832,7 @@ class EventsDialog(wx.Dialog):
 
             try:
                 # Assuming server sends back the *single* added event, pickled and base64 encoded
-                pickled_event_b64 = params[0]
-                pickled_event = base64.b64decode(pickled_event_b64)
-                new_event = pickle.loads(pickled_event)  # Should be a single dict
+                new_event = net.decode_object(params[0])  # Should be a single dict
 
                 self_outer.log_event(
                     f"Successfully decoded new event: {new_event.get('event_title')} ID: {new_event.get('id')}"
@@ -1333,15 +1331,14 @@ class EventsDialog(wx.Dialog):
 
         try:
             # Serialize the list of events to save
-            pickled_data = pickle.dumps(events_to_save)
-            encoded_data = base64.b64encode(pickled_data).decode("utf-8")  # Use utf-8
+            encoded_data = self.net.encode_object(events_to_save)
 
             # Add handler for save success? Assume server sends back updated events?
             # For now, just send. Need server response spec.
             # self.net.add_handler("SAVE_SUCCESS", self.handle_save_success)
 
             # Send the encoded data
-            self.net.send_message(self.net.build_message("SAVE_EVENTS", [encoded_data]))
+            self.net.send_frame("SAVE_EVENTS", [encoded_data])
             self.log_event("SAVE_EVENTS message sent to server.")
 
             # Optionally clear the id=-1 flag locally *after* successful confirmation
@@ -1376,6 +1373,16 @@ if __name__ == "__main__":
             print(f"DummyNetwork: Building message {command} with params {params}")
             return f"{command}~" + "~".join(map(str, params))  # Simple pipe delimiter
 
+        def encode_object(self, obj):
+            return pickle.dumps(obj)
+
+        def decode_object(self, field):
+            return pickle.loads(base64.b64decode(field))
+
+        def send_frame(self, command, params):
+            fields = [base64.b64encode(p).decode() for p in params]
+            self.send_message(self.build_message(command, fields))
+
         def send_message(self, message):
             print(f"DummyNetwork: Sending message: {message}")
             # --- Simulate Server Responses ---
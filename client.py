@@ -1,22 +1,62 @@
 import base64
 import socket
 import sys
-
-import wx
-from wx import adv
+import time
 
 import cryptManager
-import login_frame
 import networkManager
 
+# how often a BUSY server is retried, and the longest wait we accept
+BUSY_ATTEMPTS = 5
+MAX_BUSY_WAIT = 30
+
+
+class ServerBusy(ConnectionError):
+    """The server is at capacity and asked us to retry later."""
+
+    def __init__(self, retry_after: int) -> None:
+        super().__init__(f"Server busy, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+def connect(address, ticket=None) -> networkManager.NetworkManager:
+    """
+    Connect and run the key exchange, waiting out BUSY replies.
 
-def handle_key_exchange(sock: socket.socket):
+    :raises ServerBusy: If the server stays at capacity.
+    """
+    for attempt in range(BUSY_ATTEMPTS):
+        sock = socket.create_connection(address)
+        try:
+            net = handle_key_exchange(sock, ticket)
+        except ServerBusy as e:
+            sock.close()
+            if attempt == BUSY_ATTEMPTS - 1:
+                raise
+            print(e)
+            time.sleep(min(e.retry_after, MAX_BUSY_WAIT))
+            continue
+        net.address = address
+        return net
+
+
+def handle_key_exchange(sock: socket.socket, ticket=None):
     # recv rsa
     # send aes
     net = networkManager.NetworkManager(sock, cryptManager.CryptManager(rsa_key=2), {})
+    net.add_handler("TICKET", store_ticket)
     net.crypt_manager.generate_aes_key()
     rsa_pub_msg = net.recv_message_plain().decode()
-    rsa_pub_key = base64.b64decode(net.get_message_params(rsa_pub_msg)[0])
+    params = net.get_message_params(rsa_pub_msg)
+    if net.get_message_code(rsa_pub_msg) == "BUSY":
+        raise ServerBusy(int(params[0]))
+    rsa_pub_key = base64.b64decode(params[0])
+    # servers that predate capabilities only send the key
+    offer = params[1] if len(params) > 1 else ""
+    if ticket is not None and networkManager.CAP_RESUME in offer.split(","):
+        if resume_with_ticket(net, ticket, offer):
+            return net
+    caps = net.accept_caps(offer)
     print("THE RSA PUB \n", rsa_pub_key)
     print("The aes key ive chosen: ", net.crypt_manager.aes_key)
     aes_encrypted = net.crypt_manager.encrypt_rsa(
@@ -24,14 +64,79 @@ def handle_key_exchange(sock: socket.socket):
     )
     net.send_message_plain(
         net.build_message(
-            "KEY", [base64.b64encode(aes_encrypted).decode()], do_size=True
+            "KEY", [base64.b64encode(aes_encrypted).decode(), caps], do_size=True
         )
     )
     return net
 
 
-def main(sock: socket.socket):
-    net = handle_key_exchange(sock)
+def resume_with_ticket(net: networkManager.NetworkManager, ticket, offer) -> bool:
+    """
+    Try to restore a previous session instead of a new RSA exchange and LOGIN.
+    """
+    ticket_bytes, ticket_key = ticket
+    client_nonce = net.crypt_manager.generate_random_bytes(16)
+    caps = ",".join(
+        cap for cap in offer.split(",") if cap in networkManager.SUPPORTED_CAPS
+    )
+    net.send_message_plain(
+        net.build_message(
+            "RESUME",
+            [
+                base64.b64encode(ticket_bytes).decode(),
+                base64.b64encode(client_nonce).decode(),
+                caps,
+            ],
+            do_size=True,
+        )
+    )
+    reply = net.recv_message_plain().decode()
+    if net.get_message_code(reply) != "RESUMED":
+        print("Server rejected the resumption ticket")
+        return False
+    server_nonce = base64.b64decode(net.get_message_params(reply)[0])
+    net.crypt_manager.aes_key = net.crypt_manager.derive_key(
+        ticket_key, client_nonce, server_nonce
+    )
+    net.accept_caps(caps)
+    net.resume_ticket = ticket
+    net.resumed = True
+    return True
+
+
+def store_ticket(*params, net: networkManager.NetworkManager):
+    net.resume_ticket = (
+        networkManager.as_bytes(params[-1]),
+        net.crypt_manager.aes_key,
+    )
+
+
+def reconnect(net: networkManager.NetworkManager, address) -> bool:
+    """
+    Reconnect a dropped connection in place with its resumption ticket, the
+    UI keeps using the same NetworkManager object.
+    """
+    if net.resume_ticket is None:
+        return False
+    new_net = connect(address, net.resume_ticket)
+    if not new_net.resumed:
+        new_net.sock.close()
+        return False
+    net.sock = new_net.sock
+    net.reader = new_net.reader
+    net.crypt_manager = new_net.crypt_manager
+    net.caps = new_net.caps
+    print("Resumed session after reconnect")
+    return True
+
+
+def main(net: networkManager.NetworkManager):
+    # the ui is only imported here, headless users of connect skip wx
+    import wx
+    from wx import adv
+
+    import login_frame
+
     print("Finished key exchange")
     app = wx.App()
     login_fram = login_frame.LoginFrame(net)
@@ -48,11 +153,10 @@ def main(sock: socket.socket):
 if __name__ == "__main__":
     host = sys.argv[1] if len(sys.argv) > 1 else "127.0.0.1"
     port = int(sys.argv[2]) if len(sys.argv) > 2 else 12345
-    sock = socket.socket()
     try:
-        sock.connect((host, port))
+        net = connect((host, port))
         print("Connected to server")
     except Exception as e:
         print("Connection failed")
         raise e
-    main(sock)
+    main(net)
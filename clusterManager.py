@@ -0,0 +1,295 @@
+"""
+Routing summaries across several server nodes. Every summary id is owned by
+one node, picked by consistent hashing over the nodes of a directory, so a
+node joining or leaving only moves the summaries between it and its ring
+neighbours. Sessions reach the owning node through a relay: the node they
+connected to sends their sealed session state to the owner and then copies
+bytes both ways.
+"""
+
+import bisect
+import fcntl
+import hashlib
+import json
+import os
+import socket
+import struct
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import wireCodec
+from cryptManager import CryptManager
+
+# points per node on the ring, more evens out the share of each node
+VNODES = 64
+# seconds between reads of a FileDirectory
+DIRECTORY_POLL = 2
+STATE_HEADER = struct.Struct("!I")
+MAX_STATE_SIZE = 64 * 1024 * 1024
+CONNECT_TIMEOUT = 5
+ACK = b"\x01"
+
+
+def _point(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hashing of summary ids onto node names.
+    """
+
+    def __init__(self, nodes=(), vnodes: int = VNODES) -> None:
+        self.vnodes = vnodes
+        self.points: List[Tuple[int, str]] = []
+        for node in nodes:
+            self.add(node)
+
+    @property
+    def nodes(self) -> set:
+        return {node for _, node in self.points}
+
+    def add(self, node: str) -> None:
+        if node in self.nodes:
+            return
+        for replica in range(self.vnodes):
+            bisect.insort(self.points, (_point(f"{node}#{replica}"), node))
+
+    def remove(self, node: str) -> None:
+        self.points = [point for point in self.points if point[1] != node]
+
+    def owner(self, key) -> Optional[str]:
+        """
+        The node owning a key, the first point clockwise of its hash.
+
+        :param key: A summary id, as an int or as sent by a client.
+        """
+        if not self.points:
+            return None
+        index = bisect.bisect(self.points, (_point(str(key)), ""))
+        return self.points[index % len(self.points)][1]
+
+
+class LocalDirectory:
+    """
+    In-process node directory, node name -> address of its cluster port.
+    Subscribers are called with the new nodes after every change.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.nodes: Dict[str, str] = {}
+        self.subscribers: List[Callable[[Dict[str, str]], None]] = []
+
+    def subscribe(self, callback: Callable[[Dict[str, str]], None]) -> None:
+        self.subscribers.append(callback)
+        callback(dict(self.nodes))
+
+    def join(self, name: str, address: str) -> None:
+        with self.lock:
+            self.nodes[name] = address
+        self._changed()
+
+    def leave(self, name: str) -> None:
+        with self.lock:
+            self.nodes.pop(name, None)
+        self._changed()
+
+    def _changed(self) -> None:
+        nodes = dict(self.nodes)
+        for callback in self.subscribers:
+            callback(nodes)
+
+
+class FileDirectory(LocalDirectory):
+    """
+    A directory kept in a JSON file, for nodes on one host or a shared
+    mount. Changes made by other processes are picked up by polling.
+    """
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self.path = path
+        self.nodes = self._read() or {}
+        threading.Thread(target=self._poll, daemon=True).start()
+
+    def _read(self) -> Optional[Dict[str, str]]:
+        """The nodes in the file, None if it cannot be parsed."""
+        try:
+            with open(self.path) as f:
+                # a writer holds LOCK_EX from truncating to the end of its dump
+                fcntl.flock(f, fcntl.LOCK_SH)
+                return self._parse(f.read())
+        except FileNotFoundError:
+            return {}
+
+    def _parse(self, data: str) -> Optional[Dict[str, str]]:
+        try:
+            return json.loads(data or "{}")
+        except json.JSONDecodeError:
+            print(f"Unreadable node directory {self.path}, keeping the last one")
+            return None
+
+    def _update(self, change: Callable[[Dict[str, str]], None]) -> None:
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            nodes = self._parse(f.read())
+            if nodes is None:
+                # rewritten from what was last read, not from nothing
+                with self.lock:
+                    nodes = dict(self.nodes)
+            change(nodes)
+            f.seek(0)
+            f.truncate()
+            json.dump(nodes, f)
+        with self.lock:
+            self.nodes = nodes
+        self._changed()
+
+    def join(self, name: str, address: str) -> None:
+        self._update(lambda nodes: nodes.__setitem__(name, address))
+
+    def leave(self, name: str) -> None:
+        self._update(lambda nodes: nodes.pop(name, None))
+
+    def _poll(self) -> None:
+        while True:
+            time.sleep(DIRECTORY_POLL)
+            nodes = self._read()
+            with self.lock:
+                if nodes is None or nodes == self.nodes:
+                    continue
+                self.nodes = nodes
+            self._changed()
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    host, _, port = address.rpartition(":")
+    return host, int(port)
+
+
+def send_state(address: str, state: dict, crypt: CryptManager, key: bytes):
+    """
+    Connect to a node's cluster port and send it a sealed state, only nodes
+    sharing the key can open it.
+
+    :return: The connection, relayed sessions go on over it.
+    """
+    data = crypt.seal(key, wireCodec.dumps(state))
+    conn = socket.create_connection(parse_address(address), CONNECT_TIMEOUT)
+    try:
+        conn.sendall(STATE_HEADER.pack(len(data)) + data)
+    except OSError:
+        conn.close()
+        raise
+    conn.settimeout(None)
+    return conn
+
+
+def recv_state(conn: socket.socket, crypt: CryptManager, key: bytes) -> dict:
+    """Receive what send_state sent."""
+    (size,) = STATE_HEADER.unpack(_recv_exactly(conn, STATE_HEADER.size))
+    if size > MAX_STATE_SIZE:
+        raise ValueError("Cluster state is too large.")
+    return wireCodec.loads(crypt.unseal(key, _recv_exactly(conn, size)))
+
+
+def _recv_exactly(conn: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Cluster connection closed early.")
+        data += chunk
+    return bytes(data)
+
+
+def wait_ack(conn: socket.socket, timeout: float = CONNECT_TIMEOUT) -> None:
+    conn.settimeout(timeout)
+    if conn.recv(1) != ACK:
+        raise ConnectionError("Node did not acknowledge.")
+
+
+def _pump(source: socket.socket, target: socket.socket) -> None:
+    try:
+        while data := source.recv(64 * 1024):
+            target.sendall(data)
+    except OSError:
+        pass
+    try:
+        target.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+
+
+def splice(client: socket.socket, node: socket.socket) -> None:
+    """Copy bytes both ways until both sides are done, then close both."""
+    client.settimeout(None)
+    node.settimeout(None)
+    upstream = threading.Thread(target=_pump, args=(client, node), daemon=True)
+    upstream.start()
+    _pump(node, client)
+    try:
+        # the owner is done, stop waiting for the client as well
+        client.shutdown(socket.SHUT_RD)
+    except OSError:
+        pass
+    upstream.join()
+    node.close()
+    client.close()
+
+
+import pytest
+
+
+def test_ring_moves_only_keys_of_the_new_node():
+    ring = HashRing(["a:1", "b:1", "c:1"])
+    before = {sid: ring.owner(sid) for sid in range(3000)}
+    assert {ring.owner(sid) for sid in range(3000)} == {"a:1", "b:1", "c:1"}
+    ring.add("d:1")
+    moved = {sid for sid in before if ring.owner(sid) != before[sid]}
+    assert all(ring.owner(sid) == "d:1" for sid in moved)
+    assert 400 < len(moved) < 1100
+    ring.remove("d:1")
+    assert {sid: ring.owner(sid) for sid in before} == before
+    assert ring.owner("7") == ring.owner(7)
+
+
+def test_file_directory_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "nodes.json")
+    first, second = FileDirectory(path), FileDirectory(path)
+    seen = []
+    first.subscribe(seen.append)
+    first.join("a", "127.0.0.1:1")
+    second.join("b", "127.0.0.1:2")
+    assert second.nodes == {"a": "127.0.0.1:1", "b": "127.0.0.1:2"}
+    second.leave("a")
+    assert first._read() == {"b": "127.0.0.1:2"}
+    assert seen[0] == {} and seen[-1] == {"a": "127.0.0.1:1"}
+    # a file that does not parse is not an empty ring
+    with open(path, "w") as f:
+        f.write('{"b": "127.0')
+    assert second._read() is None
+    second.join("c", "127.0.0.1:3")
+    assert first._read() == {"b": "127.0.0.1:2", "c": "127.0.0.1:3"}
+
+
+def test_sealed_state_needs_the_cluster_key():
+    crypt = CryptManager(rsa_key=2)
+    key = os.urandom(32)
+    listener = socket.create_server(("127.0.0.1", 0))
+    address = "127.0.0.1:%d" % listener.getsockname()[1]
+    conn = send_state(address, {"kind": "document", "sid": 4}, crypt, key)
+    peer, _ = listener.accept()
+    assert recv_state(peer, crypt, key) == {"kind": "document", "sid": 4}
+    conn.close()
+    peer.close()
+    conn = send_state(address, {"sid": 4}, crypt, os.urandom(32))
+    peer, _ = listener.accept()
+    with pytest.raises(ValueError):
+        recv_state(peer, crypt, key)
+    conn.close()
+    peer.close()
+    listener.close()
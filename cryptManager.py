@@ -22,11 +22,72 @@ def log_failure(message):
     print(f"\033[31m{message}\033[0m")  # Red for failure
 
 
+class SessionCipher:
+    """
+    AES-GCM for one connection. Nonces come from a per direction message
+    counter, so no IV goes on the wire and a replayed, dropped or reordered
+    frame fails authentication.
+    """
+
+    TAG_SIZE = 16
+
+    def __init__(self, key: bytes, is_server: bool):
+        self.key = key
+        # different prefixes so both directions never share a nonce
+        self.send_prefix = b"SRVR" if is_server else b"CLNT"
+        self.recv_prefix = b"CLNT" if is_server else b"SRVR"
+        self.send_counter = 0
+        self.recv_counter = 0
+
+    def _cipher(self, prefix: bytes, counter: int):
+        nonce = prefix + counter.to_bytes(8, "big")
+        return AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+
+    def encrypt_into(self, data: bytes, out: memoryview) -> int:
+        """
+        Encrypt data into out (ciphertext followed by the tag).
+
+        :return: The number of bytes written.
+        """
+        cipher = self._cipher(self.send_prefix, self.send_counter)
+        self.send_counter += 1
+        cipher.encrypt(data, output=out[: len(data)])
+        out[len(data) : len(data) + self.TAG_SIZE] = cipher.digest()
+        return len(data) + self.TAG_SIZE
+
+    def encrypt(self, data: bytes) -> bytes:
+        out = bytearray(len(data) + self.TAG_SIZE)
+        self.encrypt_into(data, memoryview(out))
+        return bytes(out)
+
+    def decrypt(self, data) -> bytes:
+        """
+        Decrypt and verify the next frame from the peer.
+
+        :param data: Ciphertext followed by the tag.
+        """
+        if len(data) < self.TAG_SIZE:
+            raise ValueError("Frame is too short.")
+        cipher = self._cipher(self.recv_prefix, self.recv_counter)
+        plain = cipher.decrypt_and_verify(
+            data[: len(data) - self.TAG_SIZE], data[len(data) - self.TAG_SIZE :]
+        )
+        self.recv_counter += 1
+        return plain
+
+
 class CryptManager:
     def __init__(self, rsa_key=None):
         self.rsa_key = RSA.generate(2048) if rsa_key is None else rsa_key
         self.rsa_cipher = PKCS1_OAEP.new(self.rsa_key)
         self.aes_key: Optional[bytes] = None
+        self.session: Optional[SessionCipher] = None
+
+    def start_session(self, is_server: bool) -> SessionCipher:
+        if self.aes_key is None:
+            raise ValueError("AES Key is not set.")
+        self.session = SessionCipher(self.aes_key, is_server)
+        return self.session
 
     def hash_pass(self, password: str, salt: bytes, paper: bytes) -> str:
         # encrypt using Sha256 and hashlib
@@ -70,6 +131,30 @@ class CryptManager:
         """
         return self.rsa_cipher.decrypt(data)
 
+    def seal(self, key: bytes, data: bytes) -> bytes:
+        """
+        Encrypts and authenticates data with AES-GCM under the given key,
+        the random nonce is prepended and the tag appended.
+        """
+        nonce = get_random_bytes(12)
+        ciphertext, tag = AES.new(key, AES.MODE_GCM, nonce=nonce).encrypt_and_digest(
+            data
+        )
+        return nonce + ciphertext + tag
+
+    def unseal(self, key: bytes, blob: bytes) -> bytes:
+        """
+        Opens a blob made by seal, raises ValueError if it was tampered with.
+        """
+        if len(blob) < 28:
+            raise ValueError("Sealed data is too short.")
+        cipher = AES.new(key, AES.MODE_GCM, nonce=blob[:12])
+        return cipher.decrypt_and_verify(blob[12:-16], blob[-16:])
+
+    def derive_key(self, *parts: bytes) -> bytes:
+        """Derives a fresh 16 byte AES key from the given parts."""
+        return hashlib.sha256(b"".join(parts)).digest()[:16]
+
     def generate_random_bytes(self, length: int) -> bytes:
         return get_random_bytes(length)
 
@@ -203,6 +288,72 @@ class TestAESEncryption:
             crypt_manager.decrypt_data(sample_data["data"], iv)
 
 
+class TestSessionCipher:
+    """Tests for the counter nonce AES-GCM session cipher."""
+
+    @pytest.fixture
+    def pair(self, crypt_manager):
+        crypt_manager.generate_aes_key()
+        return (
+            SessionCipher(crypt_manager.aes_key, True),
+            SessionCipher(crypt_manager.aes_key, False),
+        )
+
+    def test_roundtrip_both_directions(self, pair):
+        server, client = pair
+        for i in range(3):
+            to_client, to_server = b"to client %d" % i, b"to server %d" % i
+            assert client.decrypt(server.encrypt(to_client)) == to_client
+            assert server.decrypt(client.encrypt(to_server)) == to_server
+
+    def test_no_iv_on_the_wire(self, pair):
+        server, _ = pair
+        assert len(server.encrypt(b"x" * 100)) == 100 + SessionCipher.TAG_SIZE
+
+    def test_encrypt_into_buffer(self, pair):
+        server, client = pair
+        out = bytearray(4 + 5 + SessionCipher.TAG_SIZE)
+        written = server.encrypt_into(b"hello", memoryview(out)[4:])
+        assert written == 5 + SessionCipher.TAG_SIZE
+        assert client.decrypt(memoryview(out)[4:]) == b"hello"
+
+    def test_tampered_frame_fails(self, pair):
+        server, client = pair
+        frame = bytearray(server.encrypt(b"hello"))
+        frame[0] ^= 1
+        with pytest.raises(ValueError):
+            client.decrypt(bytes(frame))
+
+    def test_replayed_frame_fails(self, pair):
+        server, client = pair
+        frame = server.encrypt(b"hello")
+        client.decrypt(frame)
+        with pytest.raises(ValueError):
+            client.decrypt(frame)
+
+    def test_start_session_needs_key(self, crypt_manager):
+        with pytest.raises(ValueError, match="AES Key is not set."):
+            crypt_manager.start_session(True)
+
+
+class TestTickets:
+    """Tests for sealing resumption tickets."""
+
+    def test_seal_unseal(self, crypt_manager):
+        key = get_random_bytes(32)
+        assert crypt_manager.unseal(key, crypt_manager.seal(key, b"ticket")) == b"ticket"
+
+    def test_unseal_wrong_key_fails(self, crypt_manager):
+        blob = crypt_manager.seal(get_random_bytes(32), b"ticket")
+        with pytest.raises(ValueError):
+            crypt_manager.unseal(get_random_bytes(32), blob)
+
+    def test_derive_key_depends_on_every_part(self, crypt_manager):
+        key = crypt_manager.derive_key(b"a", b"b", b"c")
+        assert len(key) == 16
+        assert key != crypt_manager.derive_key(b"a", b"b", b"d")
+
+
 class TestRSAEncryption:
     """Tests for RSA encryption functions."""
 
@@ -636,8 +636,10 @@ class DbManager:
         except Error as e:
             print(f"Error deleting links: {e}")
 
-    def get_summary(self, summary_id: str) -> Optional[Summary]:
-        """Get summary by ID, including file contents."""
+    def get_summary(
+        self, summary_id: str, with_content: bool = True
+    ) -> Optional[Summary]:
+        """Get summary by ID, including file contents unless with_content is False."""
         try:
             query = "SELECT * FROM Summary WHERE id = %s"
             self.cursor.execute(query, (summary_id,))
@@ -645,8 +647,10 @@ class DbManager:
 
             if summary_data:
                 # Read file contents if path exists
-                if summary_data["path_to_summary"] and os.path.exists(
-                    summary_data["path_to_summary"]
+                if (
+                    with_content
+                    and summary_data["path_to_summary"]
+                    and os.path.exists(summary_data["path_to_summary"])
                 ):
                     with open(
                         summary_data["path_to_summary"], "r", encoding="utf-8"
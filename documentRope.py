@@ -0,0 +1,290 @@
+"""
+The live text of an open summary. Edits to a str copy the whole document,
+a Rope keeps the text as pieces in a treap ordered by position, so an edit
+costs O(log n) plus the size of one piece. The str is only built when it is
+needed (saving, a full TAKEUPDATE) and kept until the next edit.
+"""
+
+import random
+from typing import List, Optional, Tuple
+
+# pieces of a built rope are this long, typing grows a piece up to it as well
+MAX_PIECE = 512
+
+
+class _Node:
+    __slots__ = ("text", "priority", "left", "right", "size")
+
+    def __init__(self, text: str, priority: float) -> None:
+        self.text = text
+        self.priority = priority
+        self.left: Optional[_Node] = None
+        self.right: Optional[_Node] = None
+        self.size = len(text)
+
+
+def _size(node: Optional[_Node]) -> int:
+    return node.size if node is not None else 0
+
+
+def _update(node: _Node) -> None:
+    node.size = len(node.text) + _size(node.left) + _size(node.right)
+
+
+def _split(node: Optional[_Node], pos: int) -> Tuple[Optional[_Node], Optional[_Node]]:
+    """Split a treap into its first pos characters and the rest."""
+    if node is None:
+        return None, None
+    left_size = _size(node.left)
+    if pos <= left_size:
+        left, node.left = _split(node.left, pos)
+        _update(node)
+        return left, node
+    if pos >= left_size + len(node.text):
+        node.right, right = _split(node.right, pos - left_size - len(node.text))
+        _update(node)
+        return node, right
+    # the cut falls inside this piece, its tail becomes the root of the right
+    # part and keeps the priority so the heap order still holds
+    cut = pos - left_size
+    tail = _Node(node.text[cut:], node.priority)
+    tail.right = node.right
+    _update(tail)
+    node.text = node.text[:cut]
+    node.right = None
+    _update(node)
+    return node, tail
+
+
+def _merge(left: Optional[_Node], right: Optional[_Node]) -> Optional[_Node]:
+    """Join two treaps, every position of left comes before right."""
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _update(left)
+        return left
+    right.left = _merge(left, right.left)
+    _update(right)
+    return right
+
+
+def _collect(node: Optional[_Node], start: int, end: int, pieces: List[str]) -> None:
+    """Append the text between start and end of a treap to pieces."""
+    if node is None or end <= 0 or start >= node.size:
+        return
+    left_size = _size(node.left)
+    _collect(node.left, start, end, pieces)
+    low, high = max(start - left_size, 0), min(end - left_size, len(node.text))
+    if low < high:
+        pieces.append(node.text[low:high])
+    offset = left_size + len(node.text)
+    _collect(node.right, start - offset, end - offset, pieces)
+
+
+def _build(text: str) -> Optional[_Node]:
+    root = None
+    for start in range(0, len(text), MAX_PIECE):
+        root = _merge(root, _Node(text[start : start + MAX_PIECE], random.random()))
+    return root
+
+
+class Rope:
+    """
+    A mutable string with O(log n) inserts and deletes.
+
+    Positions follow str slicing: negative ones count from the end and
+    positions past the end are clamped.
+    """
+
+    def __init__(self, text: str = "") -> None:
+        self.root = _build(text)
+        # the whole text, None after an edit until it is built again
+        self.text: Optional[str] = text
+
+    def __len__(self) -> int:
+        return _size(self.root)
+
+    def __str__(self) -> str:
+        if self.text is None:
+            pieces: List[str] = []
+            stack, node = [], self.root
+            while stack or node is not None:
+                while node is not None:
+                    stack.append(node)
+                    node = node.left
+                node = stack.pop()
+                pieces.append(node.text)
+                node = node.right
+            self.text = "".join(pieces)
+            if len(pieces) > 2 * (len(self.text) // MAX_PIECE) + 64:
+                # deletes leave many short pieces behind, start over from
+                # the text we have anyway
+                self.root = _build(self.text)
+        return self.text
+
+    def substring(self, start: int, end: int) -> str:
+        """text[start:end], without building the whole text."""
+        if self.text is not None:
+            return self.text[start:end]
+        start, end, _ = slice(start, end).indices(len(self))
+        pieces: List[str] = []
+        _collect(self.root, start, end, pieces)
+        return "".join(pieces)
+
+    def insert(self, pos: int, text: str) -> None:
+        pos = slice(pos, None).indices(len(self))[0]
+        if not text:
+            return
+        self.text = None
+        if self._extend(pos, text):
+            return
+        left, right = _split(self.root, pos)
+        self.root = _merge(_merge(left, _build(text)), right)
+
+    def _extend(self, pos: int, text: str) -> bool:
+        """
+        Append text to the piece ending at pos if it has room, the common
+        case of typing at one place.
+        """
+        path, node = [], self.root
+        while node is not None:
+            path.append(node)
+            left_size = _size(node.left)
+            if pos <= left_size:
+                node = node.left
+                continue
+            pos -= left_size
+            if pos < len(node.text):
+                return False
+            if pos == len(node.text):
+                if len(node.text) + len(text) > MAX_PIECE:
+                    return False
+                node.text += text
+                for parent in path:
+                    parent.size += len(text)
+                return True
+            pos -= len(node.text)
+            node = node.right
+        return False
+
+    def delete(self, start: int, end: int) -> None:
+        start, end, _ = slice(start, end).indices(len(self))
+        if end <= start:
+            return
+        self.text = None
+        left, rest = _split(self.root, start)
+        _, right = _split(rest, end - start)
+        self.root = _merge(left, right)
+
+    def replace(self, start: int, end: int, text: str) -> None:
+        start, end, _ = slice(start, end).indices(len(self))
+        self.delete(start, end)
+        self.insert(start, text)
+
+    def apply(self, change_type: str, start: int, end: int, content: str) -> None:
+        """Apply an INSERT, DELETE or UPDATE change of an UPDATEDOC."""
+        if change_type == "INSERT":
+            self.insert(start, content)
+        elif change_type == "DELETE":
+            self.delete(start, end)
+        elif change_type == "UPDATE":
+            self.replace(start, end, content)
+
+
+def test_rope_matches_slicing():
+    rng = random.Random(7)
+    text = "".join(rng.choice("abc \n") for _ in range(5000))
+    rope = Rope(text)
+    for step in range(3000):
+        start = rng.randint(-10, len(text) + 10)
+        end = start + rng.randint(0, 40)
+        content = "x" * rng.randint(0, 3) if step % 5 else "y" * 700
+        kind = rng.choice(["INSERT", "INSERT", "DELETE", "UPDATE"])
+        rope.apply(kind, start, end, content)
+        if kind == "INSERT":
+            text = text[:start] + content + text[start:]
+        elif kind == "DELETE":
+            start, end, _ = slice(start, end).indices(len(text))
+            text = text[:start] + text[max(start, end) :]
+        else:
+            start, end, _ = slice(start, end).indices(len(text))
+            text = text[:start] + content + text[max(start, end) :]
+        assert len(rope) == len(text)
+        assert rope.substring(start - 5, end + 5) == text[start - 5 : end + 5]
+        if step % 100 == 0:
+            assert str(rope) == text
+    assert str(rope) == text
+
+
+def test_typing_grows_one_piece():
+    rope = Rope("hello world")
+    for index, char in enumerate("big "):
+        rope.insert(6 + index, char)
+    assert str(rope) == "hello big world"
+    pieces, stack = [], [rope.root]
+    while stack:
+        node = stack.pop()
+        if node is not None:
+            pieces.append(node.text)
+            stack += [node.left, node.right]
+    assert sorted(pieces) == ["big ", "hello ", "world"]
+
+
+def test_scattered_edits_keep_pieces_small_and_the_tree_shallow():
+    """2000 keystrokes at random places of a 500KB summary."""
+    rng = random.Random(1)
+    text = "".join(rng.choice("abcdefgh \n") for _ in range(500_000))
+    rope = Rope(text)
+    built = -(-len(text) // MAX_PIECE)
+    for _ in range(2000):
+        kind, pos = rng.choice(["INSERT", "DELETE"]), rng.randint(0, 490_000)
+        rope.apply(kind, pos, pos + 1, "k")
+        if kind == "INSERT":
+            text = text[:pos] + "k" + text[pos:]
+        else:
+            text = text[:pos] + text[pos + 1 :]
+    assert str(rope) == text
+    # an edit costs the depth of the treap plus the size of one piece
+    pieces, depth, stack = 0, 0, [(rope.root, 1)]
+    while stack:
+        node, level = stack.pop()
+        if node is not None:
+            assert len(node.text) <= MAX_PIECE
+            pieces, depth = pieces + 1, max(depth, level)
+            stack += [(node.left, level + 1), (node.right, level + 1)]
+    # an edit splits at most one piece in three
+    assert pieces <= built + 2 * 2000
+    # the priorities are random, the depth of a treap is about 3 log2 n
+    assert depth <= 8 * pieces.bit_length()
+
+
+def test_rope_benchmark_against_slicing():
+    """2000 keystrokes at random places of a 500KB summary."""
+    import time
+
+    rng = random.Random(1)
+    text = "".join(rng.choice("abcdefgh \n") for _ in range(500_000))
+    edits = [
+        (rng.choice(["INSERT", "DELETE"]), rng.randint(0, 490_000)) for _ in range(2000)
+    ]
+
+    start = time.perf_counter()
+    content = text
+    for kind, pos in edits:
+        if kind == "INSERT":
+            content = content[:pos] + "k" + content[pos:]
+        else:
+            content = content[:pos] + content[pos + 1 :]
+    old = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rope = Rope(text)
+    for kind, pos in edits:
+        rope.apply(kind, pos, pos + 1, "k")
+    new = time.perf_counter() - start
+    assert str(rope) == content
+    # only printed, the times depend on the machine and its load
+    print(f"\n  slicing: {old:.4f}s, Rope: {new:.4f}s")
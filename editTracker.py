@@ -0,0 +1,353 @@
+"""
+Change capture for the summary editor. Instead of diffing the whole text on
+every sync tick, the editor's key and text events are turned into
+UPDATEDOC changes as they happen: the selection when a key went down and
+the caret and length after the text changed give the edited range, only
+the new text is read back. Edits no key explains (a paste from the mouse
+menu, undo, text set by the program) are diffed in a window around the
+caret, grown until the text around it is unchanged. An edit that is still
+not inside MAX_DIFF_WINDOW is given up on, the caller diffs the whole text
+against what it sent last.
+
+The tracker keeps what it thinks the editor holds in a Rope, so reading
+the old side of a window is cheap.
+"""
+
+import difflib
+import sys
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+
+import documentRope
+import opLog
+
+# characters diffed on each side of the caret when an edit is a guess
+DIFF_WINDOW = 256
+# the window grows up to this, an edit still not inside is given up on
+MAX_DIFF_WINDOW = 16 * 1024
+
+
+def diff_changes(old_text: str, new_text: str, offset: int = 0) -> List[dict]:
+    """
+    UPDATEDOC changes from old_text to new_text, all against old_text.
+
+    :param offset: Where old_text starts in the document.
+    """
+    matcher = difflib.SequenceMatcher(None, old_text, new_text)
+    changes = []
+
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+
+        change_type = {
+            "replace": "UPDATE",
+            "delete": "DELETE",
+            "insert": "INSERT",
+        }.get(tag, tag)
+
+        content = new_text[j1:j2] if tag in ["replace", "insert"] else ""
+
+        # Skip empty changes that aren't deletions
+        if not content and tag != "delete":
+            continue
+
+        changes.append(
+            {"cord": [offset + i1, offset + i2], "type": change_type, "cont": content}
+        )
+
+    return changes
+
+
+def _common_prefix(a: str, b: str) -> int:
+    size = min(len(a), len(b))
+    index = 0
+    while index < size and a[index] == b[index]:
+        index += 1
+    return index
+
+
+class EditTracker:
+    """
+    Follows the edits made in a wx.TextCtrl. Call key_down and key_up from
+    EVT_KEY_DOWN and EVT_KEY_UP and text_changed from EVT_TEXT, take gives
+    the ops made since the last take, in order.
+    """
+
+    def __init__(self, editor, text: str = "", window: int = DIFF_WINDOW) -> None:
+        self.editor = editor
+        self.window = window
+        self.text = documentRope.Rope(text)
+        self.ops: List[dict] = []
+        # the selection when the key being pressed went down
+        self.selection: Optional[Tuple[int, int]] = None
+        # an op came from a window diff, take checks it against the editor
+        self.guessed = False
+        # an edit was given up on, the ops do not cover it
+        self.lost = False
+        self.paused = False
+
+    def reset(self, text: str) -> None:
+        """The editor holds text now, forget what was not taken."""
+        self.text = documentRope.Rope(text)
+        self.ops = []
+        self.selection = None
+        self.guessed = False
+        self.lost = False
+
+    @contextmanager
+    def pause(self, text: str):
+        """Edits made by the program meanwhile end with the editor at text."""
+        self.paused = True
+        try:
+            yield
+        finally:
+            self.paused = False
+            self.reset(text)
+
+    @contextmanager
+    def applying(self, ops: List[dict]):
+        """The program applies ops of others to the editor, unrecorded."""
+        self.paused = True
+        try:
+            yield
+        finally:
+            self.paused = False
+            for op in ops:
+                start, end = op["cord"]
+                self.text.apply(op["type"], start, end, op.get("cont", ""))
+            self.selection = None
+
+    @contextmanager
+    def replacing(self, text: str):
+        """
+        The program replaces the whole text with text (an import), it is
+        recorded as one op instead of being diffed.
+        """
+        length = len(self.text)
+        self.paused = True
+        try:
+            yield
+        finally:
+            self.paused = False
+            kind = "UPDATE" if length and text else "INSERT" if text else "DELETE"
+            if length or text:
+                self.ops.append({"cord": [0, length], "type": kind, "cont": text})
+            self.text = documentRope.Rope(text)
+
+    def key_down(self) -> None:
+        self.selection = self.editor.GetSelection()
+
+    def key_up(self) -> None:
+        self.selection = None
+
+    def text_changed(self) -> None:
+        if self.paused:
+            return
+        length = self.editor.GetLastPosition()
+        caret = self.editor.GetInsertionPoint()
+        delta = length - len(self.text)
+        op = self._from_key(caret, delta)
+        if op is not None:
+            ops = [op]
+        else:
+            ops = self._diff_window(caret, delta, length)
+            self.guessed = True
+            if ops is None:
+                # follow the editor from here, take tells the caller
+                self.lost = True
+                self.ops = []
+                self.text = documentRope.Rope(self.editor.GetRange(0, length))
+                return
+        for op in ops:
+            start, end = op["cord"]
+            self.text.apply(op["type"], start, end, op["cont"])
+            self.ops.append(op)
+        # the caret moved, a second change of the same key is a guess
+        self.selection = None
+
+    def _from_key(self, caret: int, delta: int) -> Optional[dict]:
+        """The op of a key press: typing, a paste or a delete at the caret."""
+        if self.selection is None:
+            return None
+        start, end = self.selection
+        if start == end:
+            if delta > 0 and caret - start == delta:
+                # typed or pasted at the caret
+                end = start
+            elif delta < 0 and caret - start == delta:
+                # backspace, the caret went back over what is gone
+                start, end = caret, start
+            elif delta < 0 and caret == start:
+                # delete, the text after the caret went
+                end = start - delta
+            else:
+                return None
+        elif caret < start or caret - end != delta:
+            return None
+        content = self.editor.GetRange(start, caret) if caret > start else ""
+        kind = "INSERT" if start == end else "UPDATE" if content else "DELETE"
+        return {"cord": [start, end], "type": kind, "cont": content}
+
+    def _diff_window(
+        self, caret: int, delta: int, length: int
+    ) -> Optional[List[dict]]:
+        """
+        Diff the text around the caret with what was there, widening the
+        window until the text at both its ends is unchanged.
+
+        :return: The ops, None if the window outgrew MAX_DIFF_WINDOW.
+        """
+        window = self.window
+        while window <= MAX_DIFF_WINDOW:
+            start = max(0, min(caret, caret - delta) - window)
+            new_end = min(length, caret + window)
+            old_end = new_end - delta
+            old = self.text.substring(start, old_end)
+            new = self.editor.GetRange(start, new_end)
+            whole = start == 0 and new_end == length
+            if whole or self._settled(old, new, start == 0, new_end == length):
+                return opLog.sequential(diff_changes(old, new, start))
+            window *= 4
+        return None
+
+    @staticmethod
+    def _settled(old: str, new: str, at_start: bool, at_end: bool) -> bool:
+        """If the edit is inside the window: its ends are untouched."""
+        if old == new:
+            return True
+        prefix = _common_prefix(old, new)
+        if not at_start and prefix == 0:
+            return False
+        suffix = _common_prefix(old[prefix:][::-1], new[prefix:][::-1])
+        return at_end or suffix > 0
+
+    def take(self) -> Tuple[Optional[List[dict]], bool]:
+        """
+        The ops made since the last take, composed.
+
+        :return: The ops, None if an edit was given up on and the whole
+            text has to be diffed, and False if some were guessed and the
+            editor should be checked against text.
+        """
+        ops, sure = opLog.compose(self.ops), not self.guessed
+        if self.lost:
+            ops = None
+        self.ops = []
+        self.guessed = False
+        self.lost = False
+        return ops, sure
+
+
+class _FakeEditor:
+    """The wx.TextCtrl calls the tracker makes, on a str."""
+
+    def __init__(self, text: str) -> None:
+        self.value = text
+        self.selection = (0, 0)
+        self.caret = 0
+
+    def GetSelection(self):
+        return self.selection
+
+    def GetLastPosition(self):
+        return len(self.value)
+
+    def GetInsertionPoint(self):
+        return self.caret
+
+    def GetRange(self, start, end):
+        return self.value[start:end]
+
+    def edit(self, start, end, content, caret=None):
+        self.value = self.value[:start] + content + self.value[end:]
+        self.caret = start + len(content) if caret is None else caret
+        self.selection = (self.caret, self.caret)
+
+
+def _insert_op(pos, text):
+    return {"cord": [pos, pos], "type": "INSERT", "cont": text}
+
+
+def _press(tracker, editor, selection, start, end, content, caret=None):
+    editor.selection = selection
+    editor.caret = selection[1]
+    tracker.key_down()
+    editor.edit(start, end, content, caret)
+    tracker.text_changed()
+    tracker.key_up()
+
+
+def test_keys_give_exact_ops():
+    editor = _FakeEditor("hello world")
+    tracker = EditTracker(editor, editor.value)
+    for index, char in enumerate(" big"):
+        _press(tracker, editor, (5 + index, 5 + index), 5 + index, 5 + index, char)
+    # backspace, delete, then typing over a selection
+    _press(tracker, editor, (9, 9), 8, 9, "", caret=8)
+    _press(tracker, editor, (0, 0), 0, 1, "", caret=0)
+    _press(tracker, editor, (0, 4), 0, 4, "J")
+    assert editor.value == "J bi world"
+    assert str(tracker.text) == editor.value
+    ops, sure = tracker.take()
+    assert sure
+    assert ops == [
+        {"cord": [5, 5], "type": "INSERT", "cont": " bi"},
+        {"cord": [0, 5], "type": "UPDATE", "cont": "J"},
+    ]
+    assert opLog.apply_ops("hello world", ops) == editor.value
+
+
+def test_edits_without_a_key_are_diffed_around_the_caret():
+    text = "".join("line %d\n" % index for index in range(2000))
+    editor = _FakeEditor(text)
+    tracker = EditTracker(editor, text, window=16)
+    # a paste from the mouse menu, the caret ends after it
+    editor.edit(7000, 7000, "pasted ")
+    tracker.text_changed()
+    # undo of a far away change moves the caret there, the window grows
+    editor.edit(100, 140, "", caret=100)
+    tracker.text_changed()
+    assert str(tracker.text) == editor.value
+    ops, sure = tracker.take()
+    assert not sure
+    assert opLog.apply_ops(text, ops) == editor.value
+    assert len(ops) == 2
+    with tracker.pause("from the server"):
+        editor.edit(0, len(editor.value), "from the server")
+        tracker.text_changed()
+    assert tracker.take() == ([], True)
+    with tracker.replacing("imported"):
+        editor.edit(0, len(editor.value), "imported")
+        tracker.text_changed()
+    assert tracker.take() == (
+        [{"cord": [0, 15], "type": "UPDATE", "cont": "imported"}],
+        True,
+    )
+    remote = [_insert_op(0, ">> ")]
+    with tracker.applying(remote):
+        editor.edit(0, 0, ">> ")
+        tracker.text_changed()
+    assert str(tracker.text) == editor.value == ">> imported"
+    assert tracker.take() == ([], True)
+
+
+def test_unpaused_replace_of_a_large_text_stays_bounded(monkeypatch):
+    diffed = []
+
+    def spy(old_text, new_text, offset=0):
+        diffed.append(max(len(old_text), len(new_text)))
+        return diff_changes(old_text, new_text, offset)
+
+    monkeypatch.setattr(sys.modules[__name__], "diff_changes", spy)
+    # the ends of the window never match, so it keeps growing
+    monkeypatch.setattr(EditTracker, "_settled", staticmethod(lambda *_: False))
+    text = "".join("line %d\n" % index for index in range(20000))
+    editor = _FakeEditor(text)
+    tracker = EditTracker(editor, text)
+    editor.edit(0, len(text), text.upper(), caret=0)
+    tracker.text_changed()
+    # never settled and never the whole text: given up on, nothing diffed
+    assert diffed == []
+    assert str(tracker.text) == editor.value
+    assert tracker.take() == (None, False)
@@ -0,0 +1,375 @@
+"""
+Headless load generator for end to end benchmarks. Simulated users connect
+with the regular client key exchange, register, log in, open a summary
+shared with USERS_PER_DOC - 1 others and stream UPDATEDOC edits at a fixed
+rate. Every edit inserts a unique token, its round trip ends with the first
+TAKEUPDATE or TAKEDELTA that brings the token into the user's copy.
+
+    python loadClient.py 127.0.0.1 12345 --users 20 --rate 2 --duration 30
+    python loadClient.py --spawn /tmp/srv --users 50 --max-p99 1.5
+
+--spawn starts server.py on a free port inside a directory holding a
+sqlite dbconved.db, so a run needs no network and no mysql.
+"""
+
+import argparse
+import json
+import os
+import random
+import select
+import socket
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import client
+import networkManager
+import opLog
+
+SPAWN_TIMEOUT = 30
+# stop waiting for updates this long after the last edit
+DRAIN_SECONDS = 3
+
+
+@dataclass
+class UserStats:
+    setup: List[float] = field(default_factory=list)
+    login: List[float] = field(default_factory=list)
+    round_trips: List[float] = field(default_factory=list)
+    edits: int = 0
+    updates: int = 0
+    errors: List[str] = field(default_factory=list)
+
+    def merge(self, other: "UserStats") -> None:
+        self.setup += other.setup
+        self.login += other.login
+        self.round_trips += other.round_trips
+        self.edits += other.edits
+        self.updates += other.updates
+        self.errors += other.errors
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest rank percentile, 0 for no values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q * len(ordered)) - 1))]
+
+
+def process_cpu_seconds(pid: int) -> Optional[float]:
+    """
+    User + system CPU time of a process and its children (the workers of
+    the multi-process mode), None where there is no /proc.
+    """
+    ticks = os.sysconf("SC_CLK_TCK")
+    total = 0.0
+    try:
+        entries = os.listdir("/proc")
+    except FileNotFoundError:
+        return None
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # the command may hold spaces, the fields start after its ")"
+                stat = f.read().rpartition(")")[2].split()
+        except OSError:
+            continue
+        if int(entry) == pid or int(stat[1]) == pid:
+            total += (int(stat[11]) + int(stat[12])) / ticks
+    return total
+
+
+class Document:
+    """A summary opened by a group of users, the first one creates it."""
+
+    def __init__(self) -> None:
+        self.ready = threading.Event()
+        self.sid: Optional[int] = None
+
+
+class SimulatedUser:
+    def __init__(self, index: int, args, document: Document, creator: bool):
+        self.index = index
+        self.args = args
+        self.document = document
+        self.creator = creator
+        self.stats = UserStats()
+        # token -> send time of the edit carrying it
+        self.pending: Dict[str, float] = {}
+        # the user's copy, its revision and the edits not acknowledged yet
+        self.sync = opLog.ClientSync()
+        self.resyncing = False
+
+    def run(self) -> None:
+        net = None
+        try:
+            net = self.connect()
+            self.open_document(net)
+            self.edit(net)
+        except Exception as e:
+            self.stats.errors.append(f"user {self.index}: {e!r}")
+            if self.creator:
+                # nobody else waits forever on a document that never comes
+                self.document.ready.set()
+        finally:
+            if net is not None:
+                try:
+                    net.send_message(net.build_message("EXIT", []))
+                except OSError:
+                    pass
+                net.sock.close()
+
+    def connect(self) -> networkManager.NetworkManager:
+        start = time.perf_counter()
+        net = client.connect(self.args.address)
+        self.stats.setup.append(time.perf_counter() - start)
+        name = f"load{self.args.run_id}u{self.index}"
+        start = time.perf_counter()
+        net.send_message(net.build_message("REGISTER", [name, "load"]))
+        self.expect(net, "REGISTER_SUCCESS")
+        net.send_message(net.build_message("LOGIN", [name, "load"]))
+        self.expect(net, "LOGIN_SUCCESS")
+        self.stats.login.append(time.perf_counter() - start)
+        return net
+
+    def expect(self, net: networkManager.NetworkManager, wanted: str):
+        code, params = net.recv_frame()
+        while code == "TICKET":
+            code, params = net.recv_frame()
+        if code != wanted:
+            raise RuntimeError(f"expected {wanted}, got {code}")
+        return params
+
+    def open_document(self, net: networkManager.NetworkManager) -> None:
+        if self.creator:
+            title = f"load{self.args.run_id}d{self.index}"
+            net.send_message(net.build_message("SAVE", [title, "", "Arial"]))
+            self.expect(net, "SAVE_SUCCESS")
+            net.send_message(net.build_message("GETSUMMARIES", []))
+            summaries = net.decode_objects(self.expect(net, "TAKESUMMARIES"))
+            self.document.sid = max(summ.id for summ in summaries)
+            self.document.ready.set()
+        elif not self.document.ready.wait(SPAWN_TIMEOUT):
+            raise RuntimeError("document was never created")
+        if self.document.sid is None:
+            raise RuntimeError("document creator failed")
+        net.send_message(net.build_message("GETSUMMARY", [str(self.document.sid)]))
+        code = None
+        while code not in ("TAKESUMMARY", "SUMMARYEND"):
+            code, _ = net.recv_frame()
+
+    def edit(self, net: networkManager.NetworkManager) -> None:
+        interval = 1 / self.args.rate
+        next_edit = time.monotonic() + random.uniform(0, interval)
+        end = time.monotonic() + self.args.duration
+        while time.monotonic() < end or (
+            self.pending and time.monotonic() < end + DRAIN_SECONDS
+        ):
+            now = time.monotonic()
+            if now >= next_edit and now < end:
+                self.send_edit(net)
+                next_edit += interval
+            wait = max(0.0, min(next_edit, end + DRAIN_SECONDS) - time.monotonic())
+            if net.reader.has_frame(net.binary) or socket_readable(net.sock, wait):
+                self.receive(net)
+
+    def send_edit(self, net: networkManager.NetworkManager) -> None:
+        token = f"[{self.index}:{self.stats.edits}]"
+        self.sync.local([{"cord": [0, 0], "type": "INSERT", "cont": token}])
+        self.pending[token] = time.perf_counter()
+        self.stats.edits += 1
+        self.flush(net)
+
+    def flush(self, net: networkManager.NetworkManager) -> None:
+        """Send what was typed, once the last UPDATEDOC was acknowledged."""
+        ops = self.sync.flush()
+        if ops is None:
+            return
+        payload = {"changes": ops, "sequential": True}
+        if self.sync.revision is not None:
+            payload["base_rev"] = self.sync.revision
+        net.send_message(net.build_message("UPDATEDOC", [json.dumps(payload)]))
+
+    def receive(self, net: networkManager.NetworkManager) -> None:
+        code, params = net.recv_frame()
+        if code not in ("TAKEUPDATE", "TAKEDELTA"):
+            return
+        now = time.perf_counter()
+        self.stats.updates += 1
+        update = json.loads(networkManager.as_bytes(params[0]))
+        if code == "TAKEUPDATE":
+            self.sync.reset(update["doc_content"], update["revision"])
+            self.resyncing = False
+        elif self.resyncing:
+            return
+        elif self.sync.receive(update) is None:
+            if update["base"] == self.sync.revision:
+                self.stats.errors.append(f"user {self.index}: copy drifted")
+            net.send_message(net.build_message("RESYNC", []))
+            self.resyncing = True
+            return
+        content = self.sync.server_text
+        for token in [token for token in self.pending if token in content]:
+            self.stats.round_trips.append(now - self.pending.pop(token))
+        self.flush(net)
+
+
+def socket_readable(sock: socket.socket, timeout: float) -> bool:
+    return bool(select.select([sock], [], [], timeout)[0])
+
+
+def spawn_server(directory: str) -> Tuple[subprocess.Popen, int]:
+    """
+    Start server.py in directory on a free port.
+
+    :return: The server process and its port, once it accepts.
+    """
+    if not os.path.isfile(os.path.join(directory, "dbconved.db")):
+        raise SystemExit(f"{directory} has no dbconved.db")
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    server = subprocess.Popen(
+        [sys.executable, script, str(port)],
+        cwd=directory,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + SPAWN_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 1).close()
+            return server, port
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise SystemExit("server did not start")
+
+
+def run(args) -> UserStats:
+    documents = [Document() for _ in range(0, args.users, args.users_per_doc)]
+    users = [
+        SimulatedUser(
+            index,
+            args,
+            documents[index // args.users_per_doc],
+            index % args.users_per_doc == 0,
+        )
+        for index in range(args.users)
+    ]
+    threads = [threading.Thread(target=user.run, daemon=True) for user in users]
+    for thread in threads:
+        thread.start()
+        time.sleep(args.ramp / max(1, args.users))
+    for thread in threads:
+        thread.join()
+    total = UserStats()
+    for user in users:
+        total.merge(user.stats)
+    return total
+
+
+def report(args, stats: UserStats, elapsed: float, cpu: Optional[float]) -> dict:
+    result = {
+        "users": args.users,
+        "users_per_doc": args.users_per_doc,
+        "rate": args.rate,
+        "edits": stats.edits,
+        "updates": stats.updates,
+        "answered": len(stats.round_trips),
+        "errors": len(stats.errors),
+        "elapsed": round(elapsed, 3),
+        "server_cpu_seconds": None if cpu is None else round(cpu, 3),
+        "server_cpu_percent": None if cpu is None else round(100 * cpu / elapsed, 1),
+    }
+    for name, values in (
+        ("setup", stats.setup),
+        ("login", stats.login),
+        ("round_trip", stats.round_trips),
+    ):
+        for q in (0.5, 0.9, 0.99):
+            result[f"{name}_p{int(q * 100)}"] = round(percentile(values, q), 4)
+        result[f"{name}_max"] = round(max(values, default=0.0), 4)
+    return result
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("host", nargs="?", default="127.0.0.1")
+    parser.add_argument("port", nargs="?", type=int, default=12345)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--users-per-doc", type=int, default=5)
+    parser.add_argument("--rate", type=float, default=2.0, help="edits/s per user")
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument(
+        "--ramp", type=float, default=2.0, help="seconds to connect everyone"
+    )
+    parser.add_argument("--spawn", metavar="DIR", help="run server.py in DIR")
+    parser.add_argument("--server-pid", type=int, help="measure CPU of this server")
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument(
+        "--max-p99", type=float, help="fail if the round trip p99 is above this"
+    )
+    args = parser.parse_args()
+    args.run_id = f"{os.getpid()}x{int(time.time())}"
+
+    server, pid = None, args.server_pid
+    args.address = (args.host, args.port)
+    if args.spawn:
+        server, port = spawn_server(args.spawn)
+        args.address, pid = ("127.0.0.1", port), server.pid
+    try:
+        cpu_before = process_cpu_seconds(pid) if pid else None
+        start = time.perf_counter()
+        stats = run(args)
+        elapsed = time.perf_counter() - start
+        cpu = None
+        if cpu_before is not None:
+            cpu = process_cpu_seconds(pid) - cpu_before
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    result = report(args, stats, elapsed, cpu)
+    if args.json:
+        print(json.dumps(result))
+    else:
+        for key, value in result.items():
+            print(f"{key:>22}: {value}")
+        for error in stats.errors[:10]:
+            print("error:", error)
+    if stats.errors or (
+        args.max_p99 is not None and result["round_trip_p99"] > args.max_p99
+    ):
+        return 1
+    return 0
+
+
+def test_percentile_nearest_rank():
+    values = [0.1 * i for i in range(1, 101)]
+    assert percentile(values, 0.5) == values[49]
+    assert percentile(values, 0.99) == values[98]
+    assert percentile([3.0], 0.9) == 3.0
+    assert percentile([], 0.5) == 0.0
+
+
+def test_process_cpu_seconds_counts_this_process():
+    start = process_cpu_seconds(os.getpid())
+    if start is None:
+        return
+    deadline = time.process_time() + 0.2
+    while time.process_time() < deadline:
+        pass
+    assert process_cpu_seconds(os.getpid()) >= start + 0.1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,3 @@
-import base64
-import pickle
 from typing import Any, List, Tuple
 
 import wx
@@ -107,17 +105,10 @@ class LoginFrame(wx.Frame):
 
     def authenticate(self, username, password) -> Tuple[bool, List[Any]]:
         self.net.send_message(self.net.build_message("LOGIN", [username, password]))
-        msg = self.net.recv_message()
-        code = self.net.get_message_code(msg)
-        params = self.net.get_message_params(msg)
+        code, params = self.net.recv_frame()
 
         if "LOGIN_SUCCESS" in code:
-            events = (
-                [pickle.loads(base64.b64decode(x)) for x in params]
-                if len(params) > 1
-                else []
-            )
-            return True, events
+            return True, self.net.decode_objects(params)
         return False, []
 
     def open_main_frame(self, username, events):
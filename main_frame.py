@@ -1,10 +1,9 @@
 # Standard library imports first
 import base64
+import codecs
 import datetime
-import difflib
 import json
 import os
-import pickle
 import threading
 import time
 import traceback
@@ -17,13 +16,20 @@ import wx.adv
 import wx.html2
 
 # First-party/local imports
+import editTracker
+import opLog
 from EventDiag import EventsDialog
 from FontDiag import FontSelectorDialog
 from GraphDial import GraphDialog
 from HistoricList import HistoricListFrame
-from networkManager import NetworkManager
+from networkManager import NetworkManager, UploadFailed, as_bytes, coalesce_batch
 from SummaryCarousell import SummaryCarousel
 
+# an upload cut off by a dropped connection resumes on the next attempt
+UPLOAD_ATTEMPTS = 3
+# captured edits of an open summary are sent this often
+SYNC_INTERVAL_MS = 500
+
 
 class MainFrame(wx.Frame):
     """Main application window for the document editor with HTML preview."""
@@ -56,7 +62,12 @@ class MainFrame(wx.Frame):
         # Initialize state variables
         self.html_content = ""
         self.awaiting_update = False
+        # the editor's text when its edits were last captured
         self.prev_content = ""
+        # the server's text and revision, and the edits not acknowledged yet
+        self.sync = opLog.ClientSync()
+        # a RESYNC is on its way, deltas until its TAKEUPDATE are skipped
+        self.resyncing = False
         self.last_char = " "
         self.last_update_time = 0
         self.UPDATE_THROTTLE_INTERVAL = 0.0
@@ -83,6 +94,9 @@ class MainFrame(wx.Frame):
         # Handler and dialog attributes
         self.handlers = {}
         self.dialog = None
+        # ui calls of the messages the listening thread is handling, they
+        # run together in one wx.CallAfter, see call_after
+        self.ui_batch: list | None = None
 
         # Event-related attributes
         # self.event_title = ""
@@ -163,8 +177,11 @@ class MainFrame(wx.Frame):
         editor_sizer = wx.BoxSizer(wx.VERTICAL)
 
         self.editor = wx.TextCtrl(self.editor_panel, style=wx.TE_MULTILINE)
+        self.tracker = editTracker.EditTracker(self.editor)
         self.editor.Bind(wx.EVT_TEXT, self.on_text_input)
         self.editor.Bind(wx.EVT_CHAR, self.on_char)
+        self.editor.Bind(wx.EVT_KEY_DOWN, self.on_key_down)
+        self.editor.Bind(wx.EVT_KEY_UP, self.on_key_up)
 
         # Set font
         font = wx.Font(
@@ -232,15 +249,12 @@ class MainFrame(wx.Frame):
 
     def handle_error(self, _, explaination, net):
         # wx.MessageBox(f"Error: {explaination}", "Error", wx.OK | wx.ICON_ERROR)
-        wx.CallAfter(
+        self.call_after(
             wx.MessageBox, f"Error: {explaination}", "Error", wx.OK | wx.ICON_ERROR
         )
 
     def handle_take_summaries(self, _, *params, net):
-        summaries = []
-        for summary in params:
-            summ = pickle.loads(base64.b64decode(summary))
-            summaries.append(summ)
+        summaries = net.decode_objects(params)
 
         def show_summaries():
             if not summaries:
@@ -255,13 +269,10 @@ class MainFrame(wx.Frame):
             self.carousel.Destroy()
             # print("Removed caroussle")
 
-        wx.CallAfter(show_summaries)
+        self.call_after(show_summaries)
 
     def handle_take_events(self, _, *params, net):
-        events = []
-        for event_data in params:
-            event = pickle.loads(base64.b64decode(event_data))
-            events.append(event)
+        events = net.decode_objects(params)
 
         def show_events():
             if not events:
@@ -276,10 +287,10 @@ class MainFrame(wx.Frame):
             # self.events_dialog.Destroy()
             # self.events_dialog = None
 
-        wx.CallAfter(show_events)
+        self.call_after(show_events)
 
     def handle_event_success(self, *params, net):
-        wx.CallAfter(
+        self.call_after(
             wx.MessageBox,
             f"Event added on {self.formatted_date} at {self.formatted_time} added.",
             "Success",
@@ -287,7 +298,7 @@ class MainFrame(wx.Frame):
         )
         if not self.dialog:
             return
-        wx.CallAfter(self.dialog.Destroy)
+        self.call_after(self.dialog.Destroy)
 
     def save_handlers(self, *params, net):
         print("Save, response: ", params)
@@ -298,23 +309,23 @@ class MainFrame(wx.Frame):
             self.editor.AppendText("~".join(params[1:]))
             self.update_html_view()
 
-        wx.CallAfter(update_editor)
+        self.call_after(update_editor)
 
     def handle_graph(self, _, *params, net):
         """Handle graph data received from server"""
         if not params:
-            wx.CallAfter(
+            self.call_after(
                 wx.MessageBox, "No graph data received", "Error", wx.OK | wx.ICON_ERROR
             )
             return
 
         try:
             # Deserialize the graph data
-            graph_data = pickle.loads(base64.b64decode(params[0]))
+            graph_data = net.decode_object(params[0])
 
             # Make sure we display something even if the list is empty
             if not graph_data:
-                wx.CallAfter(
+                self.call_after(
                     wx.MessageBox,
                     "No summaries found in the graph. Try creating or sharing more summaries.",
                     "Empty Graph",
@@ -330,10 +341,10 @@ class MainFrame(wx.Frame):
                     pass
                 graph_dialog.Destroy()
 
-            wx.CallAfter(show_graph)
+            self.call_after(show_graph)
 
         except Exception as e:
-            wx.CallAfter(
+            self.call_after(
                 wx.MessageBox,
                 f"Error processing graph data: {str(e)}",
                 "Error",
@@ -348,7 +359,7 @@ class MainFrame(wx.Frame):
             self.editor.Replace(start, end, summ)
             self.update_html_view()
 
-        wx.CallAfter(update_summary)
+        self.call_after(update_summary)
 
     # def handle_gcal(self, _, *params, net):
     #     if not self.events_dialog:
@@ -369,7 +380,8 @@ class MainFrame(wx.Frame):
             "INFO": self.handle_info,
             "TAKEUPDATE": self.take_update,
             "TAKEUPDATE2": self.take_update,
-            "SHARE_SUCCESS": lambda a, *params, net: wx.CallAfter(
+            "TAKEDELTA": self.take_delta,
+            "SHARE_SUCCESS": lambda a, *params, net: self.call_after(
                 wx.MessageBox,
                 f"Summary shared with {params[0]}",
                 "Success",
@@ -377,28 +389,77 @@ class MainFrame(wx.Frame):
             ),
             "TAKEHIST": self.handle_take_hist,
             "TAKESUMMARY": self.handle_recived_summary,
+            "SUMMARYSTART": self.handle_summary_start,
+            "SUMMARYCHUNK": self.handle_summary_chunk,
+            "SUMMARYEND": self.handle_summary_end,
             "TAKEGRAPH": self.handle_graph,
             "TAKESUMMARYLINK": self.handle_take_link,
             "HISTORICLIST": self.get_historic_list,
+            "UACK": lambda _, name, offset, net: net.upload_acked(name, offset),
+            "UFAIL": lambda _, name, reason, net: net.upload_failed(name, reason),
             # "GCAL_EVENTS": self.handle_gcal,
         }
 
         self.net.add_handlers(self.handlers)
-        self.net.sock.settimeout(0.5)
+        # reads block until the server sends something, senders dont wait
+        self.net.sock.settimeout(None)
         while True:
             try:
-                # Non-blocking receive with better error managementserver
-                found_any = self.net.recv_handle_args(self)
-
-                if not found_any:
-                    time.sleep(0.1)  # Reduced sleep time
-
+                # only the newest of several full document updates is shown
+                batch = coalesce_batch(self.net.recv_batch())
+                self.ui_batch = []
+                for code, params in batch:
+                    try:
+                        self.net.handle_args(code, params, self)
+                    except Exception as _:
+                        traceback.print_exc()
+                calls, self.ui_batch = self.ui_batch, None
+                if calls:
+                    wx.CallAfter(self.run_ui_batch, calls)
+
+            except ConnectionError as _:
+                traceback.print_exc()
+                self.try_reconnect()
             except Exception as _:
                 # print(f"Listening Thread Error: {e}")
 
                 traceback.print_exc()
                 time.sleep(1)  # Prevent tight error loop
 
+    def call_after(self, func, *args, **kwargs):
+        """
+        wx.CallAfter, but the calls of messages the listening thread read
+        together are queued and made in a single wx.CallAfter.
+        """
+        if (
+            self.ui_batch is not None
+            and threading.current_thread() is self.listening_thread
+        ):
+            self.ui_batch.append((func, args, kwargs))
+            return
+        wx.CallAfter(func, *args, **kwargs)
+
+    def run_ui_batch(self, calls):
+        """Make the queued calls of call_after, on the main thread"""
+        for func, args, kwargs in calls:
+            try:
+                func(*args, **kwargs)
+            except Exception as _:
+                traceback.print_exc()
+
+    def try_reconnect(self):
+        """Resume the session on a new connection after the old one dropped"""
+        import client  # delay import, client imports the login frame
+
+        try:
+            if self.net.address and client.reconnect(self.net, self.net.address):
+                self.net.sock.settimeout(None)
+                self.show_info_message("Reconnected to the server")
+                return
+        except OSError as e:
+            print(f"Reconnect failed: {e}")
+        time.sleep(1)  # Prevent tight error loop
+
     def share_summary(self, _):
         # print("Sharing summary")
         dialog = wx.TextEntryDialog(
@@ -490,15 +551,15 @@ class MainFrame(wx.Frame):
 
     def show_error_message(self, message, title="Error"):
         """Show error message in a thread-safe way"""
-        wx.CallAfter(wx.MessageBox, message, title, wx.OK | wx.ICON_ERROR)
+        self.call_after(wx.MessageBox, message, title, wx.OK | wx.ICON_ERROR)
 
     def show_info_message(self, message, title="Info"):
         """Show info message in a thread-safe way"""
-        wx.CallAfter(wx.MessageBox, message, title, wx.OK | wx.ICON_INFORMATION)
+        self.call_after(wx.MessageBox, message, title, wx.OK | wx.ICON_INFORMATION)
 
     def show_success_message(self, message, title="Success"):
         """Show success message in a thread-safe way"""
-        wx.CallAfter(wx.MessageBox, message, title, wx.OK | wx.ICON_INFORMATION)
+        self.call_after(wx.MessageBox, message, title, wx.OK | wx.ICON_INFORMATION)
 
     def update_doc(self, _):
         """Update document with improved error handling and logic"""
@@ -516,20 +577,8 @@ class MainFrame(wx.Frame):
 
         try:
             with self.update_lock:
-                old_text = self.normalize_text(self.prev_content)
-                assert self.editor is not None
-                new_text = self.normalize_text(self.editor.GetValue())
-
-                # Detect if content has actually changed
-                if old_text == new_text:
-                    print("No changes detected")
-                    self.send_changes([], False)
-                    return
-                # Calculate changes using diff
-                changes = self._calculate_text_changes(old_text, new_text)
-
-                # Send update if there are meaningful changes
-                self.send_changes(changes, new_text)
+                self.capture()
+                self.send_changes()
                 return
         except Exception as e:
             print(f"Error in update_doc: {e}")
@@ -538,36 +587,40 @@ class MainFrame(wx.Frame):
 
     def _calculate_text_changes(self, old_text, new_text):
         """Calculate changes between old and new text"""
-        matcher = difflib.SequenceMatcher(None, old_text, new_text)
-        changes = []
-
-        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
-            if tag == "equal":
-                continue
-
-            change_type = {
-                "replace": "UPDATE",
-                "delete": "DELETE",
-                "insert": "INSERT",
-            }.get(tag, tag)
-
-            content = new_text[j1:j2] if tag in ["replace", "insert"] else ""
-
-            # Skip empty changes that aren't deletions
-            if not content and tag != "delete":
-                continue
-
-            changes.append({"cord": [i1, i2], "type": change_type, "cont": content})
-
-        return changes
-
-    def send_changes(self, changes, new_text):
+        return editTracker.diff_changes(old_text, new_text)
+
+    def capture(self):
+        """Hand the edits made since the last capture to self.sync"""
+        # captured by the tracker as they were typed
+        changes, sure = self.tracker.take()
+        if changes is None or not sure:
+            # some were diffed around the caret, check the result
+            assert self.editor is not None
+            new_text = self.editor.GetValue()
+            if changes is None or str(self.tracker.text) != new_text:
+                print("Edit capture went wrong, diffing the whole text")
+                changes = opLog.sequential(
+                    self._calculate_text_changes(self.prev_content, new_text)
+                )
+                self.tracker.reset(new_text)
+        if changes:
+            self.sync.local(changes)
+            self.prev_content = str(self.tracker.text)
+
+    def send_changes(self):
+        """Send the captured edits, unless an UPDATEDOC waits for its ack"""
+        changes = self.sync.flush()
+        if changes is None:
+            return
         # print("Found these changes: ", changes)
-        payload = json.dumps({"changes": changes})
+        # in order, each on the text the one before left
+        payload = {"changes": changes, "sequential": True}
+        if self.sync.revision is not None:
+            # the server transforms them against the ops applied since
+            payload["base_rev"] = self.sync.revision
+        payload = json.dumps(payload)
         try:
             self.net.send_message(self.net.build_message("UPDATEDOC", [payload]))
-            if new_text:
-                self.prev_content = new_text
             self.awaiting_update = True
         except Exception as _:
             # print(f"Error sending update: {e}")
@@ -575,7 +628,7 @@ class MainFrame(wx.Frame):
 
     def handle_info(self, _, *params, net):
         # print("Recived info: ", params)
-        wx.CallAfter(
+        self.call_after(
             wx.MessageBox,
             f"Info: {params[0]}",
             "Info",
@@ -583,7 +636,7 @@ class MainFrame(wx.Frame):
         )
 
     def get_historic_list(self, _, pickled, net):
-        historic = pickle.loads(base64.b64decode(pickled))
+        historic = net.decode_object(pickled)
         print("Historic: ", historic)
         # list of timestamps formated like this(str):  timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
         # first paese the list, then sort
@@ -600,7 +653,7 @@ class MainFrame(wx.Frame):
             frame.Show()
             # print("Showing historic list")
 
-        wx.CallAfter(create_frame)
+        self.call_after(create_frame)
 
     def on_historic_pick(self, selected_datetime):
         print("Picked: ", selected_datetime)
@@ -626,7 +679,7 @@ class MainFrame(wx.Frame):
             self.is_processing.set()
 
             # Decode update
-            jsoned = json.loads(base64.b64decode(params[0]).decode())
+            jsoned = json.loads(as_bytes(params[0]).decode())
             print("Unjsoned; ")
             print(jsoned)
 
@@ -640,9 +693,12 @@ class MainFrame(wx.Frame):
                     # Update content
                     new_content = jsoned["doc_content"]
                     print("Seting value")
-                    self.editor.SetValue(new_content)
+                    with self.tracker.pause(new_content):
+                        self.editor.SetValue(new_content)
                     print("Set value")
                     self.prev_content = new_content
+                    self.sync.reset(new_content, jsoned.get("revision"))
+                    self.resyncing = False
                     print("UPDATED THE FUCKING UI")
                     font_name = jsoned.get("font_name", "Arial")
                     # Apply font
@@ -702,13 +758,48 @@ class MainFrame(wx.Frame):
                     raise e
 
             # Ensure UI update happens on main thread
-            wx.CallAfter(update_ui)
+            self.call_after(update_ui)
 
         except Exception as _:
             # print(f"Update Processing Error: {e}")
             traceback.print_exc()
             self.is_processing.clear()
 
+    def take_delta(self, _, *params, net):
+        """Apply the ops the others made since our revision"""
+        delta = json.loads(as_bytes(params[0]).decode())
+
+        def update_ui():
+            if self.resyncing:
+                return
+            with self.update_lock:
+                # what was typed since has to move past the others' ops
+                self.capture()
+                editor_ops = self.sync.receive(delta)
+                if editor_ops is None:
+                    # missed a revision or drifted, the whole text is needed
+                    self.resync()
+                    return
+                if editor_ops:
+                    # our own ops are shown already, repaint the others'
+                    assert self.editor is not None
+                    with self.tracker.applying(editor_ops):
+                        for op in editor_ops:
+                            start, end = op["cord"]
+                            if op["type"] == "INSERT":
+                                end = start
+                            self.editor.Replace(start, end, op["cont"])
+                    self.prev_content = str(self.tracker.text)
+                self.awaiting_update = False
+                # the last UPDATEDOC may have been acknowledged
+                self.send_changes()
+
+        self.call_after(update_ui)
+
+    def resync(self):
+        self.resyncing = True
+        self.net.send_message(self.net.build_message("RESYNC", []))
+
     def on_font_selector(self, _):
         """Handle font selection with improved error handling"""
         dialog = FontSelectorDialog(self, self.net)
@@ -781,7 +872,16 @@ class MainFrame(wx.Frame):
             # print("Current char:", self.last_char)
         event.Skip()
 
+    def on_key_down(self, event):
+        self.tracker.key_down()
+        event.Skip()
+
+    def on_key_up(self, event):
+        self.tracker.key_up()
+        event.Skip()
+
     def on_text_input(self, _):
+        self.tracker.text_changed()
         # Store current position and content
         assert self.editor is not None
         current_pos = self.editor.GetInsertionPoint()
@@ -1058,8 +1158,10 @@ class MainFrame(wx.Frame):
             ).decode()
             # print("THE CONTENT: ", cont)
             assert self.editor is not None
-            self.editor.SetValue(cont)
+            with self.tracker.pause(cont):
+                self.editor.SetValue(cont)
             self.prev_content = cont
+            self.sync.reset(cont, None)
             self.update_html_view()
 
         # if link.startswith("internal:"):
@@ -1119,7 +1221,21 @@ class MainFrame(wx.Frame):
         if dialog.ShowModal() == wx.ID_CANCEL:
             return
         path = dialog.GetPath()
-        self.net.send_file(path)
+        # the UACKs come in on the listening thread, don't block the UI on them
+        threading.Thread(target=self.upload_and_scan, args=(path,), daemon=True).start()
+
+    def upload_and_scan(self, path):
+        for attempt in range(UPLOAD_ATTEMPTS):
+            try:
+                self.net.send_file(path)
+                break
+            except (ConnectionError, TimeoutError, UploadFailed) as e:
+                # the listening thread reconnects, the next try resumes
+                print(f"Upload interrupted: {e}")
+                time.sleep(2 * (attempt + 1))
+        else:
+            self.show_info_message("Upload failed, try again later")
+            return
         self.net.send_message(
             self.net.build_message("GETFILECONTENT", [os.path.basename(path)])
         )
@@ -1201,7 +1317,8 @@ class MainFrame(wx.Frame):
         if not file_text_content:
             return
         assert self.editor is not None
-        self.editor.SetValue(file_text_content)
+        with self.tracker.replacing(file_text_content):
+            self.editor.SetValue(file_text_content)
         self.update_html_view()
 
     def import_from_pdf(self, _):
@@ -1216,7 +1333,9 @@ class MainFrame(wx.Frame):
             return
         # preform the reverse of convert_text_to_html
         assert self.editor is not None
-        self.editor.SetValue(self.html_to_text(file_text_content))
+        text = self.html_to_text(file_text_content)
+        with self.tracker.replacing(text):
+            self.editor.SetValue(text)
         self.update_html_view()
         return
 
@@ -1227,7 +1346,8 @@ class MainFrame(wx.Frame):
         if not file_text_content:
             return
         assert self.editor is not None
-        self.editor.SetValue(file_text_content)
+        with self.tracker.replacing(file_text_content):
+            self.editor.SetValue(file_text_content)
         self.update_html_view()
 
     def get_file_content(self, _):
@@ -1260,16 +1380,12 @@ class MainFrame(wx.Frame):
             wx.OK | wx.ICON_INFORMATION,
         )
         self.net.send_message(self.net.build_message("GETSUMMARIES", []))
-        msg = self.net.recv_message()
-        code, params = self.net.get_message_code(msg), self.net.get_message_params(msg)
+        code, params = self.net.recv_frame()
         if code.strip() == "ERROR":
             wx.MessageBox(f"Error: {params[0]}", "Error", wx.OK | wx.ICON_ERROR)
             return
         #
-        summaries = []
-        for summary in params:
-            summ = pickle.loads(base64.b64decode(summary))
-            summaries.append(summ)
+        summaries = self.net.decode_objects(params)
 
         if not summaries:
             wx.MessageBox("No summaries found.", "Info", wx.OK | wx.ICON_INFORMATION)
@@ -1318,12 +1434,14 @@ class MainFrame(wx.Frame):
 
         def process_summary():
             try:
-                dic = pickle.loads(base64.b64decode(params[0]))
+                dic = net.decode_object(params[0])
                 cont = dic["data"].decode()
                 dicty = {"font": dic["summ"].font}
                 assert self.editor is not None
-                self.editor.SetValue(cont)
+                with self.tracker.pause(cont):
+                    self.editor.SetValue(cont)
                 self.prev_content = cont
+                self.sync.reset(cont, None)
                 dicty["font"] = dicty.get("font", "Arial")
 
                 if dicty["font"] and dicty["font"].startswith("http"):
@@ -1387,7 +1505,7 @@ class MainFrame(wx.Frame):
                 )
                 self.Close()
 
-        wx.CallAfter(process_summary)
+        self.call_after(process_summary)
 
     def handle_recived_summary(self, _, *params, net):
         self.historic = False
@@ -1395,65 +1513,58 @@ class MainFrame(wx.Frame):
         def process_summary():
             assert self.editor is not None
             try:
-                dic = pickle.loads(base64.b64decode(params[0]))
+                dic = net.decode_object(params[0])
                 cont = dic["data"].decode()
-                dicty = {"font": dic["summ"].font}
-                self.editor.SetValue(cont)
-                self.prev_content = cont
-                dicty["font"] = dicty.get("font", "Arial")
-
-                if dicty["font"] and dicty["font"].startswith("http"):
-                    self.current_font = {
-                        "name": dicty["font"],
-                        "url": dicty["font"],
-                        "from_url": True,
-                    }
-                else:
-                    # Clean up the font name - remove any @ symbol or pipe characters
-                    if dicty.get("font") is None:
-                        clean_font_name = "Arial"
+                with self.tracker.pause(cont):
+                    self.editor.SetValue(cont)
+                self.finish_summary(cont, dic["summ"].font)
+            except Exception as _:
+                # print("Error: ", e)
+                traceback.print_exc()
+                wx.MessageBox(
+                    "Error: Could not retrieve summary content.",
+                    "Error",
+                    wx.OK | wx.ICON_ERROR,
+                )
+                self.Close()
 
-                    else:
-                        clean_font_name = (
-                            dicty.get("font", "Arial").replace("@", "").replace("|", "")
-                        )
-                    self.current_font = {
-                        "name": clean_font_name if clean_font_name else "Arial",
-                        "url": None,
-                        "from_url": False,
-                    }
+        self.call_after(process_summary)
 
-                try:
-                    font = wx.Font(
-                        12,
-                        wx.FONTFAMILY_DEFAULT,
-                        wx.FONTSTYLE_NORMAL,
-                        wx.FONTWEIGHT_NORMAL,
-                        False,
-                        self.current_font["name"],
-                    )
-                    self.editor.SetFont(font)
-                except Exception as font_error:
-                    print(f"Error setting font: {font_error}")
-                    # Fallback to default font
-                    default_font = wx.Font(
-                        12,
-                        wx.FONTFAMILY_DEFAULT,
-                        wx.FONTSTYLE_NORMAL,
-                        wx.FONTWEIGHT_NORMAL,
-                        False,
-                        "Arial",
-                    )
-                    self.editor.SetFont(default_font)
+    def handle_summary_start(self, _, sid, size, net):
+        """A streamed summary begins, its chunks are shown as they arrive"""
+        self.historic = False
+        self.summary_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.summary_parts = []
+
+        def clear_editor():
+            self.update_timer.Stop()
+            self.update_enable_timer.Stop()
+            # the chunks are the server's text, finish_summary resumes tracking
+            self.tracker.paused = True
+            self.editor.SetValue("")
+
+        self.call_after(clear_editor)
+
+    def handle_summary_chunk(self, _, sid, data, net):
+        # a chunk may end inside a multi byte character, the decoder keeps it
+        text = self.summary_decoder.decode(as_bytes(data))
+        self.summary_parts.append(text)
+        self.call_after(self.editor.AppendText, text)
+
+    def handle_summary_end(self, _, sid, meta, net):
+        summ = net.decode_object(meta)
+        text = self.summary_decoder.decode(b"", final=True)
+        self.summary_parts.append(text)
+        cont = "".join(self.summary_parts)
+        self.summary_parts = []
 
-                print("Font info: ", self.current_font)
-                if hasattr(self, "carousel") and self.carousel:
-                    self.carousel.Close()
-                self.update_timer.Start(3000)  # Check every 3 seconds
-                self.update_enable_timer.Start(3000)
+        def process_summary():
+            try:
+                self.editor.AppendText(text)
+                self.finish_summary(cont, summ.font)
             except Exception as _:
-                # print("Error: ", e)
                 traceback.print_exc()
+                self.tracker.paused = False
                 wx.MessageBox(
                     "Error: Could not retrieve summary content.",
                     "Error",
@@ -1461,4 +1572,62 @@ class MainFrame(wx.Frame):
                 )
                 self.Close()
 
-        wx.CallAfter(process_summary)
+        self.call_after(process_summary)
+
+    def finish_summary(self, cont, font):
+        """Apply the font of a loaded summary and start syncing changes"""
+        self.prev_content = cont
+        self.sync.reset(cont, None)
+        self.tracker.paused = False
+        self.tracker.reset(cont)
+        dicty = {"font": font}
+
+        if dicty["font"] and dicty["font"].startswith("http"):
+            self.current_font = {
+                "name": dicty["font"],
+                "url": dicty["font"],
+                "from_url": True,
+            }
+        else:
+            # Clean up the font name - remove any @ symbol or pipe characters
+            if dicty.get("font") is None:
+                clean_font_name = "Arial"
+
+            else:
+                clean_font_name = (
+                    dicty.get("font", "Arial").replace("@", "").replace("|", "")
+                )
+            self.current_font = {
+                "name": clean_font_name if clean_font_name else "Arial",
+                "url": None,
+                "from_url": False,
+            }
+
+        try:
+            font = wx.Font(
+                12,
+                wx.FONTFAMILY_DEFAULT,
+                wx.FONTSTYLE_NORMAL,
+                wx.FONTWEIGHT_NORMAL,
+                False,
+                self.current_font["name"],
+            )
+            self.editor.SetFont(font)
+        except Exception as font_error:
+            print(f"Error setting font: {font_error}")
+            # Fallback to default font
+            default_font = wx.Font(
+                12,
+                wx.FONTFAMILY_DEFAULT,
+                wx.FONTSTYLE_NORMAL,
+                wx.FONTWEIGHT_NORMAL,
+                False,
+                "Arial",
+            )
+            self.editor.SetFont(default_font)
+
+        print("Font info: ", self.current_font)
+        if hasattr(self, "carousel") and self.carousel:
+            self.carousel.Close()
+        self.update_timer.Start(SYNC_INTERVAL_MS)
+        self.update_enable_timer.Start(3000)
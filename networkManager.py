@@ -1,12 +1,261 @@
+import asyncio
 import base64
+import collections
 import os
+import pickle
 import select
+import selectors
+import struct
 import threading
 import time
-from socket import socket
-from typing import Callable, Dict, List
+import zlib
+from contextlib import nullcontext
+from socket import SHUT_RDWR, socket
+from typing import Callable, Dict, List, Tuple, Union
 
+import wireCodec
 from cryptManager import CryptManager
+from statsManager import STATS, UNKNOWN_CODE
+
+EXIT_CODE = "EXIT"
+# print every message sent and received, costs real time on busy servers
+LOG_TRAFFIC = os.getenv("NET_LOG_TRAFFIC", "0") == "1"
+
+# capabilities offered in the KEY exchange, old clients just ignore them
+CAP_BINARY = "BIN"
+# zlib payload compression, only used together with binary framing
+CAP_ZLIB = "ZLIB"
+# AES-GCM with counter nonces instead of CBC with a random iv per message
+CAP_GCM = "GCM"
+# the server hands out resumption tickets after a login
+CAP_RESUME = "RESUME"
+# windowed, acknowledged and resumable file uploads
+CAP_UPLOAD = "UPLOAD"
+# GETSUMMARY answered with SUMMARYSTART, SUMMARYCHUNK... and SUMMARYEND
+CAP_STREAM = "STREAM"
+# summaries, events and graphs are sent with wireCodec instead of pickle
+CAP_SCHEMA = "SCHEMA"
+# the peer answers PING with PONG, so an idle connection can be told apart
+# from a dead one
+CAP_PING = "PING"
+SUPPORTED_CAPS = [
+    CAP_BINARY,
+    CAP_ZLIB,
+    CAP_GCM,
+    CAP_RESUME,
+    CAP_UPLOAD,
+    CAP_STREAM,
+    CAP_SCHEMA,
+    CAP_PING,
+]
+
+# binary frame: body length + flags, body is iv + ciphertext of the fields
+FRAME_HEADER = struct.Struct("!IB")
+# plaintext of a binary frame: code length + field count, then the code
+CODE_HEADER = struct.Struct("!BH")
+# every field: kind + length, then the raw field bytes
+FIELD_HEADER = struct.Struct("!BI")
+FIELD_STR = 0
+FIELD_BYTES = 1
+IV_SIZE = 16
+# frame header flags
+FLAG_ZLIB = 0x01
+# smaller payloads are not worth the compression time
+COMPRESS_THRESHOLD = 1024
+COMPRESS_LEVEL = 6
+MAX_DECOMPRESSED_SIZE = 256 * 1024 * 1024
+# upload stream: chunk size and how many chunks may wait for their UACK
+UPLOAD_CHUNK_SIZE = 256 * 1024
+UPLOAD_WINDOW = 8
+UPLOAD_ACK_TIMEOUT = 30
+LEGACY_CHUNK_SIZE = 1024
+# outbound queue, senders of the connection itself wait above the size,
+# a broadcast above the limit disconnects the peer instead
+OUTBOUND_QUEUE_SIZE = 256
+OUTBOUND_QUEUE_LIMIT = 512
+# full state updates and the codes they replace: queued or batched messages
+# of those are dropped when a newer full state update comes in
+COALESCE_CODES = {"TAKEUPDATE": {"TAKEUPDATE", "TAKEDELTA"}}
+# keepalives are answered by the NetworkManager itself, handlers never see them
+PING_CODE = "PING"
+PONG_CODE = "PONG"
+KEEPALIVE_CODES = {PING_CODE, PONG_CODE}
+
+Field = Union[str, bytes]
+
+
+def as_bytes(field: Field) -> bytes:
+    """
+    Get the bytes of a field that may have been sent raw (binary framing)
+    or base64 encoded (text framing).
+    """
+    if isinstance(field, (bytes, bytearray, memoryview)):
+        return bytes(field)
+    return base64.b64decode(field)
+
+
+def as_text(field: Field) -> str:
+    """The text protocol form of a field, raw bytes become base64."""
+    if isinstance(field, (bytes, bytearray, memoryview)):
+        return base64.b64encode(field).decode()
+    return field
+
+
+def pack_fields(code: str, params: List[Field]) -> bytes:
+    """
+    Pack a code and its fields into the plaintext of a binary frame.
+
+    :param code: The message code.
+    :param params: str fields are utf-8 encoded, bytes fields are kept raw.
+    :return: The packed bytes.
+    """
+    code_bytes = code.encode()
+    parts = [CODE_HEADER.pack(len(code_bytes), len(params)), code_bytes]
+    for param in params:
+        if isinstance(param, (bytes, bytearray, memoryview)):
+            kind, data = FIELD_BYTES, param
+        else:
+            kind, data = FIELD_STR, str(param).encode()
+        parts.append(FIELD_HEADER.pack(kind, len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def unpack_fields(data) -> Tuple[str, List[Field]]:
+    """
+    Unpack the plaintext of a binary frame.
+
+    :param data: A bytes-like object built by pack_fields.
+    :return: The code and its fields.
+    """
+    view = memoryview(data)
+    code_len, count = CODE_HEADER.unpack_from(view, 0)
+    offset = CODE_HEADER.size
+    code = str(view[offset : offset + code_len], "utf-8")
+    offset += code_len
+    params: List[Field] = []
+    for _ in range(count):
+        kind, size = FIELD_HEADER.unpack_from(view, offset)
+        offset += FIELD_HEADER.size
+        field = view[offset : offset + size]
+        offset += size
+        params.append(bytes(field) if kind == FIELD_BYTES else str(field, "utf-8"))
+    return code, params
+
+
+def coalesce_batch(
+    batch: List[Tuple[str, List[Field]]], codes=COALESCE_CODES
+) -> List[Tuple[str, List[Field]]]:
+    """
+    Drop the messages of a received batch that a later full state message
+    replaces, see COALESCE_CODES.
+    """
+    replaced = set()
+    kept = []
+    for message in reversed(batch):
+        if message[0] in replaced:
+            continue
+        kept.append(message)
+        replaced |= codes.get(message[0], set())
+    kept.reverse()
+    return kept
+
+
+class FrameReader:
+    """
+    Reads frames from a socket into one reusable buffer with recv_into.
+
+    A single read may fill in several frames, they are handed out one by one
+    as memoryviews into the buffer. A view is only valid until the next
+    read_frame call, so decode it first.
+    """
+
+    TEXT_HEADER_SIZE = 10
+
+    def __init__(self, sock: socket, size: int = 64 * 1024) -> None:
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first byte not handed out yet
+        self.end = 0  # end of the received bytes
+
+    def _frame_bounds(self, binary: bool) -> Tuple[int, int, int]:
+        """
+        Find the next frame in the buffer.
+
+        :return: (body start, body end, flags), body end is past self.end
+            (or -1 if the header is incomplete) when more bytes are needed.
+        """
+        available = self.end - self.start
+        if binary:
+            if available < FRAME_HEADER.size:
+                return self.start, -1, 0
+            size, flags = FRAME_HEADER.unpack_from(self.buffer, self.start)
+            body_start = self.start + FRAME_HEADER.size
+            return body_start, body_start + size, flags
+        if available < self.TEXT_HEADER_SIZE:
+            return self.start, -1, 0
+        body_start = self.start + self.TEXT_HEADER_SIZE
+        size = int(bytes(self.view[self.start : body_start]))
+        return body_start, body_start + size, 0
+
+    def has_frame(self, binary: bool) -> bool:
+        _, body_end, _ = self._frame_bounds(binary)
+        return body_end != -1 and body_end <= self.end
+
+    def _fill(self, needed: int) -> None:
+        """
+        Receive more bytes, making room for a frame of needed bytes total.
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+        if self.start + needed > len(self.buffer):
+            pending = self.end - self.start
+            if needed > len(self.buffer):
+                # grow once to the frame size, old views keep the old buffer
+                buffer = bytearray(max(needed, 2 * len(self.buffer)))
+                buffer[:pending] = self.view[self.start : self.end]
+                self.buffer = buffer
+                self.view = memoryview(buffer)
+            else:
+                self.buffer[:pending] = self.buffer[self.start : self.end]
+            self.start, self.end = 0, pending
+        received = self.sock.recv_into(self.view[self.end :])
+        if received == 0:
+            raise ConnectionResetError("Connection closed by peer.")
+        self.end += received
+
+    def read_frame(self, binary: bool) -> Tuple[memoryview, int]:
+        """
+        Read the next frame, a timeout mid frame keeps the partial bytes
+        for the next call.
+
+        :param binary: Parse binary frame headers instead of text sizes.
+        :return: A view of the frame body and the frame flags.
+        """
+        while True:
+            body_start, body_end, flags = self._frame_bounds(binary)
+            if body_end != -1 and body_end <= self.end:
+                self.start = body_end
+                return self.view[body_start:body_end], flags
+            header = FRAME_HEADER.size if binary else self.TEXT_HEADER_SIZE
+            needed = body_end if body_end != -1 else body_start + header
+            self._fill(needed - self.start)
+
+    def pending(self) -> bytes:
+        """The received bytes not handed out yet."""
+        return bytes(self.view[self.start : self.end])
+
+    def preload(self, data: bytes) -> None:
+        """Start with bytes another reader received from the socket."""
+        self.buffer = bytearray(max(len(data), len(self.buffer)))
+        self.buffer[: len(data)] = data
+        self.view = memoryview(self.buffer)
+        self.start, self.end = 0, len(data)
+
+
+class UploadFailed(Exception):
+    """The server refused a chunk of an upload (UFAIL)."""
 
 
 class NetworkManager:
@@ -27,26 +276,208 @@ class NetworkManager:
         self.handlers: Dict[str, Callable] = handlers
         self.crypt_manager = crypt
         self.lock = threading.Lock()
+        # receiving has its own lock so a blocked read never stalls a send
+        self.recv_lock = threading.Lock()
+        self.caps: set = set()
+        self.reader = FrameReader(sock)
+        # (ticket, session key it was issued for), set on the client by TICKET
+        self.resume_ticket: Tuple[bytes, bytes] | None = None
+        self.resumed = False
+        # (host, port) a client reconnects to when the connection drops
+        self.address = None
+        # code -> [messages, plain bytes, bytes after compression]
+        self.compression_stats: Dict[str, List[int]] = {}
+        # file name -> bytes the server acknowledged, filled by UACK
+        self.upload_acks: Dict[str, int] = {}
+        # file name -> why the server refused the upload, filled by UFAIL
+        self.upload_failures: Dict[str, str] = {}
+        self.upload_cond = threading.Condition()
+        # (code, str message or fields), None until start_writer
+        self.outbound: collections.deque | None = None
+        self.outbound_cond = threading.Condition()
+        self.outbound_closed = False
+        self.writer_thread: threading.Thread | None = None
+        # set once the session moved to another process, see detach
+        self.detached = False
+        # monotonic time of the last message from the peer, keepalives included
+        self.last_seen = time.monotonic()
+        # records every decoded message when set, see traceManager.TraceWriter
+        self.trace = None
+        # waits for the socket in wait_readable, built for whichever socket
+        # self.sock is now, a reconnect swaps it
+        self.selector: selectors.BaseSelector | None = None
+        self.selector_sock: socket | None = None
+
+    @property
+    def binary(self) -> bool:
+        return CAP_BINARY in self.caps
+
+    @property
+    def compress(self) -> bool:
+        return self.binary and CAP_ZLIB in self.caps
+
+    @property
+    def gcm(self) -> bool:
+        return self.binary and CAP_GCM in self.caps
+
+    def offer_caps(self) -> str:
+        return ",".join(SUPPORTED_CAPS)
+
+    def accept_caps(self, offer: str, is_server: bool = False) -> str:
+        """
+        Enable the offered capabilities this side supports as well.
+
+        :param offer: Comma separated capabilities from the peer.
+        :param is_server: Which side of the connection this is, picks the
+            nonce direction of the session cipher.
+        :return: The enabled capabilities, comma separated.
+        """
+        self.caps = {cap for cap in offer.split(",") if cap in SUPPORTED_CAPS}
+        if self.gcm:
+            self.crypt_manager.start_session(is_server)
+        return ",".join(sorted(self.caps))
 
     def _get_file_name(self, path: str) -> str:
         return os.path.basename(path)
 
-    def send_file(self, path) -> None:
+    @property
+    def streams_uploads(self) -> bool:
+        return self.binary and CAP_UPLOAD in self.caps
+
+    @property
+    def streams_summaries(self) -> bool:
+        return self.binary and CAP_STREAM in self.caps
+
+    @property
+    def schema(self) -> bool:
+        return CAP_SCHEMA in self.caps
+
+    @property
+    def heartbeat(self) -> bool:
+        return CAP_PING in self.caps
+
+    def answer_keepalive(self, code: str, params: List[Field]) -> bool:
+        """
+        Answer a PING with a PONG carrying the same fields.
+
+        :return: True if the message was a keepalive and is fully handled.
+        """
+        if code == PING_CODE:
+            self.send_frame_nowait(PONG_CODE, params)
+        return code in KEEPALIVE_CODES
+
+    def encode_objects(self, objects) -> List[bytes]:
+        """
+        Serialize a list of objects into message fields: one wireCodec
+        field with the SCHEMA capability, one pickle per object otherwise.
+        """
+        if self.schema:
+            return [wireCodec.dumps(list(objects))]
+        return [pickle.dumps(obj) for obj in objects]
+
+    def decode_objects(self, params: List[Field]) -> list:
+        """
+        Deserialize the fields made by :meth:`encode_objects`.
+        """
+        if self.schema:
+            return wireCodec.loads(as_bytes(params[0])) if params[0] else []
+        return [pickle.loads(as_bytes(param)) for param in params if param]
+
+    def encode_object(self, obj) -> bytes:
+        return wireCodec.dumps(obj) if self.schema else pickle.dumps(obj)
+
+    def decode_object(self, field: Field):
+        data = as_bytes(field)
+        return wireCodec.loads(data) if self.schema else pickle.loads(data)
+
+    def send_file(
+        self, path, chunk_size: int = UPLOAD_CHUNK_SIZE, window: int = UPLOAD_WINDOW
+    ) -> None:
+        """
+        Upload a file. With the UPLOAD capability the file is streamed in
+        large chunks with up to ``window`` of them unacknowledged, and an
+        upload that was cut off continues from the offset the server has.
+        Someone else has to be receiving, the UACK and UFAIL replies are
+        handed to :meth:`upload_acked` and :meth:`upload_failed`. The file's
+        mtime goes along, so the server does not resume a part it kept of
+        another file with the same name.
+
+        :param path: The file to upload.
+        :param chunk_size: Bytes per chunk of the upload stream.
+        :param window: Chunks that may be in flight before waiting for a UACK.
+        :raises TimeoutError: If the server stops acknowledging.
+        :raises UploadFailed: If the server refused a chunk.
+        """
         name = self._get_file_name(path)
-        self.send_message(self.build_message("FILE", [name], False))
+        if not self.streams_uploads:
+            self.send_message(self.build_message("FILE", [name], False))
+            with open(path, "rb") as f:
+                chunk = f.read(LEGACY_CHUNK_SIZE)
+                while chunk:
+                    self.send_frame("CHUNK", [name, chunk])
+                    chunk = f.read(LEGACY_CHUNK_SIZE)
+            print("Finished chunking the file")
+            self.send_message(self.build_message("END", [name], False))
+            return
+
+        stat = os.stat(path)
+        size = stat.st_size
+        with self.upload_cond:
+            self.upload_acks.pop(name, None)
+            self.upload_failures.pop(name, None)
+        self.send_message(
+            self.build_message("UPLOAD", [name, str(size), str(stat.st_mtime_ns)])
+        )
+        offset = self.wait_upload_ack(name, 0)
+        if offset:
+            print(f"Resuming upload of {name} at {offset}")
         with open(path, "rb") as f:
-            # read chunk of 1024 at a time
-            chunk = f.read(1024)
+            f.seek(offset)
+            chunk = f.read(chunk_size)
             while chunk:
-                self.send_message(
-                    self.build_message(
-                        "CHUNK", [name, base64.b64encode(chunk).decode()], False
-                    )
-                )
-                chunk = f.read(1024)
-        print("Finished chunking the file")
+                self.wait_upload_ack(name, offset - (window - 1) * chunk_size)
+                self.send_frame("UCHUNK", [name, str(offset), chunk])
+                offset += len(chunk)
+                chunk = f.read(chunk_size)
+        self.wait_upload_ack(name, size)
+        print("Finished uploading the file")
         self.send_message(self.build_message("END", [name], False))
 
+    def upload_acked(self, name: str, offset) -> None:
+        """
+        Record a UACK, the server has written ``offset`` bytes of ``name``.
+        """
+        with self.upload_cond:
+            self.upload_acks[name] = int(offset)
+            self.upload_cond.notify_all()
+
+    def upload_failed(self, name: str, reason: str) -> None:
+        """Record a UFAIL, the upload of ``name`` has to start over."""
+        with self.upload_cond:
+            self.upload_failures[name] = reason
+            self.upload_cond.notify_all()
+
+    def wait_upload_ack(self, name: str, offset: int) -> int:
+        """
+        Wait until the server acknowledged at least ``offset`` bytes of an
+        upload, the first UACK of an upload is always awaited.
+
+        :return: The acknowledged offset.
+        :raises TimeoutError: If no acknowledgement arrives in time.
+        :raises UploadFailed: If the server refused the upload meanwhile.
+        """
+        with self.upload_cond:
+            done = self.upload_cond.wait_for(
+                lambda: name in self.upload_failures
+                or self.upload_acks.get(name, -1) >= max(offset, 0),
+                UPLOAD_ACK_TIMEOUT,
+            )
+            if name in self.upload_failures:
+                raise UploadFailed(f"{name}: {self.upload_failures[name]}")
+            if not done:
+                raise TimeoutError(f"Upload of {name} was not acknowledged")
+            return self.upload_acks[name]
+
     def build_message(self, code: str, params: List[str], do_size=False) -> str:
         """
         Build a formatted message string with a code and parameters.
@@ -66,8 +497,54 @@ class NetworkManager:
         :param message: The message string to send.
         """
         with self.lock:
-            print(f"SEND>>>{message[: min(100, len(message))]}")
-            self.sock.send(message.encode())
+            if LOG_TRAFFIC:
+                print(f"SEND>>>{message[: min(100, len(message))]}")
+            self._send_raw(message.encode())
+
+    def _send_raw(self, data: bytes) -> None:
+        """
+        Write already framed bytes to the peer.
+
+        :param data: The bytes to write.
+        """
+        self.sock.sendall(data)
+
+    def wait_readable(self, timeout: float | None = None) -> bool:
+        """
+        Block until the peer sent something or timeout seconds passed. Takes
+        neither lock, so senders and a waiting reader never stall each other.
+
+        :param timeout: Seconds to wait, None waits for as long as it takes.
+        :return: True if there is something to read.
+        """
+        if self.reader.has_frame(self.binary):
+            return True
+        if self.selector_sock is not self.sock:
+            if self.selector is None:
+                self.selector = selectors.DefaultSelector()
+            else:
+                self.selector.unregister(self.selector_sock)
+            self.selector.register(self.sock, selectors.EVENT_READ)
+            self.selector_sock = self.sock
+        return bool(self.selector.select(timeout))
+
+    def recv_batch(self, timeout: float | None = None) -> List[Tuple[str, List[Field]]]:
+        """
+        Wait for the peer, then read every message that came in with the same
+        read, keepalives are answered and left out.
+
+        :param timeout: Seconds to wait, None waits for as long as it takes.
+        :return: The codes and fields read, empty if the wait timed out.
+        """
+        if not self.wait_readable(timeout):
+            return []
+        batch = []
+        while True:
+            code, params = self._read_frame()
+            if not self.answer_keepalive(code, params):
+                batch.append((code, params))
+            if not self.reader.has_frame(self.binary):
+                return batch
 
     def has_received(self) -> bool:
         """
@@ -75,7 +552,9 @@ class NetworkManager:
 
         :return: True if a new message is available, otherwise False.
         """
-        with self.lock:
+        with self.recv_lock:
+            if self.reader.has_frame(self.binary):
+                return True
             return self.sock in select.select([self.sock], [], [], 0)[0]
 
     def recv_handle(self) -> None:
@@ -86,11 +565,12 @@ class NetworkManager:
             if not self.has_received():
                 # print("No message received.")
                 return
-            message = self.recv_message()
-            code = self.get_message_code(message)
+            code, params = self._read_frame()
+            if self.answer_keepalive(code, params):
+                return
             if code in self.handlers.keys():
                 print("Recived code: ", code)
-                self.handlers[code](*self.get_message_params(message), net=self)
+                self.handlers[code](*params, net=self)
             else:
                 print(f"Received message with unhandled code: {code}")
                 return True
@@ -99,27 +579,59 @@ class NetworkManager:
             print("Connection reset by peer.")
             return True
 
-    def recv_handle_server(self, *args) -> None:
+    def recv_handle_server(self, *args, timeout: float = 0) -> None:
         """
         Receive a message from the socket connection and handle it with the appropriate handler function.
+
+        :param timeout: Seconds to wait for a message before returning.
         """
         try:
-            if not self.has_received():
+            if not self.wait_readable(timeout):
                 # print("No message received.")
                 return
-            message = self.recv_message()
-            code = self.get_message_code(message)
-            if code in self.handlers.keys():
-                print("Recived code: ", code)
-                self.handlers[code](*args, *self.get_message_params(message), net=self)
-            else:
-                print(f"Received message with unhandled code: {code}")
-                return True
+            return self.dispatch_frame(*self._read_frame(), *args)
         # ConnectionResetError
         except ConnectionResetError:
             print("Connection reset by peer.")
             return True
 
+    def dispatch(self, message: str, *args) -> bool:
+        """
+        Handle an already decrypted message with the matching handler.
+
+        :param message: The decrypted message string.
+        :return: True if the connection should be closed, otherwise False.
+        """
+        return self.dispatch_frame(
+            self.get_message_code(message), self.get_message_params(message), *args
+        )
+
+    def dispatch_frame(self, code: str, params: List[Field], *args) -> bool:
+        """
+        Handle an already decoded code and its fields with the matching handler.
+
+        :return: True if the connection should be closed, otherwise False.
+        """
+        if code == EXIT_CODE:
+            return True
+        if self.answer_keepalive(code, params):
+            return False
+        handler = self.handlers.get(code)
+        if handler is None:
+            print(f"Received message with unhandled code: {code}")
+            STATS.record_error(UNKNOWN_CODE)
+            return True
+        if LOG_TRAFFIC:
+            print("Recived code: ", code)
+        start = time.perf_counter()
+        error = True
+        try:
+            # handlers return True when the request failed
+            error = bool(handler(*args, *params, net=self))
+        finally:
+            STATS.record_handler(code, time.perf_counter() - start, error)
+        return False
+
     def recv_handle_args(self, *args) -> bool:
         """
         Receive a message from the socket connection and handle it with the appropriate handler function.
@@ -128,12 +640,20 @@ class NetworkManager:
             # print("Received message.")
             # print("No message received.")
             return False
-        message = self.recv_message()
-        code = self.get_message_code(message)
+        code, params = self._read_frame()
+        if self.answer_keepalive(code, params):
+            return True
+        self.handle_args(code, params, *args)
+        return True
+
+    def handle_args(self, code: str, params: List[Field], *args) -> None:
+        """
+        Call the handler of an already decoded message with args before its
+        fields, the way recv_handle_args does.
+        """
         if code in self.handlers.keys():
             print("Recived code: ", code)
-            self.handlers[code](*args, *self.get_message_params(message), net=self)
-            return True
+            self.handlers[code](*args, *params, net=self)
         else:
             print(f"Received message with unhandled code: {code}")
             print("Current codes:", self.handlers.keys())
@@ -193,36 +713,115 @@ class NetworkManager:
         """
         # message = self.sock.recv(10).decode()
 
-        message = self.recv_message_plain()
+        if self.binary:
+            code, params = self.recv_frame()
+            return self.build_message(code, [as_text(param) for param in params])
+        while True:
+            message = self.decode_message(self.recv_message_plain())
+            self.last_seen = time.monotonic()
+            code = message.partition("~")[0]
+            if code not in KEEPALIVE_CODES:
+                return message
+            self.answer_keepalive(code, self.get_message_params(message))
+
+    def recv_frame(self) -> Tuple[str, List[Field]]:
+        """
+        Receive one message and split it into its code and fields, keepalives
+        are answered and skipped.
+
+        :return: The message code and its fields.
+        """
+        while True:
+            code, params = self._read_frame()
+            if not self.answer_keepalive(code, params):
+                return code, params
+
+    def _read_frame(self) -> Tuple[str, List[Field]]:
+        if not self.binary:
+            return self.decode_text(self.recv_message_plain())
+        with self.recv_lock:
+            body, flags = self.reader.read_frame(True)
+            # the view is reused by the next read, decode while holding the lock
+            return self.decode_frame(body, flags)
+
+    def decode_frame(self, body: bytes, flags: int = 0) -> Tuple[str, List[Field]]:
+        """
+        Decrypt and unpack the body of a binary frame.
+
+        :param body: The iv followed by the ciphertext.
+        :param flags: The flags byte of the frame header.
+        :return: The message code and its fields.
+        """
+        start = time.perf_counter()
+        if self.gcm:
+            plain = self.crypt_manager.session.decrypt(body)
+        else:
+            plain = self.crypt_manager.decrypt_data(body[IV_SIZE:], body[:IV_SIZE])
+        if flags & FLAG_ZLIB:
+            decompressor = zlib.decompressobj()
+            plain = decompressor.decompress(plain, MAX_DECOMPRESSED_SIZE)
+            if decompressor.unconsumed_tail:
+                raise ValueError("Decompressed frame is too large.")
+        code, params = unpack_fields(plain)
+        self.last_seen = time.monotonic()
+        if self.trace is not None and code not in KEEPALIVE_CODES:
+            self.trace.record(code, params)
+        STATS.record_recv(
+            self.stats_code(code),
+            FRAME_HEADER.size + len(body),
+            time.perf_counter() - start,
+        )
+        return code, params
+
+    def decode_text(self, message: bytes) -> Tuple[str, List[str]]:
+        """
+        Decrypt a raw ENCODED message and split it into its code and fields.
+        """
+        start = time.perf_counter()
+        text = self.decode_message(message)
+        code, params = self.get_message_code(text), self.get_message_params(text)
+        self.last_seen = time.monotonic()
+        if self.trace is not None and code not in KEEPALIVE_CODES:
+            self.trace.record(code, params)
+        STATS.record_recv(
+            self.stats_code(code),
+            FrameReader.TEXT_HEADER_SIZE + len(message),
+            time.perf_counter() - start,
+        )
+        return code, params
+
+    def stats_code(self, code: str) -> str:
+        # peers can send any code, only the handled ones get their own stats
+        if code in self.handlers or code in KEEPALIVE_CODES:
+            return code
+        return UNKNOWN_CODE
+
+    def decode_message(self, message: bytes) -> str:
+        """
+        Decrypt a raw ENCODED message (without its size prefix).
+
+        :param message: The raw message bytes.
+        :return: The decrypted message string.
+        """
         payload, iv = self.get_message_params(message.decode())
         #  print(f"DECODING WITH: {iv} \n {self.crypt_manager.aes_key}")
         msg = self.crypt_manager.decrypt_data(
             base64.b64decode(payload), base64.b64decode(iv)
         ).decode()
-        print("DECODE TO: ", msg[: min(60, len(msg))])
+        if LOG_TRAFFIC:
+            print("DECODE TO: ", msg[: min(60, len(msg))])
         return msg
 
     def recv_message_plain(self):
-        size = b""
-        with self.lock:
-            while len(size) < 10:
-                size += self.sock.recv(10 - len(size))
-            size_int = int(size.decode())
-            message = b""
-            while len(message) < size_int:
-                try:
-                    message += self.sock.recv(size_int - len(message))
-                except ConnectionResetError:
-                    print("Connection reset by peer.")
-                    return ""
-                # except:
-                #     print("Socket timeout.")
-                except Exception as e:
-                    print("Error: ", e)
-                    # return ""
-                    print("Socket timeout.")
-
-            print(f"RECV>>>{size}{message[:30]}")
+        with self.recv_lock:
+            try:
+                body, _ = self.reader.read_frame(False)
+            except ConnectionResetError:
+                print("Connection reset by peer.")
+                return ""
+            message = bytes(body)
+            if LOG_TRAFFIC:
+                print(f"RECV>>>{len(message):10}{message[:30]}")
             return message
 
     def send_message(self, message: str) -> None:
@@ -232,21 +831,357 @@ class NetworkManager:
         :param message: The message string to send.
         """
         #  print("ENCRYPTING WITH: ", self.crypt_manager.aes_key)
+        if self.binary:
+            code, _, rest = message.partition("~")
+            self.send_frame(code, rest.split("~"))
+            return
+        if not self._enqueue(message.partition("~")[0], message, True):
+            self._send_text(message)
+
+    def _send_text(self, message: str) -> None:
+        start = time.perf_counter()
         arr = [
             base64.b64encode(d).decode()
             for d in self.crypt_manager.encrypt_data(message.encode())
         ]
-        if self.lock:
-            with self.lock:
-                # print("IV: ", arr[1])
-                print("Using lock.")
-                self.sock.send(
-                    self.build_message("ENCODED", arr, do_size=True).encode()
+        data = self.build_message("ENCODED", arr, do_size=True).encode()
+        STATS.record_send(
+            message.partition("~")[0], len(data), time.perf_counter() - start
+        )
+        with self.lock or nullcontext():
+            self._send_raw(data)
+        if LOG_TRAFFIC:
+            print(f"SEND>>>{message[: min(100, len(message))]}")
+
+    def send_frame(self, code: str, params: List[Field]) -> None:
+        """
+        Send a code with its fields, bytes fields go raw when binary framing
+        was negotiated and base64 encoded otherwise.
+
+        :param code: The message code.
+        :param params: The message fields.
+        """
+        if not self.binary:
+            self.send_message(
+                self.build_message(code, [as_text(param) for param in params])
+            )
+            return
+        if not self._enqueue(code, params, True):
+            self._send_binary(code, params)
+
+    def send_frame_nowait(self, code: str, params: List[Field]) -> None:
+        """
+        Like send_frame but never waits for a slow peer, for broadcasts from
+        other connections. A full state frame (COALESCE_CODES) replaces the
+        queued frames it makes stale and a peer whose queue keeps growing past
+        OUTBOUND_QUEUE_LIMIT is disconnected.
+        """
+        if not self.binary:
+            params = [as_text(param) for param in params]
+            if not self._enqueue(code, self.build_message(code, params), False):
+                self._send_text(self.build_message(code, params))
+        elif not self._enqueue(code, params, False):
+            self._send_binary(code, params)
+
+    def _send_binary(self, code: str, params: List[Field]) -> None:
+        # an empty field list is sent as one empty field, like "CODE~"
+        start = time.perf_counter()
+        plain, flags = self.compress_payload(code, pack_fields(code, params or [""]))
+        prepared = time.perf_counter() - start
+        with self.lock or nullcontext():
+            start = time.perf_counter()
+            frame = self.encrypt_frame(plain, flags)
+            encrypted = prepared + time.perf_counter() - start
+            self._send_raw(frame)
+        STATS.record_send(code, len(frame), encrypted)
+        if LOG_TRAFFIC:
+            print(f"SEND>>>{code} ({len(frame)} bytes)")
+
+    def encrypt_frame(self, plain: bytes, flags: int) -> bytes:
+        """
+        Encrypt a payload into a complete binary frame. With GCM the nonce
+        follows the send counter, so frames must be sent in the order they
+        were encrypted (send_frame holds the lock for both).
+        """
+        if not self.gcm:
+            ciphertext, iv = self.crypt_manager.encrypt_data(plain)
+            return FRAME_HEADER.pack(len(iv) + len(ciphertext), flags) + iv + ciphertext
+        size = len(plain) + self.crypt_manager.session.TAG_SIZE
+        frame = bytearray(FRAME_HEADER.size + size)
+        FRAME_HEADER.pack_into(frame, 0, size, flags)
+        self.crypt_manager.session.encrypt_into(
+            plain, memoryview(frame)[FRAME_HEADER.size :]
+        )
+        return frame
+
+    def start_writer(self) -> None:
+        """
+        From now on every send goes through a bounded queue drained by a
+        writer thread, so a stalled peer only holds up its own queue. The
+        frames are encrypted by the writer, in the order they are sent.
+        """
+        self.outbound = collections.deque()
+        self.writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self.writer_thread.start()
+
+    def stop_writer(self) -> None:
+        """
+        Let the writer send what is queued and exit.
+        """
+        with self.outbound_cond:
+            self.outbound_closed = True
+            self._wake_writer()
+
+    def _wake_writer(self) -> None:
+        # called with outbound_cond held
+        self.outbound_cond.notify_all()
+
+    def detach(self) -> dict:
+        """
+        Stop using the connection and describe its session, so a process
+        holding a copy of the socket can carry on with it (see attach).
+        Queued messages are sent first, later ones are dropped.
+
+        :return: The key, capabilities, GCM counters and unread bytes.
+        """
+        self.stop_writer()
+        if self.writer_thread is not None:
+            self.writer_thread.join()
+        self.detached = True
+        with self.recv_lock:
+            state = {
+                "key": self.crypt_manager.aes_key,
+                "caps": sorted(self.caps),
+                "pending": self.reader.pending(),
+            }
+        if self.gcm:
+            session = self.crypt_manager.session
+            state["counters"] = [session.send_counter, session.recv_counter]
+        return state
+
+    def attach(self, state: dict, is_server: bool = False) -> None:
+        """
+        Carry on with a session another process detached.
+
+        :param state: What detach returned.
+        :param is_server: Which side of the connection this is.
+        """
+        self.crypt_manager.aes_key = state["key"]
+        self.accept_caps(",".join(state["caps"]), is_server)
+        if self.gcm:
+            session = self.crypt_manager.session
+            session.send_counter, session.recv_counter = state["counters"]
+        self.reader.preload(state["pending"])
+
+    def _can_block(self) -> bool:
+        return True
+
+    def _enqueue(self, code: str, payload, block: bool) -> bool:
+        """
+        Queue a message for the writer.
+
+        :return: False if there is no writer and the caller sends it itself.
+        """
+        if self.outbound is None:
+            return False
+        with self.outbound_cond:
+            if self.outbound_closed:
+                return True
+            if code in COALESCE_CODES:
+                queued = len(self.outbound)
+                replaced = COALESCE_CODES[code]
+                self.outbound = collections.deque(
+                    item for item in self.outbound if item[0] not in replaced
                 )
-                print(f"SEND>>>{message[: min(100, len(message))]}")
+                STATS.record_coalesced(code, queued - len(self.outbound))
+            while (
+                block
+                and len(self.outbound) >= OUTBOUND_QUEUE_SIZE
+                and not self.outbound_closed
+                and self._can_block()
+            ):
+                self.outbound_cond.wait()
+            if self.outbound_closed:
+                return True
+            if len(self.outbound) >= OUTBOUND_QUEUE_LIMIT:
+                print(f"Outbound queue full, disconnecting {self.address}")
+                self.outbound_closed = True
+                self.outbound.clear()
+                self._abort()
+                return True
+            self.outbound.append((code, payload))
+            self._wake_writer()
+        return True
+
+    def _next_outbound(self):
+        """
+        Take the next queued message, None once stopped and drained.
+        """
+        with self.outbound_cond:
+            if not self.outbound:
+                return None
+            item = self.outbound.popleft()
+            # wake senders waiting for room
+            self.outbound_cond.notify_all()
+            return item
+
+    def _send_queued(self, code: str, payload) -> None:
+        if isinstance(payload, str):
+            self._send_text(payload)
         else:
-            self.sock.send(self.build_message("ENCODED", arr, do_size=True).encode())
-            print(f"SEND>>>{message[: min(100, len(message))]}")
+            self._send_binary(code, payload)
+
+    def _writer_loop(self) -> None:
+        while True:
+            with self.outbound_cond:
+                while not self.outbound and not self.outbound_closed:
+                    self.outbound_cond.wait()
+            item = self._next_outbound()
+            if item is None:
+                return
+            try:
+                self._send_queued(*item)
+            except OSError as e:
+                # includes timeouts, a frame may be half sent so drop the peer
+                print(f"Writer failed, disconnecting {self.address}: {e}")
+                with self.outbound_cond:
+                    self.outbound_closed = True
+                    self.outbound.clear()
+                    self.outbound_cond.notify_all()
+                self._abort()
+                return
+
+    def _abort(self) -> None:
+        try:
+            self.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+    def compress_payload(self, code: str, plain: bytes) -> Tuple[bytes, int]:
+        """
+        Compress a packed payload before encryption when it pays off.
+
+        :param code: The message code, used for the stats.
+        :param plain: The packed fields.
+        :return: The payload to encrypt and the frame flags.
+        """
+        if not self.compress or len(plain) < COMPRESS_THRESHOLD:
+            return plain, 0
+        compressed = zlib.compress(plain, COMPRESS_LEVEL)
+        stats = self.compression_stats.setdefault(code, [0, 0, 0])
+        stats[0] += 1
+        stats[1] += len(plain)
+        if len(compressed) >= len(plain):
+            stats[2] += len(plain)
+            return plain, 0
+        stats[2] += len(compressed)
+        return compressed, FLAG_ZLIB
+
+    def compression_ratios(self) -> Dict[str, float]:
+        """
+        :return: Compressed size / plain size per message code.
+        """
+        return {
+            code: sent / plain
+            for code, (_, plain, sent) in self.compression_stats.items()
+            if plain
+        }
+
+
+class AsyncNetworkManager(NetworkManager):
+    """
+    A NetworkManager whose socket is owned by an asyncio event loop.
+
+    Reads happen on the loop (see read_frame), while handlers may keep calling
+    send_message from executor threads; writes are handed back to the loop.
+    """
+
+    def __init__(
+        self,
+        sock: socket,
+        crypt: CryptManager,
+        handlers: Dict[str, Callable],
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        super().__init__(sock, crypt, handlers)
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+
+    def _send_raw(self, data: bytes) -> None:
+        if self.writer.is_closing():
+            raise ConnectionResetError("Writer is closed.")
+        if threading.get_ident() == self.loop_thread:
+            self.writer.write(data)
+        else:
+            self.loop.call_soon_threadsafe(self.writer.write, data)
+
+    def start_writer(self) -> None:
+        """
+        Drain the outbound queue from a task on the loop, waiting for the
+        transport to drain after every write.
+        """
+        self.outbound = collections.deque()
+        self.writer_event = asyncio.Event()
+        self.writer_task = self.loop.create_task(self._drain_outbound())
+
+    def _wake_writer(self) -> None:
+        if threading.get_ident() == self.loop_thread:
+            self.writer_event.set()
+        else:
+            self.loop.call_soon_threadsafe(self.writer_event.set)
+
+    def _can_block(self) -> bool:
+        # the loop itself drains the queue
+        return threading.get_ident() != self.loop_thread
+
+    def _abort(self) -> None:
+        if threading.get_ident() == self.loop_thread:
+            self.writer.transport.abort()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+    async def _drain_outbound(self) -> None:
+        try:
+            while True:
+                await self.writer_event.wait()
+                self.writer_event.clear()
+                while (item := self._next_outbound()) is not None:
+                    self._send_queued(*item)
+                    await self.writer.drain()
+                with self.outbound_cond:
+                    if self.outbound_closed and not self.outbound:
+                        return
+        except (ConnectionError, OSError) as e:
+            print(f"Writer failed for {self.address}: {e}")
+            with self.outbound_cond:
+                self.outbound_closed = True
+                self.outbound.clear()
+                self.outbound_cond.notify_all()
+
+    async def read_plain(self) -> bytes:
+        """
+        Read one size prefixed text frame from the stream.
+
+        :return: The frame bytes without the size prefix.
+        """
+        size = await self.reader.readexactly(10)
+        return await self.reader.readexactly(int(size.decode()))
+
+    async def read_frame(self) -> Tuple[str, List[Field]]:
+        """
+        Read and decode one message from the stream.
+
+        :return: The message code and its fields.
+        """
+        if not self.binary:
+            return self.decode_text(await self.read_plain())
+        size, flags = FRAME_HEADER.unpack(
+            await self.reader.readexactly(FRAME_HEADER.size)
+        )
+        return self.decode_frame(await self.reader.readexactly(size), flags)
 
 
 import base64
@@ -279,7 +1214,7 @@ def mock_sock():
             + base64.b64encode(b"mockiv"),
         ]
     )
-    sock.send = MagicMock()
+    sock.sendall = MagicMock()
     return sock
 
 
@@ -314,11 +1249,27 @@ def test_get_message_code_and_params(net_mgr):
 
 def test_send_message_encodes_correctly(net_mgr, mock_sock):
     net_mgr.send_message("hello world")
-    args = mock_sock.send.call_args[0][0]
+    args = mock_sock.sendall.call_args[0][0]
     assert isinstance(args, bytes)
     assert b"ENCODED" in args
 
 
+def test_dispatch_exit_and_unhandled(net_mgr):
+    assert net_mgr.dispatch("EXIT~") is True
+    assert net_mgr.dispatch("NOPE~a") is True
+
+
+def test_dispatch_passes_args_and_params(net_mgr):
+    called = {}
+
+    def mock_handler(db, p1, p2, net=None):
+        called["args"] = (db, p1, p2, net)
+
+    net_mgr.add_handler("TEST", mock_handler)
+    assert net_mgr.dispatch("TEST~a~b", "db") is False
+    assert called["args"] == ("db", "a", "b", net_mgr)
+
+
 def test_recv_message_decodes_correctly(net_mgr):
     # We will override recv_message_plain to return a known encoded message
     encoded = net_mgr.build_message(
@@ -335,6 +1286,399 @@ def test_recv_message_decodes_correctly(net_mgr):
     assert result == "hello world"
 
 
+def test_pack_unpack_fields_roundtrip():
+    packed = pack_fields("CODE", ["text~with~tildes", b"\x00raw\xff", ""])
+    assert unpack_fields(packed) == ("CODE", ["text~with~tildes", b"\x00raw\xff", ""])
+
+
+def test_as_bytes_and_as_text():
+    assert as_bytes(b"raw") == b"raw"
+    assert as_bytes(base64.b64encode(b"raw").decode()) == b"raw"
+    assert as_text(b"raw") == base64.b64encode(b"raw").decode()
+    assert as_text("plain") == "plain"
+
+
+def test_accept_caps_ignores_unknown(net_mgr):
+    assert net_mgr.accept_caps("BIN,SOMETHINGNEW") == "BIN"
+    assert net_mgr.binary
+    assert net_mgr.accept_caps("") == ""
+    assert not net_mgr.binary
+
+
+def test_send_frame_text_mode_base64s_bytes(net_mgr, mock_sock):
+    sent = []
+    net_mgr.send_message = sent.append
+    net_mgr.send_frame("CHUNK", ["name", b"data"])
+    assert sent == ["CHUNK~name~" + base64.b64encode(b"data").decode()]
+
+
+@pytest.fixture
+def binary_pair():
+    import socket as socket_module
+
+    from cryptManager import CryptManager
+
+    left, right = socket_module.socketpair()
+    key = CryptManager(rsa_key=2)
+    key.generate_aes_key()
+    other = CryptManager(rsa_key=2)
+    other.aes_key = key.aes_key
+    a, b = NetworkManager(left, key, {}), NetworkManager(right, other, {})
+    a.accept_caps(CAP_BINARY)
+    b.accept_caps(CAP_BINARY)
+    yield a, b
+    left.close()
+    right.close()
+
+
+def test_binary_frame_roundtrip(binary_pair):
+    a, b = binary_pair
+    a.send_frame("TAKESUMMARY", [b"\x00" * 5000, "meta"])
+    assert b.recv_frame() == ("TAKESUMMARY", [b"\x00" * 5000, "meta"])
+
+
+def test_binary_send_message_keeps_text_semantics(binary_pair):
+    a, b = binary_pair
+    a.send_message(a.build_message("SAVE_SUCCESS", [""]))
+    a.send_message(a.build_message("LOGIN", ["user", "pass"]))
+    a.send_frame("GETEVENTS", [])
+    assert b.recv_frame() == ("SAVE_SUCCESS", [""])
+    assert b.recv_message() == "LOGIN~user~pass"
+    assert b.recv_frame() == ("GETEVENTS", [""])
+
+
+def test_frame_reader_splits_coalesced_frames():
+    import socket as socket_module
+
+    left, right = socket_module.socketpair()
+    left.sendall(b"         3abc         2de" + b"         4f")
+    reader = FrameReader(right, size=64)
+    assert bytes(reader.read_frame(False)[0]) == b"abc"
+    assert reader.has_frame(False)
+    assert bytes(reader.read_frame(False)[0]) == b"de"
+    assert not reader.has_frame(False)
+    left.sendall(b"ghi")
+    assert bytes(reader.read_frame(False)[0]) == b"fghi"
+    left.close()
+    right.close()
+
+
+def test_frame_reader_keeps_partial_frame_on_timeout():
+    import socket as socket_module
+
+    left, right = socket_module.socketpair()
+    right.settimeout(0.05)
+    reader = FrameReader(right)
+    left.sendall(FRAME_HEADER.pack(6, 1) + b"abc")
+    with pytest.raises(socket_module.timeout):
+        reader.read_frame(True)
+    left.sendall(b"def")
+    body, flags = reader.read_frame(True)
+    assert (bytes(body), flags) == (b"abcdef", 1)
+    left.close()
+    right.close()
+
+
+def test_frame_reader_reads_a_large_frame_in_place():
+    """An 8MB frame: the buffer grows once and the body is a view into it."""
+    import socket as socket_module
+
+    payload = os.urandom(8 * 1024 * 1024)
+    frame = f"{len(payload):10}".encode() + payload
+    left, right = socket_module.socketpair()
+    writer = threading.Thread(target=left.sendall, args=(frame,))
+    writer.start()
+    reader = FrameReader(right)
+    body, _ = reader.read_frame(False)
+    writer.join()
+    assert body == payload
+    # no copy per recv as with +=, and none when handing the body out
+    assert len(reader.buffer) == len(frame)
+    assert body.obj is reader.buffer
+    left.close()
+    right.close()
+
+
+def test_frame_reader_benchmark_against_concat_reader():
+    """Reads an 8MB frame with the old += loop and with FrameReader."""
+    import socket as socket_module
+
+    payload = os.urandom(8 * 1024 * 1024)
+
+    def concat_reader(sock):
+        size = b""
+        while len(size) < 10:
+            size += sock.recv(10 - len(size))
+        size_int = int(size.decode())
+        message = b""
+        while len(message) < size_int:
+            message += sock.recv(size_int - len(message))
+        return message
+
+    def timed(read):
+        left, right = socket_module.socketpair()
+        writer = threading.Thread(
+            target=left.sendall, args=(f"{len(payload):10}".encode() + payload,)
+        )
+        writer.start()
+        start = time.perf_counter()
+        result = read(right)
+        duration = time.perf_counter() - start
+        writer.join()
+        left.close()
+        right.close()
+        assert result == payload
+        return duration
+
+    old = timed(concat_reader)
+    new = timed(lambda sock: bytes(FrameReader(sock).read_frame(False)[0]))
+    # only printed, the times depend on the machine and its load
+    print(f"\n  concat reader: {old:.4f}s, FrameReader: {new:.4f}s")
+
+
+def test_compression_roundtrip_and_stats(binary_pair):
+    a, b = binary_pair
+    a.accept_caps("BIN,ZLIB")
+    b.accept_caps("BIN,ZLIB")
+    doc = ("lorem ipsum dolor sit amet " * 500).encode()
+    a.send_frame("TAKEUPDATE", [doc])
+    a.send_frame("INFO", ["short"])
+    assert b.recv_frame() == ("TAKEUPDATE", [doc])
+    assert b.recv_frame() == ("INFO", ["short"])
+    assert list(a.compression_stats) == ["TAKEUPDATE"]
+    assert a.compression_ratios()["TAKEUPDATE"] < 0.1
+
+
+def test_incompressible_payload_is_sent_plain(binary_pair):
+    a, b = binary_pair
+    a.accept_caps("BIN,ZLIB")
+    b.accept_caps("BIN,ZLIB")
+    noise = os.urandom(4096)
+    assert a.compress_payload("CHUNK", noise) == (noise, 0)
+    a.send_frame("CHUNK", ["name", noise])
+    assert b.recv_frame() == ("CHUNK", ["name", noise])
+
+
+def test_gcm_session_frames(binary_pair):
+    a, b = binary_pair
+    a.accept_caps("BIN,ZLIB,GCM", is_server=True)
+    b.accept_caps("BIN,ZLIB,GCM")
+    doc = ("lorem ipsum dolor sit amet " * 500).encode()
+    for i in range(3):
+        a.send_frame("TAKEUPDATE", [doc, str(i)])
+        b.send_frame("UPDATEDOC", [str(i)])
+    for i in range(3):
+        assert b.recv_frame() == ("TAKEUPDATE", [doc, str(i)])
+        assert a.recv_frame() == ("UPDATEDOC", [str(i)])
+
+
+def test_gcm_frame_is_smaller_than_cbc(binary_pair):
+    a, _ = binary_pair
+    cbc = a.encrypt_frame(b"x" * 100, 0)
+    a.accept_caps("BIN,GCM", is_server=True)
+    assert len(a.encrypt_frame(b"x" * 100, 0)) < len(cbc)
+
+
+def test_stats_count_frames_and_handler_errors(binary_pair):
+    a, b = binary_pair
+    b.handlers = {"LOGIN": lambda *params, net: True}
+    STATS.reset()
+    a.send_frame("LOGIN", ["user", "pass"])
+    a.send_frame("BOGUS", [])
+    assert b.dispatch_frame(*b.recv_frame()) is False
+    assert b.dispatch_frame(*b.recv_frame()) is True
+    login = STATS.per_code["LOGIN"]
+    assert (login.sent, login.received, login.errors) == (1, 1, 1)
+    assert login.bytes_out == login.bytes_in > 0
+    assert login.handler.count == login.decrypt.count == 1
+    assert STATS.per_code[UNKNOWN_CODE].received == 1
+    assert STATS.per_code[UNKNOWN_CODE].errors == 1
+
+
+def test_outbound_queue_coalesces_full_state_updates(binary_pair):
+    a, b = binary_pair
+    a.outbound = collections.deque()  # queue without a writer yet
+    a.send_frame_nowait("TAKEUPDATE", [b"5"])
+    a.send_frame_nowait("TAKEDELTA", [b"5-7"])
+    a.send_frame("INFO", ["saved"])
+    a.send_frame_nowait("TAKEUPDATE", [b"9"])
+    # a delta after the full update is based on it and stays
+    a.send_frame_nowait("TAKEDELTA", [b"9-10"])
+    assert [code for code, _ in a.outbound] == ["INFO", "TAKEUPDATE", "TAKEDELTA"]
+    threading.Thread(target=a._writer_loop, daemon=True).start()
+    assert b.recv_frame() == ("INFO", ["saved"])
+    assert b.recv_frame() == ("TAKEUPDATE", [b"9"])
+    assert b.recv_frame() == ("TAKEDELTA", [b"9-10"])
+    a.stop_writer()
+
+
+def test_batch_drops_deltas_a_full_update_replaces():
+    batch = [
+        ("TAKEUPDATE", ["5"]),
+        ("TAKEDELTA", ["5-7"]),
+        ("INFO", ["between"]),
+        ("TAKEUPDATE", ["9"]),
+        ("TAKEDELTA", ["9-10"]),
+    ]
+    assert coalesce_batch(batch) == [
+        ("INFO", ["between"]),
+        ("TAKEUPDATE", ["9"]),
+        ("TAKEDELTA", ["9-10"]),
+    ]
+
+
+def test_outbound_queue_disconnects_laggard(binary_pair, monkeypatch):
+    a, b = binary_pair
+    monkeypatch.setitem(globals(), "OUTBOUND_QUEUE_LIMIT", 4)
+    a.outbound = collections.deque()
+    for i in range(5):
+        a.send_frame_nowait("INFO", [str(i)])
+    assert a.outbound_closed and not a.outbound
+    b.sock.settimeout(1)
+    assert b.sock.recv(1) == b""
+
+
+def test_zlib_needs_binary_framing(net_mgr):
+    net_mgr.accept_caps("ZLIB")
+    assert not net_mgr.compress
+
+
+def _serve_upload(net, stored: bytearray, ack_chunks=True):
+    # minimal server side of the upload stream, acks as the server does
+    code, (name, size, identity) = net.recv_frame()
+    assert code == "UPLOAD" and identity.isdigit()
+    net.send_frame("UACK", [name, str(len(stored))])
+    while True:
+        code, params = net.recv_frame()
+        if code == "END":
+            return
+        stored += as_bytes(params[2])
+        if ack_chunks:
+            net.send_frame("UACK", [name, str(len(stored))])
+
+
+def _receive_acks(net):
+    try:
+        while True:
+            code, params = net.recv_frame()
+            if code == "UACK":
+                net.upload_acked(*params)
+            elif code == "UFAIL":
+                net.upload_failed(*params)
+    except (OSError, ValueError):
+        return
+
+
+def test_streamed_upload_resumes_at_server_offset(binary_pair, tmp_path):
+    a, b = binary_pair
+    a.accept_caps("BIN,UPLOAD")
+    b.accept_caps("BIN,UPLOAD")
+    data = os.urandom(100_000)
+    (tmp_path / "scan.png").write_bytes(data)
+    stored = bytearray(data[:30_000])  # left from an interrupted upload
+    server = threading.Thread(target=_serve_upload, args=(b, stored))
+    server.start()
+    threading.Thread(target=_receive_acks, args=(a,), daemon=True).start()
+    a.send_file(str(tmp_path / "scan.png"), chunk_size=8192, window=4)
+    server.join(5)
+    assert bytes(stored) == data
+
+
+def test_streamed_upload_stops_at_full_window(binary_pair, tmp_path, monkeypatch):
+    a, b = binary_pair
+    a.accept_caps("BIN,UPLOAD")
+    b.accept_caps("BIN,UPLOAD")
+    monkeypatch.setitem(globals(), "UPLOAD_ACK_TIMEOUT", 0.5)
+    (tmp_path / "scan.png").write_bytes(os.urandom(100_000))
+    stored = bytearray()
+    server = threading.Thread(
+        target=_serve_upload, args=(b, stored, False), daemon=True
+    )
+    server.start()
+    threading.Thread(target=_receive_acks, args=(a,), daemon=True).start()
+    with pytest.raises(TimeoutError):
+        a.send_file(str(tmp_path / "scan.png"), chunk_size=8192, window=4)
+    assert len(stored) == 4 * 8192
+
+
+def test_refused_upload_fails_without_waiting(binary_pair, tmp_path):
+    a, b = binary_pair
+    a.accept_caps("BIN,UPLOAD")
+    b.accept_caps("BIN,UPLOAD")
+    (tmp_path / "scan.png").write_bytes(os.urandom(100_000))
+
+    def refuse():
+        code, (name, *_) = b.recv_frame()
+        b.send_frame("UACK", [name, "0"])
+        b.recv_frame()
+        b.send_frame("UFAIL", [name, "BAD UPLOAD OFFSET"])
+
+    threading.Thread(target=refuse, daemon=True).start()
+    threading.Thread(target=_receive_acks, args=(a,), daemon=True).start()
+    start = time.monotonic()
+    with pytest.raises(UploadFailed):
+        a.send_file(str(tmp_path / "scan.png"), chunk_size=8192, window=1)
+    assert time.monotonic() - start < UPLOAD_ACK_TIMEOUT / 2
+
+
+def test_keepalive_is_answered_below_the_handlers(binary_pair):
+    a, b = binary_pair
+    b.handlers = {"INFO": lambda *params, net: None}
+    b.last_seen = 0
+    a.send_frame("PING", ["42"])
+    a.send_frame("INFO", ["saved"])
+    # recv_frame answers the PING and returns the next real message
+    assert b.recv_frame() == ("INFO", ["saved"])
+    assert b.last_seen > 0
+    assert a._read_frame() == ("PONG", ["42"])
+    a.send_frame("PING", ["43"])
+    assert b.dispatch_frame(*b._read_frame()) is False
+    assert a._read_frame() == ("PONG", ["43"])
+
+
+def test_recv_batch_waits_and_reads_what_came_together(binary_pair):
+    a, b = binary_pair
+    assert b.recv_batch(0) == []
+    b.sock.settimeout(None)
+    threading.Timer(0.1, a.send_frame, ("INFO", ["late"])).start()
+    start = time.monotonic()
+    assert b.recv_batch(5) == [("INFO", ["late"])]
+    assert time.monotonic() - start < 1
+    for content in ("one", "two"):
+        a.send_frame("TAKEUPDATE", [content])
+    a.send_frame("PING", ["1"])
+    a.send_frame("INFO", ["after"])
+    time.sleep(0.05)
+    batch = b.recv_batch()
+    assert [code for code, _ in batch] == ["TAKEUPDATE", "TAKEUPDATE", "INFO"]
+    assert coalesce_batch(batch) == [("TAKEUPDATE", ["two"]), ("INFO", ["after"])]
+    assert a._read_frame() == ("PONG", ["1"])
+
+
+def test_detached_session_carries_on_in_another_manager(binary_pair):
+    a, b = binary_pair
+    a.accept_caps("BIN,GCM,PING", is_server=True)
+    b.accept_caps("BIN,GCM,PING")
+    b.start_writer()
+    a.send_frame("GETSUMMARY", ["7"])
+    a.send_frame("UPDATEDOC", ["{}"])
+    # one read took in both frames, the second one moves with the session
+    assert b.recv_frame() == ("GETSUMMARY", ["7"])
+    assert b.reader.has_frame(True)
+    b.send_frame("INFO", ["queued"])
+    state = b.detach()
+    b.send_frame("INFO", ["dropped"])
+
+    from cryptManager import CryptManager
+
+    moved = NetworkManager(b.sock, CryptManager(rsa_key=2), {})
+    moved.attach(state)
+    assert moved.recv_frame() == ("UPDATEDOC", ["{}"])
+    moved.send_frame("INFO", ["moved"])
+    assert a.recv_frame() == ("INFO", ["queued"])
+    assert a.recv_frame() == ("INFO", ["moved"])
+
+
 def test_add_handler_and_call(net_mgr):
     called = {}
 
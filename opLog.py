@@ -0,0 +1,473 @@
+"""
+Revision numbered log of the ops applied to a summary, for operational
+transform. Every applied op gets the next revision. Clients tag an UPDATEDOC
+with the revision their text was at, so a change only has to be transformed
+against the ops applied since then, found by index in the log.
+
+Ops are the UPDATEDOC change dicts: {"cord": [start, end], "type": INSERT,
+DELETE or UPDATE, "cont": text}, positions refer to the text before the op.
+Op lists are applied in order, each to the text the one before left.
+
+A client keeps one UPDATEDOC in flight, see ClientSync: what it types
+meanwhile waits until the server's ops acknowledge it, so every UPDATEDOC
+is based on a revision that has all of the author's earlier ops.
+"""
+
+import zlib
+from typing import List, Optional, Tuple
+
+# ops kept per summary, a change based on an older revision is refused
+MAX_OPS = 1000
+
+
+def _shift(pos: int, start: int, end: int) -> int:
+    """Where a position ends up once [start, end) is deleted."""
+    if pos <= start:
+        return pos
+    if pos <= end:
+        return start
+    return pos - (end - start)
+
+
+def _against_insert(op: dict, at: int, length: int, first: bool) -> List[dict]:
+    start, end = op["cord"]
+    if op["type"] == "INSERT":
+        # on a tie the insert that came first stays in front
+        if at < start or (at == start and first):
+            return [dict(op, cord=[start + length, end + length])]
+        return [op]
+    if at <= start:
+        return [dict(op, cord=[start + length, end + length])]
+    if at < end:
+        # text was typed inside the range, keep it and cut the range in two,
+        # the later part first so the positions of the other stay right
+        return [
+            {"cord": [at + length, end + length], "type": "DELETE", "cont": ""},
+            dict(op, cord=[start, at]),
+        ]
+    return [op]
+
+
+def _against_delete(op: dict, start: int, end: int) -> List[dict]:
+    op_start, op_end = op["cord"]
+    new_start, new_end = _shift(op_start, start, end), _shift(op_end, start, end)
+    if op["type"] == "INSERT":
+        return [dict(op, cord=[new_start, new_start])]
+    if new_start == new_end and op["type"] == "DELETE":
+        # someone else deleted all of it already
+        return []
+    return [dict(op, cord=[new_start, new_end])]
+
+
+def transform(op: dict, applied: dict, first: bool = True) -> List[dict]:
+    """
+    Rewrite an op made without knowing about an applied one so it can be
+    applied after it.
+
+    :param first: If the applied op came first, it wins ties.
+    :return: The ops to apply instead, in order: none if nothing is left
+        of it, two if the applied op landed inside its range.
+    """
+    start, end = applied["cord"]
+    length = len(applied.get("cont", ""))
+    if applied["type"] == "INSERT":
+        return _against_insert(op, start, length, first)
+    ops = _against_delete(op, start, end)
+    if applied["type"] == "UPDATE" and length:
+        ops = [
+            part
+            for rest in ops
+            for part in _against_insert(rest, start, length, first)
+        ]
+    return ops
+
+
+def _split_updates(ops: List[dict]) -> List[dict]:
+    """An UPDATE as a DELETE and an INSERT, those transform consistently."""
+    result = []
+    for op in ops:
+        if op["type"] == "UPDATE":
+            start, end = op["cord"]
+            result.append({"cord": [start, end], "type": "DELETE", "cont": ""})
+            op = {"cord": [start, start], "type": "INSERT", "cont": op["cont"]}
+        result.append(op)
+    return result
+
+
+def transform_ops(
+    ops: List[dict], applied: List[dict]
+) -> Tuple[List[dict], List[dict]]:
+    """
+    Transform two op lists made on the same text against each other, so
+    either order of applying them ends with the same text.
+
+    :return: ops rewritten to apply after applied, and applied rewritten to
+        apply after ops.
+    """
+    ops, applied = _split_updates(ops), _split_updates(applied)
+    result = []
+    for op in ops:
+        parts, moved = [op], []
+        # op moves along applied, each applied op moves past what op became
+        for other in applied:
+            if len(parts) == 1:
+                part = parts[0]
+                parts, others = transform(part, other), transform(other, part, False)
+            else:
+                parts, others = transform_ops(parts, [other])
+            moved += others
+        result += parts
+        applied = moved
+    return result, applied
+
+
+def sequential(changes: List[dict]) -> List[dict]:
+    """
+    Order the changes of one UPDATEDOC, which all refer to the same text,
+    so they can be applied one after the other: from the end, so the
+    positions of the others stay valid, and a delete before an insert at
+    the same place so it keeps the new text.
+    """
+    return sorted(
+        changes,
+        key=lambda op: (op["cord"][0], op["type"] != "INSERT"),
+        reverse=True,
+    )
+
+
+def _kind(start: int, end: int, content: str) -> Optional[str]:
+    if start == end:
+        return "INSERT" if content else None
+    return "UPDATE" if content else "DELETE"
+
+
+def compose(ops: List[dict]) -> List[dict]:
+    """
+    Fold an op list into fewer ops with the same result. An op touching the
+    text the op before it wrote (typing on, backspacing, deleting what was
+    just typed) becomes part of it, so a run of keystrokes at one place is
+    a single op and an insert deleted again is none.
+    """
+    result: List[dict] = []
+    for op in ops:
+        start, end = op["cord"]
+        content = op.get("cont", "")
+        if result:
+            last = result[-1]
+            last_start, last_end = last["cord"]
+            written = last.get("cont", "")
+            if start <= last_start + len(written) and end >= last_start:
+                # one replace of the text before last: what op keeps of
+                # last's text around its own, over both ranges
+                content = (
+                    written[: max(0, start - last_start)]
+                    + content
+                    + written[max(0, end - last_start) :]
+                )
+                end = last_end + max(0, end - last_start - len(written))
+                start = min(start, last_start)
+                result.pop()
+        kind = _kind(start, end, content)
+        if kind is not None:
+            result.append({"cord": [start, end], "type": kind, "cont": content})
+    return result
+
+
+class OpLog:
+    """
+    The last MAX_OPS ops applied to a summary, indexed by revision.
+    """
+
+    def __init__(self, limit: int = MAX_OPS) -> None:
+        self.limit = limit
+        self.revision = 0
+        # ops[i] has revision base + i + 1
+        self.ops: List[dict] = []
+        self.base = 0
+
+    def append(self, op: dict) -> int:
+        """Log an applied op, it gets the next revision."""
+        self.revision += 1
+        op["rev"] = self.revision
+        self.ops.append(op)
+        if len(self.ops) > 2 * self.limit:
+            # trimmed in chunks so appending stays O(1) on average
+            drop = len(self.ops) - self.limit
+            del self.ops[:drop]
+            self.base += drop
+        return self.revision
+
+    def since(self, revision: int) -> Optional[List[dict]]:
+        """The ops applied after revision, None if they are not kept."""
+        if revision < self.base:
+            return None
+        return self.ops[min(revision, self.revision) - self.base :]
+
+    def recent(self, count: int) -> List[dict]:
+        return self.ops[-count:]
+
+    def rebase(self, ops: List[dict], revision: int, author) -> Optional[List[dict]]:
+        """
+        Transform ops made on the text at revision against what other
+        authors applied since. A client following ClientSync has none of
+        its own ops after revision, any there were already in its text.
+
+        :param ops: Ops to apply in order, see sequential.
+        :return: The ops to apply in order, None if revision is too old.
+        """
+        concurrent = self.since(revision)
+        if concurrent is None:
+            return None
+        others = [op for op in concurrent if op.get("user_id") != author]
+        return compose(transform_ops(ops, others)[0]) if others else ops
+
+
+def apply_ops(text: str, ops: List[dict]) -> str:
+    """Apply ops to a str one after the other, for the clients' copy."""
+    for op in ops:
+        start, end = op["cord"]
+        if op["type"] == "INSERT":
+            end = start
+        text = text[:start] + op.get("cont", "") + text[end:]
+    return text
+
+
+class ClientSync:
+    """
+    A client's side of the sync. The ops it sent and waits for (in flight)
+    and the ones made since (buffer) are both on top of the server's text
+    at revision. Ops of others in a TAKEDELTA are transformed past them
+    before they reach the editor, and the ones in flight and the buffer
+    past the others. The server marks the client's own ops in a delta
+    ("own"), those are the ones in flight as it applied them, and "ack"s
+    the UPDATEDOC, even if nothing of it was left to apply.
+    """
+
+    def __init__(self, text: str = "", revision: Optional[int] = None) -> None:
+        self.reset(text, revision)
+
+    def reset(self, text: str, revision: Optional[int]) -> None:
+        """The server sent the whole text, whatever was not sent is gone."""
+        self.server_text = text
+        self.revision = revision
+        self.inflight: Optional[List[dict]] = None
+        self.buffer: List[dict] = []
+
+    def local(self, ops: List[dict]) -> None:
+        """Ops made in the editor, in order."""
+        self.buffer += ops
+
+    def flush(self) -> Optional[List[dict]]:
+        """The ops to send now, None while others are in flight."""
+        if self.inflight is not None:
+            return None
+        ops, self.buffer = compose(self.buffer), []
+        if not ops:
+            return None
+        self.inflight = ops
+        return ops
+
+    def receive(self, delta: dict) -> Optional[List[dict]]:
+        """
+        Take a TAKEDELTA.
+
+        :return: The ops to apply to the editor, None if the delta does not
+            follow revision or the copy drifted, the whole text has to be
+            asked for again.
+        """
+        if self.revision is None or delta["base"] != self.revision:
+            return None
+        text = self.server_text
+        inflight, buffer = self.inflight, self.buffer
+        editor_ops: List[dict] = []
+        for op in delta["ops"]:
+            text = apply_ops(text, [op])
+            if op.get("own") and inflight is not None:
+                # what is in flight as the server applied it, shown already
+                inflight = []
+                continue
+            others = [op]
+            if inflight:
+                inflight, others = transform_ops(inflight, others)
+            if buffer:
+                buffer, others = transform_ops(buffer, others)
+            editor_ops += others
+        if len(text) != delta["length"]:
+            return None
+        if "checksum" in delta and checksum(text) != delta["checksum"]:
+            return None
+        self.server_text, self.revision = text, delta["revision"]
+        self.inflight = None if delta.get("ack") else inflight
+        self.buffer = buffer
+        return editor_ops
+
+
+def checksum(text: str) -> int:
+    """What a TAKEDELTA carries now and then to check a client's copy."""
+    return zlib.crc32(text.encode())
+
+
+def _insert(pos, text):
+    return {"cord": [pos, pos], "type": "INSERT", "cont": text}
+
+
+def _delete(start, end):
+    return {"cord": [start, end], "type": "DELETE", "cont": ""}
+
+
+def test_concurrent_edits_keep_both_intents():
+    base = "hello world"
+    log = OpLog()
+    text = base
+    # alice types at the end and bob fixes the start, both on revision 0
+    for author, ops in (
+        ("alice", [_insert(11, "!")]),
+        ("bob", [_insert(0, "HELLO"), _delete(0, 5)]),
+    ):
+        for op in log.rebase(sequential(ops), 0, author):
+            text = apply_ops(text, [op])
+            log.append(dict(op, user_id=author))
+    assert text == "HELLO world!"
+    # bob's delete and insert came back as one UPDATE
+    assert log.revision == 2
+
+
+def test_delete_around_concurrent_insert_keeps_the_insert():
+    log = OpLog()
+    log.append(dict(_insert(3, "XY"), user_id="alice"))
+    text = "abcXYdefg"
+    for op in log.rebase([_delete(1, 6)], 0, "bob"):
+        text = apply_ops(text, [op])
+    assert text == "aXYg"
+    # a delete of what is already gone is dropped
+    log.append(dict(_delete(0, 4), user_id="alice"))
+    assert log.rebase([_delete(1, 2)], 1, "bob") == []
+
+
+def test_rebase_keeps_the_order_of_an_op_list():
+    log = OpLog()
+    log.append(dict(_insert(10, "A"), user_id="alice"))
+    # bob typed Y at 2, then X before the 9, which is at 10 after the Y
+    ops = log.rebase([_insert(2, "Y"), _insert(10, "X")], 0, "bob")
+    assert apply_ops("0123456789Acdef", ops) == "01Y2345678X9Acdef"
+
+
+def test_compose_folds_keystrokes():
+    text = "hello world"
+    typing = [_insert(5 + index, char) for index, char in enumerate(" big")]
+    assert compose(typing) == [_insert(5, " big")]
+    # typed, one backspace, typed on, then all of it backspaced away
+    ops = typing + [_delete(8, 9), _insert(8, "g!")]
+    assert compose(ops) == [_insert(5, " big!")]
+    ops += [_delete(9 - index, 10 - index) for index in range(5)]
+    assert compose(ops) == []
+    # backspacing into the text before becomes one delete
+    ops = [_delete(4, 5), _delete(3, 4), _delete(2, 3), _insert(2, "LP")]
+    assert compose(ops) == [{"cord": [2, 5], "type": "UPDATE", "cont": "LP"}]
+    for ops in (typing, ops):
+        assert apply_ops(text, compose(ops)) == apply_ops(text, ops)
+
+
+def test_log_is_bounded_and_refuses_old_revisions():
+    log = OpLog(limit=10)
+    for index in range(35):
+        log.append(dict(_insert(index, "x"), user_id="alice"))
+    assert log.revision == 35 and len(log.ops) <= 20
+    assert [op["rev"] for op in log.since(30)] == [31, 32, 33, 34, 35]
+    assert log.since(3) is None
+    assert log.rebase([_insert(0, "y")], 3, "bob") is None
+    assert log.since(40) == []
+
+
+def test_transform_ops_converges():
+    import random
+
+    rng = random.Random(9)
+
+    def edits(text):
+        ops = []
+        for _ in range(4):
+            start = rng.randint(0, len(text))
+            end = rng.randint(start, min(len(text), start + 3))
+            kind = rng.choice(["INSERT", "DELETE", "UPDATE"])
+            content = "" if kind == "DELETE" else rng.choice(["X", "YZ", "XYZ"])
+            op = {"cord": [start, start if kind == "INSERT" else end], "type": kind}
+            ops.append(dict(op, cont=content))
+            text = apply_ops(text, ops[-1:])
+        return ops
+
+    for _ in range(2000):
+        text = "".join(rng.choice("abcde") for _ in range(rng.randint(0, 15)))
+        first, second = edits(text), edits(text)
+        second_after, first_after = transform_ops(second, first)
+        assert apply_ops(apply_ops(text, first), second_after) == apply_ops(
+            apply_ops(text, second), first_after
+        )
+
+
+def test_clients_keep_one_update_in_flight():
+    log, text = OpLog(), "abcdef"
+    clients = {name: ClientSync(text, 0) for name in ("alice", "bob")}
+    editors = dict.fromkeys(clients, text)
+    sent = {}
+
+    def edit(name, ops):
+        editors[name] = apply_ops(editors[name], ops)
+        clients[name].local(ops)
+        ops = clients[name].flush()
+        if ops is not None:
+            sent[name] = (ops, clients[name].revision)
+
+    def serve(name):
+        nonlocal text
+        ops, base = sent.pop(name)
+        for op in log.rebase(ops, base, name):
+            text = apply_ops(text, [op])
+            log.append(dict(op, user_id=name))
+
+    def deliver(name, ack):
+        client = clients[name]
+        ops = [dict(op, own=op["user_id"] == name) for op in log.since(client.revision)]
+        delta = {"base": client.revision, "ops": ops, "length": len(text)}
+        editor_ops = client.receive(dict(delta, revision=log.revision, ack=ack))
+        editors[name] = apply_ops(editors[name], editor_ops)
+
+    edit("bob", [_insert(2, "X")])
+    serve("bob")
+    edit("alice", [_delete(0, 3)])
+    serve("alice")
+    # typed while the delete is in flight, it waits for the echo
+    edit("alice", [_insert(1, "Z")])
+    assert "alice" not in sent
+    deliver("alice", ack=True)
+    assert editors["alice"] == "XdZef"
+    edit("alice", [])
+    serve("alice")
+    deliver("alice", ack=True)
+    deliver("bob", ack=True)
+    assert text == editors["alice"] == editors["bob"] == "XdZef"
+    # a copy that does not match the checksum asks for the whole text
+    delta = {"base": log.revision, "ops": [], "length": len(text)}
+    assert clients["bob"].receive(dict(delta, checksum=checksum(text) + 1)) is None
+    assert clients["bob"].receive(dict(delta, revision=log.revision)) == []
+
+
+def test_buffered_edits_survive_a_paste_bigger_than_the_text():
+    log, text = OpLog(), "hi"
+    bob = ClientSync(text, 0)
+    editor = text
+    # bob's first edit is in flight, the second waits behind it
+    for op in (_insert(2, "!"), _insert(0, ">")):
+        editor = apply_ops(editor, [op])
+        bob.local([op])
+        bob.flush()
+    assert bob.inflight == [_insert(2, "!")] and bob.buffer == [_insert(0, ">")]
+    # alice pastes far more than the summary holds, it still comes as ops
+    paste = _insert(0, "pasted " * 2000)
+    text = apply_ops(text, [paste])
+    log.append(dict(paste, user_id="alice"))
+    delta = {"base": 0, "ops": log.since(0), "length": len(text)}
+    editor = apply_ops(editor, bob.receive(dict(delta, revision=log.revision)))
+    # the paste was applied first, it stays in front at the same place
+    assert editor == "pasted " * 2000 + ">hi!"
+    assert bob.inflight and bob.buffer
@@ -0,0 +1,407 @@
+"""
+Replay session traces recorded with TRACE_DIR (see traceManager.py) against
+a server running in this process, to reproduce and profile a production
+command mix offline.
+
+    python replayTrace.py /srv/traces/*.trace.gz --db-dir /tmp/srv
+    python replayTrace.py traces/ --db-dir /tmp/srv --speed 0 --profile out.prof
+
+Every traced session gets its own connection, sessions start and send at
+their recorded offsets divided by --speed, 0 sends as fast as possible.
+Recorded users are registered again under replay names (passwords are not
+traced) and every summary a trace opens is stood in for by a new empty
+summary, so any sqlite dbconved.db will do. Handler times per code come
+from the server's own STATS.
+"""
+
+import argparse
+import cProfile
+import glob
+import os
+import pstats
+import socket
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import client
+import networkManager
+import traceManager
+from statsManager import STATS
+
+# codes the replay sends itself before a session's records
+LOGIN_CODES = {"LOGIN", "REGISTER"}
+# code -> index of the field holding a summary id
+SUMMARY_ID_FIELDS = {"GETSUMMARY": 0}
+# code -> index of the field holding a username
+USERNAME_FIELDS = {"SHARESUMMARY": 0}
+REPLAY_PASSWORD = "replay"
+# seconds a session waits for the server to finish after its last record
+DRAIN_SECONDS = 5
+
+
+@dataclass
+class Trace:
+    path: str
+    header: dict
+    records: List[Tuple[float, str, list]]
+
+    @property
+    def user(self) -> Optional[str]:
+        """The first user the session logged in or registered as."""
+        for _, code, fields in self.records:
+            if code in LOGIN_CODES and fields:
+                return str(fields[0])
+        return None
+
+
+@dataclass
+class SessionResult:
+    sent: int = 0
+    received: int = 0
+    errors: List[str] = field(default_factory=list)
+
+
+def load_traces(paths: List[str]) -> List[Trace]:
+    """Read trace files, directories are searched for *.trace.gz."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, "*.trace.gz")))
+        else:
+            files.append(path)
+    traces = [Trace(path, *traceManager.read_trace(path)) for path in files]
+    traces.sort(key=lambda trace: trace.header["started"])
+    return traces
+
+
+def replay_names(traces: List[Trace], run_id: str) -> Dict[str, str]:
+    """
+    Replay usernames, sessions of one recorded user share theirs and
+    sessions without a login get one of their own, keyed by trace path.
+    """
+    names = {}
+    for trace in traces:
+        key = trace.user if trace.user is not None else trace.path
+        if key not in names:
+            names[key] = f"replay{run_id}u{len(names)}"
+    return names
+
+
+def summary_ids(traces: List[Trace]) -> List[str]:
+    ids = set()
+    for trace in traces:
+        for _, code, fields in trace.records:
+            index = SUMMARY_ID_FIELDS.get(code)
+            if index is not None and index < len(fields):
+                ids.add(str(fields[index]))
+    return sorted(ids)
+
+
+def rewrite(code: str, fields: list, names: Dict[str, str], summaries: Dict[str, int]):
+    """
+    Point the recorded ids of a message at their replay stand-ins.
+
+    :return: The fields to send, None for messages the replay skips.
+    """
+    if code in LOGIN_CODES:
+        return None
+    fields = list(fields)
+    index = SUMMARY_ID_FIELDS.get(code)
+    if index is not None and str(fields[index]) in summaries:
+        fields[index] = str(summaries[str(fields[index])])
+    index = USERNAME_FIELDS.get(code)
+    if index is not None and str(fields[index]) in names:
+        fields[index] = names[str(fields[index])]
+    return fields
+
+
+def expect(net: networkManager.NetworkManager, wanted: str) -> list:
+    code, params = net.recv_frame()
+    while code == "TICKET":
+        code, params = net.recv_frame()
+    if code != wanted:
+        raise RuntimeError(f"expected {wanted}, got {code}")
+    return params
+
+
+def login(address, name: str) -> networkManager.NetworkManager:
+    net = client.connect(address)
+    net.send_frame("LOGIN", [name, REPLAY_PASSWORD])
+    expect(net, "LOGIN_SUCCESS")
+    return net
+
+
+def prepare(address, names: Dict[str, str], ids: List[str], run_id: str):
+    """
+    Register the replay users and create a summary for every recorded one.
+
+    :return: Recorded summary id -> replay summary id.
+    """
+    net = client.connect(address)
+    owner = f"replay{run_id}owner"
+    for name in [*names.values(), owner]:
+        net.send_frame("REGISTER", [name, REPLAY_PASSWORD])
+        expect(net, "REGISTER_SUCCESS")
+    net.send_frame("LOGIN", [owner, REPLAY_PASSWORD])
+    expect(net, "LOGIN_SUCCESS")
+    summaries = {}
+    for sid in ids:
+        net.send_frame("SAVE", [f"replay{run_id}s{sid}", "", "Arial"])
+        expect(net, "SAVE_SUCCESS")
+        net.send_frame("GETSUMMARIES", [])
+        created = net.decode_objects(expect(net, "TAKESUMMARIES"))
+        summaries[sid] = max(summ.id for summ in created)
+    net.send_frame("EXIT", [])
+    net.sock.close()
+    return summaries
+
+
+def drain(net: networkManager.NetworkManager, result: SessionResult) -> None:
+    """Read everything the server sends until it closes the session."""
+    try:
+        while True:
+            code, params = net.recv_frame()
+            result.received += 1
+            if code == "ERROR":
+                result.errors.append(networkManager.as_text(params[0]))
+    except (OSError, ValueError):
+        pass
+
+
+def replay_session(
+    address,
+    trace: Trace,
+    name: str,
+    start: float,
+    speed: float,
+    names: Dict[str, str],
+    summaries: Dict[str, int],
+    result: SessionResult,
+) -> None:
+    try:
+        net = login(address, name)
+    except (OSError, RuntimeError) as e:
+        result.errors.append(f"{trace.path}: {e}")
+        return
+    reader = threading.Thread(target=drain, args=(net, result), daemon=True)
+    reader.start()
+    last = None
+    try:
+        for offset, code, fields in trace.records:
+            fields = rewrite(code, fields, names, summaries)
+            if fields is None:
+                continue
+            if speed:
+                time.sleep(max(0.0, start + offset / speed - time.monotonic()))
+            net.send_frame(code, fields)
+            result.sent += 1
+            last = code
+        if last != networkManager.EXIT_CODE:
+            net.send_frame(networkManager.EXIT_CODE, [])
+    except OSError as e:
+        result.errors.append(f"{trace.path}: {e}")
+    reader.join(DRAIN_SECONDS)
+    net.sock.close()
+
+
+class HandlerProfiler:
+    """
+    cProfile of the message handlers only, one profile per handler thread
+    merged at the end, in thread and async mode alike.
+    """
+
+    def __init__(self) -> None:
+        self.local = threading.local()
+        self.profiles: List[cProfile.Profile] = []
+
+    def wrap(self, dispatch):
+        def profiled(*args, **kwargs):
+            profile = getattr(self.local, "profile", None)
+            if profile is None:
+                profile = self.local.profile = cProfile.Profile()
+                self.profiles.append(profile)
+            profile.enable()
+            try:
+                return dispatch(*args, **kwargs)
+            finally:
+                profile.disable()
+
+        return profiled
+
+    def dump(self, path: str) -> None:
+        profiles = [profile for profile in self.profiles if profile.getstats()]
+        if profiles:
+            pstats.Stats(*profiles).dump_stats(path)
+
+
+def start_server(use_async: bool) -> Tuple[str, int]:
+    """
+    Run the server's accept loop on a thread of this process, on a free
+    loopback port of the current directory's dbconved.db.
+    """
+    import asyncio
+
+    from Crypto.PublicKey import RSA
+
+    import server
+
+    server.rsa_key = RSA.generate(2048)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    # connections queue up before the accept loop gets going
+    sock.listen(server.LISTEN_BACKLOG)
+    if use_async:
+        target, args = asyncio.run, (server.async_main(sock, server.rsa_key, 0),)
+    else:
+        target, args = server.main, (sock, server.rsa_key, time.time())
+    threading.Thread(target=target, args=args, daemon=True).start()
+    return sock.getsockname()
+
+
+def handler_table() -> List[str]:
+    lines = [f"{'code':>16} {'count':>7} {'errors':>6} {'mean ms':>9} {'p99 ms':>9}"]
+    with STATS.lock:
+        rows = [
+            (code, stats)
+            for code, stats in STATS.per_code.items()
+            if stats.handler.count
+        ]
+    rows.sort(key=lambda row: -row[1].handler.total)
+    for code, stats in rows:
+        histogram = stats.handler
+        lines.append(
+            f"{code:>16} {histogram.count:>7} {stats.errors:>6}"
+            f" {1000 * histogram.total / histogram.count:>9.2f}"
+            f" {1000 * histogram.quantile(0.99):>9.1f}"
+        )
+    return lines
+
+
+def run(args) -> List[SessionResult]:
+    traces = load_traces(args.traces)
+    if not traces:
+        raise SystemExit("no traces")
+    run_id = f"{os.getpid()}x{int(time.time())}"
+    names = replay_names(traces, run_id)
+    address = start_server(args.use_async)
+    summaries = prepare(address, names, summary_ids(traces), run_id)
+    STATS.reset()
+
+    first = traces[0].header["started"]
+    start = time.monotonic()
+    results = [SessionResult() for _ in traces]
+    threads = []
+    for trace, result in zip(traces, results):
+        session_start = start
+        if args.speed:
+            session_start += (trace.header["started"] - first) / args.speed
+            time.sleep(max(0.0, session_start - time.monotonic()))
+        name = names[trace.user if trace.user is not None else trace.path]
+        thread = threading.Thread(
+            target=replay_session,
+            args=(address, trace, name, session_start, args.speed, names, summaries, result),
+            daemon=True,
+        )
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("traces", nargs="+", help="trace files or directories")
+    parser.add_argument(
+        "--db-dir", default=".", help="directory holding the dbconved.db to use"
+    )
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="1 is real time, 0 as fast as possible"
+    )
+    parser.add_argument("--async", dest="use_async", action="store_true")
+    parser.add_argument("--profile", metavar="FILE", help="cProfile the handlers")
+    parser.add_argument(
+        "--verbose", action="store_true", help="keep the server's own output"
+    )
+    args = parser.parse_args()
+    args.traces = [os.path.abspath(path) for path in args.traces]
+    profile_path = os.path.abspath(args.profile) if args.profile else None
+    os.chdir(args.db_dir)
+    if not os.path.isfile("dbconved.db"):
+        raise SystemExit(f"{args.db_dir} has no dbconved.db")
+
+    profiler = None
+    if profile_path:
+        profiler = HandlerProfiler()
+        networkManager.NetworkManager.dispatch_frame = profiler.wrap(
+            networkManager.NetworkManager.dispatch_frame
+        )
+    stdout = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+    try:
+        start = time.perf_counter()
+        results = run(args)
+        elapsed = time.perf_counter() - start
+    finally:
+        sys.stdout = stdout
+
+    errors = [error for result in results for error in result.errors]
+    print(f"sessions: {len(results)}")
+    print(f"sent: {sum(result.sent for result in results)}")
+    print(f"received: {sum(result.received for result in results)}")
+    print(f"errors: {len(errors)}")
+    print(f"elapsed: {elapsed:.3f}")
+    print("\n".join(handler_table()))
+    for error in errors[:10]:
+        print("error:", error)
+    if profiler is not None:
+        profiler.dump(profile_path)
+        print(f"profile: {profile_path}")
+    return 0
+
+
+def test_replay_maps_recorded_ids(tmp_path):
+    writer = traceManager.TraceWriter(str(tmp_path / "a.trace.gz"), ["BIN"])
+    writer.record("LOGIN", ["alice", "pw"])
+    writer.record("GETSUMMARY", ["41"])
+    writer.record("SHARESUMMARY", ["bob"])
+    writer.close()
+    writer = traceManager.TraceWriter(str(tmp_path / "b.trace.gz"), ["BIN"])
+    writer.record("UPDATEDOC", ["{}"])
+    writer.close()
+    traces = load_traces([str(tmp_path)])
+    assert [trace.user for trace in traces] == ["alice", None]
+    names = replay_names(traces, "r")
+    assert names == {"alice": "replayru0", traces[1].path: "replayru1"}
+    assert summary_ids(traces) == ["41"]
+    names["bob"] = "replayru2"
+    summaries = {"41": 7}
+    sent = [
+        (code, rewrite(code, fields, names, summaries))
+        for _, code, fields in traces[0].records
+    ]
+    assert sent == [
+        ("LOGIN", None),
+        ("GETSUMMARY", ["7"]),
+        ("SHARESUMMARY", ["replayru2"]),
+    ]
+
+
+def test_handler_profiler_merges_threads():
+    profiler = HandlerProfiler()
+    work = profiler.wrap(lambda n: sum(range(n)))
+    threads = [threading.Thread(target=work, args=(10_000,)) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(profiler.profiles) == 3
+    assert pstats.Stats(*profiler.profiles).total_calls > 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,27 +1,40 @@
+import asyncio
+import atexit
 import base64
 import datetime
+import itertools
 import json
 import os
+import pickle
+import signal
 
 # from dbManager import DbManager
-import pickle
 import socket
+import struct
 import sys
+import tempfile
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from enum import Enum
 from threading import Thread
-from typing import Dict, Optional
+from typing import Callable, Dict, List, Optional
 
 import dotenv
 from Crypto.PublicKey import RSA
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 
+import clusterManager
 import cryptManager
+import documentRope
 import networkManager
 import OCRManager
+import opLog
+import statsManager
+import traceManager
+import workerManager
 from dbManager import DbManager, Summary
 from OCRManager import ExtractText
 
@@ -31,9 +44,17 @@ ids_per_summary_id = {}
 net_per_sock = {}
 # lock_per_sock: Dict[socket.socket, threading.Lock] = {}
 # doc_changes_lock = threading.Lock()
-lock_per_doc = {}
+# summary id -> condition guarding its doc_changes, notified on new changes
+# and when its last user leaves so the summary thread wakes right away
+lock_per_doc: Dict[int, threading.Condition] = {}
 historic_id_per_sock = {}
 handlers_per_sock_per_path = {}
+# streamed uploads are written here until their END
+UPLOAD_PART_SUFFIX = ".part"
+# next to a .part file, which file it is part of (the client's mtime)
+UPLOAD_ID_SUFFIX = ".id"
+# GETSUMMARY streams the summary file in pieces of this size
+SUMMARY_CHUNK_SIZE = 64 * 1024
 doc_changes = {}
 EVENT_DAY_REMIND = 7
 USE_MYSQL = False
@@ -51,8 +72,182 @@ class LockType(Enum):
 
 
 LOCK_GRANULARITY = LockType.CHARACTER  # Can be changed to WORD or LINE
-ENABLE_OPERATIONAL_TRANSFORM = not True  # Enable advanced conflict resolution
-MAX_HISTORY_LENGTH = 100
+# transform changes made on an older revision against the ops applied since
+ENABLE_OPERATIONAL_TRANSFORM = os.getenv("OPERATIONAL_TRANSFORM", "1") != "0"
+# ops kept per summary, a change based on an older revision is dropped
+MAX_HISTORY_LENGTH = int(os.getenv("MAX_HISTORY_LENGTH", str(opLog.MAX_OPS)))
+# summary threads wait this long after the first change of a burst so the
+# edits typed meanwhile are applied and broadcast together, 0 applies at once
+DOC_BATCH_WINDOW = float(os.getenv("DOC_BATCH_WINDOW", "0"))
+# summary threads are woken by notifications, this only bounds a missed one
+DOC_IDLE_WAKEUP = 5
+# peers get the ops applied since their revision (TAKEDELTA), every this
+# many deltas one carries a checksum of the text, a copy that drifted asks
+# for the whole text again (RESYNC)
+FULL_SYNC_EVERY = int(os.getenv("FULL_SYNC_EVERY", "50"))
+
+# "thread" keeps one thread per connection, "async" multiplexes every
+# connection on a single event loop (pass --async or set SERVER_MODE=async)
+SERVER_MODE = os.getenv("SERVER_MODE", "thread")
+MAX_HANDLER_WORKERS = int(os.getenv("MAX_HANDLER_WORKERS", "16"))
+MAX_BLOCKING_WORKERS = int(os.getenv("MAX_BLOCKING_WORKERS", "2"))
+# seconds a thread mode socket may stall on a send (or inside a frame) before
+# the peer is dropped, a laggard that only reads slowly is caught by the
+# outbound queue limit long before that
+SOCKET_TIMEOUT = float(os.getenv("SOCKET_TIMEOUT", "30"))
+# codes whose handlers run OCR/summarization/google api calls, kept on their
+# own small pool so they cant starve the regular handlers
+BLOCKING_CODES = {"GETFILECONTENT", "SUMMARIZE", "EXPORT", "IMPORT_GCAL"}
+thread_db = threading.local()
+# summary threads, finished ones are dropped when the next one starts
+threads = []
+# admission control, connections over MAX_SESSIONS get a BUSY reply with a
+# retry hint instead of a session
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "256"))
+LISTEN_BACKLOG = int(os.getenv("LISTEN_BACKLOG", str(socket.SOMAXCONN)))
+BUSY_RETRY_SECONDS = int(os.getenv("BUSY_RETRY_SECONDS", "5"))
+
+# resumption tickets let a reconnecting client skip the RSA exchange and the
+# LOGIN, set TICKET_KEY (base64) to keep them valid across restarts/nodes
+TICKET_KEY = (
+    base64.b64decode(os.environ["TICKET_KEY"])
+    if os.getenv("TICKET_KEY")
+    else os.urandom(32)
+)
+TICKET_LIFETIME = int(os.getenv("TICKET_LIFETIME", str(12 * 60 * 60)))
+# session key, user id, expiry timestamp
+TICKET_FORMAT = struct.Struct("!16sId")
+KEY_EXCHANGE_TIMEOUT = 10
+# user ids allowed to run STATS, comma separated
+ADMIN_USER_IDS = {
+    int(uid) for uid in os.getenv("ADMIN_USER_IDS", "").split(",") if uid.strip()
+}
+# local plain text metrics, 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# logged in peers that negotiated PING get one after PING_INTERVAL seconds of
+# silence and are disconnected after IDLE_TIMEOUT, a PING_INTERVAL of 0
+# disables both and LOGIN_TIMEOUT below
+PING_INTERVAL = int(os.getenv("PING_INTERVAL", "30"))
+IDLE_TIMEOUT = int(os.getenv("IDLE_TIMEOUT", "90"))
+# a session that is not logged in cannot be pinged (the login frame reads
+# nothing until its user acts), it is disconnected after LOGIN_TIMEOUT
+# seconds of silence so it does not hold a MAX_SESSIONS slot forever
+LOGIN_TIMEOUT = int(os.getenv("LOGIN_TIMEOUT", "600"))
+# multi-process mode, WORKERS processes share the port and each summary is
+# owned by one of them, sessions move to the owner over a unix socket in
+# IPC_DIR when they open it
+WORKERS = int(os.getenv("WORKERS", "1"))
+IPC_DIR = os.getenv("IPC_DIR", tempfile.gettempdir())
+worker_index = 0
+server_port = 12345
+# cluster mode, nodes list the address of their cluster port in the json
+# file CLUSTER_DIRECTORY and own the summaries the hash ring gives them.
+# they must share TICKET_KEY, it also seals what nodes send each other, and
+# do not start without it
+CLUSTER_DIRECTORY = os.getenv("CLUSTER_DIRECTORY", "")
+NODE_ADDRESS = os.getenv("NODE_ADDRESS", "127.0.0.1:13345")
+MIGRATE_TIMEOUT = 5
+# seconds a thread mode session waits for its client before checking if
+# its summary moved or its session was detached
+SESSION_WAKEUP = 0.5
+ring = clusterManager.HashRing()
+# client socket -> connection to the node its session was relayed to
+relay_per_sock: Dict[socket.socket, socket.socket] = {}
+# live content (a documentRope.Rope) of every summary thread, sent along
+# when a summary moves
+doc_contents = {}
+# content a summary moved here with, its next summary thread starts there
+seeded_contents = {}
+
+
+@dataclass
+class PeerSync:
+    """The revision a peer's copy of a summary was last brought to."""
+
+    revision: int
+    deltas: int = 0
+    # an UPDATEDOC of the peer was handled since, its next delta says so
+    acked: bool = False
+
+
+# summary id -> user id -> PeerSync, a peer without one gets the whole text
+peer_syncs: Dict[int, Dict[int, PeerSync]] = {}
+# when set, every session records the messages it receives to a trace file
+# in this directory, for replayTrace.py. passwords are left out, documents
+# and uploads are not
+TRACE_DIR = os.getenv("TRACE_DIR", "")
+trace_counter = itertools.count()
+
+
+# reverse index of ids_per_summary_id, user id -> the summary id they have open
+open_summary_per_user: Dict[int, int] = {}
+# joining/leaving a summary and its summary thread exiting
+open_summary_lock = threading.RLock()
+
+
+def get_open_summary(user_id) -> int:
+    return open_summary_per_user.get(user_id, -1)
+
+
+def set_open_summary(user_id, sid) -> bool:
+    """
+    Move a user to another open summary.
+
+    :return: True if they are the first one on it (no summary thread yet).
+    """
+    with open_summary_lock:
+        close_open_summary(user_id)
+        open_summary_per_user[user_id] = sid
+        # what they have is from GETSUMMARY, not a revision
+        peer_syncs.get(sid, {}).pop(user_id, None)
+        if sid not in ids_per_summary_id:
+            ids_per_summary_id[sid] = [user_id]
+            return True
+        ids_per_summary_id[sid].append(user_id)
+        return False
+
+
+def close_open_summary(user_id) -> None:
+    with open_summary_lock:
+        sid = open_summary_per_user.pop(user_id, None)
+        if sid is None or user_id not in ids_per_summary_id.get(sid, []):
+            return
+        ids_per_summary_id[sid].remove(user_id)
+        emptied = not ids_per_summary_id[sid]
+    if emptied:
+        # its summary thread saves and exits now instead of on its next change
+        wake_summary(sid)
+
+
+def wake_summary(sid) -> None:
+    cond = lock_per_doc.get(sid)
+    if cond is not None:
+        with cond:
+            cond.notify_all()
+
+
+def has_pending_changes(sid) -> bool:
+    return any(doc_changes.get(sid, {}).values())
+
+
+def release_summary(sid, db_manager: DbManager, doc_content) -> bool:
+    """
+    Save and drop a summary nobody has open any more, so the next one to
+    open it starts a new summary thread on the saved content.
+
+    :return: True if it was dropped, False if someone still has it open.
+    """
+    with open_summary_lock:
+        if ids_per_summary_id.get(sid):
+            return False
+        db_manager.save_summary(sid, str(doc_content))
+        ids_per_summary_id.pop(sid, None)
+        doc_contents.pop(sid, None)
+        change_history.pop(sid, None)
+        peer_syncs.pop(sid, None)
+        user_cursors.pop(sid, None)
+        user_selections.pop(sid, None)
+        return True
 
 
 @dataclass
@@ -71,18 +266,90 @@ def handle_key_exchange(
     net: networkManager.NetworkManager = networkManager.NetworkManager(sock, crypt, {})
     # print("Public rsa key: ", crypt.get_public_key())
     net.send_message_plain(
-        net.build_message("KEY", [crypt.get_public_key()], do_size=True)
+        net.build_message(
+            "KEY", [crypt.get_public_key(), net.offer_caps()], do_size=True
+        )
     )
-    while not net.has_received():
-        time.sleep(0.1)
-    plain = net.recv_message_plain()
-    if plain == b"" or plain == "":
-        print("Client disconnected during key exchange")
-        return None
-    public_key = net.get_message_params(plain.decode())[0]
-    crypt.aes_key = base64.b64decode(crypt.decrypt_rsa(base64.b64decode(public_key)))
-    net.crypt_manager = crypt
-    return net
+    sock.settimeout(KEY_EXCHANGE_TIMEOUT)
+    # a rejected RESUME is followed by a regular KEY reply
+    for _ in range(2):
+        try:
+            plain = net.recv_message_plain()
+        except socket.timeout:
+            plain = b""
+        if plain == b"" or plain == "":
+            print("Client disconnected during key exchange")
+            return None
+        if complete_key_exchange(net, plain):
+            return net
+    return None
+
+
+def complete_key_exchange(net: networkManager.NetworkManager, plain: bytes) -> bool:
+    """
+    Handle the client's answer to KEY, either its RSA encrypted aes key or a
+    RESUME with a ticket.
+
+    :return: False if a RESUME was rejected and a KEY reply should follow.
+    """
+    crypt = net.crypt_manager
+    message = plain.decode()
+    params = net.get_message_params(message)
+    if net.get_message_code(message) == "RESUME":
+        if resume_session(net, *params):
+            return True
+        net.send_message_plain(net.build_message("RESUME_FAIL", [], do_size=True))
+        return False
+    crypt.aes_key = base64.b64decode(crypt.decrypt_rsa(base64.b64decode(params[0])))
+    # old clients answer with the key only and keep the text protocol
+    caps = net.accept_caps(params[1] if len(params) > 1 else "", is_server=True)
+    print("Negotiated caps: ", caps)
+    return True
+
+
+def issue_ticket(net: networkManager.NetworkManager, user_id: int) -> None:
+    if networkManager.CAP_RESUME not in net.caps:
+        return
+    crypt = net.crypt_manager
+    ticket = crypt.seal(
+        TICKET_KEY,
+        TICKET_FORMAT.pack(crypt.aes_key, user_id, time.time() + TICKET_LIFETIME),
+    )
+    net.send_frame("TICKET", [ticket])
+
+
+def resume_session(
+    net: networkManager.NetworkManager, ticket="", client_nonce="", caps="", *_
+) -> bool:
+    """
+    Restore the aes session and login of a ticket. The new session key is
+    derived from the ticket key and fresh nonces of both sides, so counters
+    never repeat under the same key.
+    """
+    crypt = net.crypt_manager
+    try:
+        ticket_key, user_id, expiry = TICKET_FORMAT.unpack(
+            crypt.unseal(TICKET_KEY, base64.b64decode(ticket))
+        )
+        client_nonce = base64.b64decode(client_nonce)
+    except (ValueError, struct.error):
+        print("Rejected resumption ticket")
+        return False
+    if expiry < time.time() or len(client_nonce) != 16:
+        print("Rejected resumption ticket")
+        return False
+    server_nonce = crypt.generate_random_bytes(16)
+    crypt.aes_key = crypt.derive_key(ticket_key, client_nonce, server_nonce)
+    net.accept_caps(caps, is_server=True)
+    net.send_message_plain(
+        net.build_message(
+            "RESUMED", [base64.b64encode(server_nonce).decode()], do_size=True
+        )
+    )
+    id_per_sock[net.sock] = user_id
+    state_per_sock[net.sock] = UserState(user_id, net, None)
+    print(f"Resumed session of user {user_id}")
+    return True
 
 
 def handle_login(
@@ -104,22 +371,18 @@ def handle_login(
     )
     print(N_days_from_today)
     print(events)
-    net.send_message(
-        net.build_message(
-            "LOGIN_SUCCESS" if loged else "LOGIN_FAIL",
-            (
-                []
-                if not loged
-                else [
-                    base64.b64encode(pickle.dumps(eve)).decode()
-                    for eve in filter(
-                        lambda x: x["event_date"] <= N_days_from_today,
-                        events,
-                    )
-                ]
-            ),
-        )
+    net.send_frame(
+        "LOGIN_SUCCESS" if loged else "LOGIN_FAIL",
+        (
+            []
+            if not loged
+            else net.encode_objects(
+                filter(lambda x: x["event_date"] <= N_days_from_today, events)
+            )
+        ),
     )
+    if loged:
+        issue_ticket(net, loged.id)
     return False
 
 
@@ -139,35 +402,18 @@ def handle_register(
 
 
 def handle_summaries(db_manager, *a, net: networkManager.NetworkManager) -> bool:
-    if not db_manager.get_is_sock_logged(net.sock):
-        print("NOT logged in")
-        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
-        return True
     summaries = db_manager.get_all_user_can_access(db_manager.get_id_per_sock(net.sock))
-    net.send_message(
-        net.build_message(
-            "TAKESUMMARIES",
-            [base64.b64encode(pickle.dumps(summ)).decode() for summ in summaries],
-        )
-    )
+    net.send_frame("TAKESUMMARIES", net.encode_objects(summaries))
     return False
 
 
 def handle_save(
     db_manager, title, summary, font, *, net: networkManager.NetworkManager
 ) -> bool:
-    if not db_manager.get_is_sock_logged(net.sock):
-        print("NOT logged in")
-        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
-        return True
     print("Saving title: ", title)
     # net.send_message(net.build_message("ERROR",["ASD"]))
     if title == "":
-        sid = -1
-        for k, v in ids_per_summary_id.items():
-            if db_manager.get_id_per_sock(net.sock) in v:
-                sid = k
-                break
+        sid = get_open_summary(db_manager.get_id_per_sock(net.sock))
         print(f"Updating, {sid=}")
         db_manager.update_summary(sid, summary, font)
 
@@ -182,18 +428,9 @@ def handle_save(
 def handle_event(
     db_manager, title, datetime_str, *, net: networkManager.NetworkManager
 ) -> bool:
-    if not db_manager.get_is_sock_logged(net.sock):
-        print("NOT logged in")
-        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
-        return True
-
     db_manager.insert_event(db_manager.get_id_per_sock(net.sock), title, datetime_str)
     even = db_manager.get_event(db_manager.get_id_per_sock(net.sock), title)
-    net.send_message(
-        net.build_message(
-            "EVENT_SUCCESS", [base64.b64encode(pickle.dumps(even)).decode()]
-        )
-    )
+    net.send_frame("EVENT_SUCCESS", [net.encode_object(even)])
     return False
 
 
@@ -202,11 +439,6 @@ def handle_delete_event(
 ) -> bool:
     user_id = db_manager.get_id_per_sock(net.sock)
 
-    if not db_manager.get_is_sock_logged(net.sock):
-        print("NOT logged in")
-        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
-        return True
-
     success = db_manager.delete_event(event_id, user_id)
 
     if success:
@@ -219,25 +451,29 @@ def handle_delete_event(
     return False
 
 
-def handle_file(db_manager, path, *, net: networkManager.NetworkManager) -> bool:
-    user_id = db_manager.get_id_per_sock(net.sock)
-    if not db_manager.get_is_sock_logged(net.sock):
-        print("NOT logged in")
-        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
-        return True
-    if (
+def is_invalid_upload_path(path) -> bool:
+    return (
         # "." in path or
         ".." in path
         or path.startswith("/")
         or path.startswith("\\")
         or ":" in path
-    ):
-        net.send_message(net.build_message("ERROR", ["INVALID PATH"]))
-        return True
+    )
+
+
+def ensure_tmp_dir(user_id) -> None:
     # with open(f"./data/{id}/tmp/{path}", "rb") as jf
     if not os.path.exists(f"./data/{user_id}/tmp"):
         print("Path does not exist")
-        os.makedirs(f"./data/{user_id}/tmp", exist_ok=False)
+        os.makedirs(f"./data/{user_id}/tmp", exist_ok=True)
+
+
+def handle_file(db_manager, path, *, net: networkManager.NetworkManager) -> bool:
+    user_id = db_manager.get_id_per_sock(net.sock)
+    if is_invalid_upload_path(path):
+        net.send_message(net.build_message("ERROR", ["INVALID PATH"]))
+        return True
+    ensure_tmp_dir(user_id)
     if user_id not in handlers_per_sock_per_path:
         handlers_per_sock_per_path[user_id] = {}
     if path in handlers_per_sock_per_path[user_id]:
@@ -251,10 +487,6 @@ def handle_file(db_manager, path, *, net: networkManager.NetworkManager) -> bool
 
 def handle_chunk(db_manager, path, data, net: networkManager.NetworkManager) -> bool:
     user_id = db_manager.get_id_per_sock(net.sock)
-    if not db_manager.get_is_sock_logged(net.sock):
-        print("NOT logged in")
-        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
-        return True
     # resuse handle later.... (matter of adding a global dict of id,
     # that leads to dict of path to file handle then seeing if it exists
     if (
@@ -264,16 +496,68 @@ def handle_chunk(db_manager, path, data, net: networkManager.NetworkManager) ->
         net.send_message(net.build_message("ERROR", ["NO FILE OPENED"]))
         return True
     f = handlers_per_sock_per_path[user_id][path]
-    f.write(base64.b64decode(data))
+    f.write(networkManager.as_bytes(data))
     return False
 
 
-def handle_end(db_manager, path, net: networkManager.NetworkManager) -> bool:
+def handle_upload(
+    db_manager, path, size, identity="", *, net: networkManager.NetworkManager
+):
+    """
+    Start or resume a streamed upload. The data goes to a .part file that
+    is kept when the connection drops, the UACK tells the client how much
+    of it the server already has. A part kept for another identity (or
+    for none) is started over.
+    """
     user_id = db_manager.get_id_per_sock(net.sock)
-    if db_manager.get_is_sock_logged(net.sock) == -1:
-        print("NOT logged in")
-        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
+    if is_invalid_upload_path(path) or not size.isdigit():
+        net.send_message(net.build_message("ERROR", ["INVALID PATH"]))
+        return True
+    ensure_tmp_dir(user_id)
+    files = handlers_per_sock_per_path.setdefault(user_id, {})
+    part_path = f"./data/{user_id}/tmp/{path}{UPLOAD_PART_SUFFIX}"
+    if path in files and files[path].name != part_path:
+        # a legacy FILE upload of the same name is still open
+        net.send_message(net.build_message("ERROR", ["FILE ALREADY EXISTS(rn)"]))
+        return True
+    if path not in files:
+        files[path] = open(part_path, "ab")
+    f = files[path]
+    id_path = part_path + UPLOAD_ID_SUFFIX
+    try:
+        with open(id_path) as id_file:
+            kept = id_file.read()
+    except FileNotFoundError:
+        kept = ""
+    if f.tell() > int(size) or not identity or kept != identity:
+        # left over from another file with this name
+        f.truncate(0)
+        f.seek(0)
+        with open(id_path, "w") as id_file:
+            id_file.write(identity)
+    net.send_message(net.build_message("UACK", [path, str(f.tell())]))
+    return False
+
+
+def handle_upload_chunk(
+    db_manager, path, offset, data, *, net: networkManager.NetworkManager
+) -> bool:
+    user_id = db_manager.get_id_per_sock(net.sock)
+    f = handlers_per_sock_per_path.get(user_id, {}).get(path)
+    # the uploader waits for a UACK of this file, it gives up on a UFAIL
+    if f is None:
+        net.send_message(net.build_message("UFAIL", [path, "NO FILE OPENED"]))
         return True
+    if int(offset) != f.tell():
+        net.send_message(net.build_message("UFAIL", [path, "BAD UPLOAD OFFSET"]))
+        return True
+    f.write(networkManager.as_bytes(data))
+    net.send_message(net.build_message("UACK", [path, str(f.tell())]))
+    return False
+
+
+def handle_end(db_manager, path, net: networkManager.NetworkManager) -> bool:
+    user_id = db_manager.get_id_per_sock(net.sock)
     if (
         user_id not in handlers_per_sock_per_path
         or path not in handlers_per_sock_per_path[user_id]
@@ -283,16 +567,18 @@ def handle_end(db_manager, path, net: networkManager.NetworkManager) -> bool:
     f = handlers_per_sock_per_path[user_id][path]
     f.close()
     del handlers_per_sock_per_path[user_id][path]
+    if f.name.endswith(UPLOAD_PART_SUFFIX):
+        os.replace(f.name, f.name[: -len(UPLOAD_PART_SUFFIX)])
+        try:
+            os.remove(f.name + UPLOAD_ID_SUFFIX)
+        except FileNotFoundError:
+            pass
     return False
 
 
 def handle_ocr(db_manager, path, net: networkManager.NetworkManager) -> bool:
     # in real life we would have to prevent the RFI LFI
     # but for now we just assume the path is safe
-    if not db_manager.get_is_sock_logged(net.sock):
-        print("NOT logged in")
-        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
-        return True
     if (
         # "." in path or
         ".." in path
@@ -309,10 +595,6 @@ def handle_ocr(db_manager, path, net: networkManager.NetworkManager) -> bool:
 
 def handle_summary(db_manager, summary, net: networkManager.NetworkManager) -> bool:
     # id = db_manager.get_id_per_sock(net.sock)
-    if not db_manager.get_is_sock_logged(net.sock):
-        print("NOT logged in")
-        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
-        return True
     summ = OCRManager.summarize_paragraph(
         summary, summary.count(".") - 2 if summary.count(".") > 2 else 1
     )
@@ -345,63 +627,59 @@ def handle_build_file(db_manager, content, ext):
 
 def handle_export(db_manager, content, ext, net: networkManager.NetworkManager) -> bool:
     # id = db_manager.get_id_per_sock(net.sock)
-    if not db_manager.get_is_sock_logged(net.sock):
-        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
-        return True
     # currently avaliable formats: txt,pdf,md,html
     if ext not in ["txt", "pdf", "md", "html"]:
         net.send_message(net.build_message("ERROR", ["INVALID FORMAT"]))
         return True
     file_bytes = handle_build_file(db_manager, content, ext)
-    net.send_message(
-        net.build_message("EXPORTED", [base64.b64encode(file_bytes).decode()])
-    )
+    net.send_frame("EXPORTED", [file_bytes])
     return False
 
 
 def handle_get_summary(db_manager, sid, net: networkManager.NetworkManager) -> bool:
+    if route_summary(db_manager, net, "GETSUMMARY", [sid]):
+        return False
     user_id = db_manager.get_id_per_sock(net.sock)
-    if not db_manager.get_is_sock_logged(net.sock):
-        print("NOT logged in")
-        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
-        return True
-    summ: Summary = db_manager.get_summary(sid)
+    # the content is read from the file below, not by the db manager too
+    summ: Summary = db_manager.get_summary(sid, with_content=False)
     if summ is None:
         net.send_message(net.build_message("ERROR", ["SUMMARY NOT FOUND"]))
         return True
-    with open(summ.path_to_summary, "rb") as f:
-        data = f.read()
-
-    net.send_message(
-        net.build_message(
-            "TAKESUMMARY",
-            [base64.b64encode(pickle.dumps({"data": data, "summ": summ})).decode()],
+    if net.streams_summaries:
+        stream_summary(summ, net)
+    else:
+        with open(summ.path_to_summary, "rb") as f:
+            data = f.read()
+        net.send_frame(
+            "TAKESUMMARY", [net.encode_object({"data": data, "summ": summ})]
         )
-    )
 
     # scan if id exists, then remove
-    for _, value in ids_per_summary_id.items():
-        if user_id in value:
-            value.remove(user_id)
-            break
-    if summ.id not in ids_per_summary_id:
-        ids_per_summary_id[summ.id] = [user_id]
+    if set_open_summary(user_id, summ.id):
         spawn_summary_thread(summ, user_id, net, summ.id)
-    else:
-        ids_per_summary_id[summ.id].append(user_id)
 
     return False
 
 
+def stream_summary(summ: Summary, net: networkManager.NetworkManager) -> None:
+    """
+    Send the summary file in SUMMARY_CHUNK_SIZE pieces, so neither side
+    holds it twice, then the metadata the client needs to finish up.
+    """
+    sid = str(summ.id)
+    size = os.path.getsize(summ.path_to_summary)
+    net.send_message(net.build_message("SUMMARYSTART", [sid, str(size)]))
+    with open(summ.path_to_summary, "rb") as f:
+        for chunk in iter(lambda: f.read(SUMMARY_CHUNK_SIZE), b""):
+            net.send_frame("SUMMARYCHUNK", [sid, chunk])
+    net.send_frame("SUMMARYEND", [sid, net.encode_object(summ)])
+
+
 # Add this function to your server.py file
 def handle_get_summary_by_link(
     db_manager, link, net: networkManager.NetworkManager
 ) -> bool:
     # id = db_manager.get_id_per_sock(net.sock)
-    if not db_manager.get_is_sock_logged(net.sock):
-        print("NOT logged in")
-        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
-        return True
     print("Checking db")
     summ: Summary = db_manager.get_summary_by_link(link)
     # print("Sending summary: ", summ)
@@ -431,20 +709,10 @@ def handle_get_summary_by_link(
 
 def handle_get_events(db_manager, *a, net: networkManager.NetworkManager) -> bool:
     user_id = db_manager.get_id_per_sock(net.sock)
-    if not db_manager.get_is_sock_logged(net.sock):
-        print("NOT logged in")
-        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
-        return True
-
     events = db_manager.get_events(user_id)
     print(f"Found {len(events)} events for user {user_id}")
 
-    net.send_message(
-        net.build_message(
-            "TAKEEVENTS",
-            [base64.b64encode(pickle.dumps(event)).decode() for event in events],
-        )
-    )
+    net.send_frame("TAKEEVENTS", net.encode_objects(events))
     return False
 
 
@@ -477,17 +745,9 @@ def handle_update_document(
     global doc_changes
     global documents
     user_id = db_manager.get_id_per_sock(net.sock)
-    if not db_manager.get_is_sock_logged(net.sock):
-        print("NOT logged in")
-        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
-        return True
     # save into the dict
     # let the thread handle
-    document_id = -1
-    for k, v in ids_per_summary_id.items():
-        if user_id in v:
-            document_id = k
-            break
+    document_id = get_open_summary(user_id)
     if document_id == -1:
         # net.send_message(net.build_message("ERROR", ["NO DOCUMENT OPENED"]))
         print("User hasnt oppened a document")
@@ -505,6 +765,7 @@ def handle_update_document(
 
         if json.loads(changes)["changes"]:
             doc_changes[document_id][user_id].append(changes)
+            lock_per_doc[document_id].notify_all()
             # print("Appended: ", changes)
             # print("\n\n\n")
         # else:
@@ -513,28 +774,39 @@ def handle_update_document(
     return False
 
 
+def handle_resync(db_manager, *_, net: networkManager.NetworkManager) -> bool:
+    """A client lost track of the revisions, send it the whole text again."""
+    user_id = db_manager.get_id_per_sock(net.sock)
+    sid = get_open_summary(user_id)
+    if sid not in doc_contents:
+        # no summary thread yet, its first update is a whole text anyway
+        return False
+    with lock_per_doc[sid]:
+        text = str(doc_contents[sid])
+        revision = change_history[sid].revision
+        peer_syncs.setdefault(sid, {})[user_id] = PeerSync(revision)
+    js = json.dumps(
+        update_message(
+            sid,
+            user_id,
+            doc_content=text,
+            recent_changes=change_history[sid].recent(5),
+            revision=revision,
+            font=db_manager.get_font_info(sid),
+        )
+    )
+    net.send_frame("TAKEUPDATE", [js.encode()])
+    return False
+
+
 def handle_share_summary(
     db_manager: DbManager, username, net: networkManager.NetworkManager
 ) -> bool:
     # Get the current user's ID from their socket
     current_user_id = db_manager.get_id_per_sock(net.sock)
 
-    # Check if user is logged in
-    if not db_manager.get_is_sock_logged(net.sock):
-        print("NOT logged in")
-        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
-        return True
-
     # Find the summary ID that the current user has open
-    summary_id = -1
-    for k, v in ids_per_summary_id.items():
-        if current_user_id in v:
-            summary_id = k
-            break
-
-    if summary_id == -1:
-        net.send_message(net.build_message("ERROR", ["NO SUMMARY OPENED"]))
-        return True
+    summary_id = get_open_summary(current_user_id)
 
     # Get the target user ID by username (the user to share WITH)
     target_user_id = db_manager.get_id_by_username(username)
@@ -559,23 +831,10 @@ def handle_share_summary(
 
 def handle_get_graph(db_manager, *_, net: networkManager.NetworkManager) -> bool:
     user_id = db_manager.get_id_per_sock(net.sock)
-    if not db_manager.get_is_sock_logged(net.sock):
-        print("NOT logged in")
-        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
-        return True
-    sid = -1
-    for k, v in ids_per_summary_id.items():
-        if user_id in v:
-            sid = k
-            break
-    if sid == -1:
-        net.send_message(net.build_message("ERROR", ["NO SUMMARY OPENED"]))
-        return True
+    sid = get_open_summary(user_id)
     print("Getting graph for: ", sid)
     graph = db_manager.get_graph(sid)
-    net.send_message(
-        net.build_message("TAKEGRAPH", [base64.b64encode(pickle.dumps(graph)).decode()])
-    )
+    net.send_frame("TAKEGRAPH", [net.encode_object(graph)])
     return False
 
 
@@ -583,12 +842,8 @@ def handle_saving_events(
     db_manager, jsoned_events, net: networkManager.NetworkManager
 ) -> bool:
     user_id = db_manager.get_id_per_sock(net.sock)
-    if not db_manager.get_is_sock_logged(net.sock):
-        print("NOT logged in")
-        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
-        return True
     # print("Saving events: ", jsoned_events)
-    events = pickle.loads(base64.b64decode(jsoned_events))  # json.loads(jsoned_events)
+    events = net.decode_object(jsoned_events)  # json.loads(jsoned_events)
     # print(events)
     print(events)
     for event in events:
@@ -599,29 +854,14 @@ def handle_saving_events(
 
 def get_historic_list(db_manager, *_, net: networkManager.NetworkManager) -> bool:
     # _= db_manager.get_id_per_sock(net.sock)
-    if not db_manager.get_is_sock_logged(net.sock):
-        print("NOT logged in")
-        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
-        return True
-    sid = -1
-    for k, v in ids_per_summary_id.items():
-        if db_manager.get_id_per_sock(net.sock) in v:
-            sid = k
-            break
-    if sid == -1:
-        net.send_message(net.build_message("ERROR", ["NO SUMMARY OPENED"]))
-        return True
+    sid = get_open_summary(db_manager.get_id_per_sock(net.sock))
     # read the directory save/{sid}/ (read sub directorys which are all timestamps)
     if not os.path.exists(f"save/{sid}/"):
         net.send_message(net.build_message("ERROR", ["NO HISTORIC DATA"]))
         return True
 
     dirs = os.listdir(f"save/{sid}/")
-    net.send_message(
-        net.build_message(
-            "HISTORICLIST", [base64.b64encode(pickle.dumps(dirs)).decode()]
-        )
-    )
+    net.send_frame("HISTORICLIST", [net.encode_object(dirs)])
     return False
 
 
@@ -629,18 +869,7 @@ def load_historic_summary(
     db_manager, timestamp, net: networkManager.NetworkManager
 ) -> bool:
     uid = db_manager.get_id_per_sock(net.sock)
-    if not db_manager.get_is_sock_logged(net.sock):
-        print("NOT logged in")
-        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
-        return True
-    sid = -1
-    for k, v in ids_per_summary_id.items():
-        if db_manager.get_id_per_sock(net.sock) in v:
-            sid = k
-            break
-    if sid == -1:
-        net.send_message(net.build_message("ERROR", ["NO SUMMARY OPENED"]))
-        return True
+    sid = get_open_summary(db_manager.get_id_per_sock(net.sock))
     # read the directory save/{sid}/{timestamp}/ (read sub directorys which are all timestamps)
     if not db_manager.can_access(sid, db_manager.get_id_per_sock(net.sock)):
         net.send_message(net.build_message("ERROR", ["NO PERMISSION"]))
@@ -649,30 +878,18 @@ def load_historic_summary(
     with open(f"save/{sid}/{timestamp}/summary.md", "rb") as f:
         data = f.read()
     # remove the user from the queues
-    for _, value in ids_per_summary_id.items():
-        if uid in value:
-            value.remove(uid)
-            break
+    close_open_summary(uid)
     # remove the user from the doc_changes
     summ: Summary = db_manager.get_summary(sid)
     summ.content = data.decode()
     historic_id_per_sock[db_manager.get_id_per_sock(net.sock)] = summ.id
-    net.send_message(
-        net.build_message(
-            "TAKEHIST",
-            [base64.b64encode(pickle.dumps({"data": data, "summ": summ})).decode()],
-        )
-    )
+    net.send_frame("TAKEHIST", [net.encode_object({"data": data, "summ": summ})])
     return False
 
 
 def handle_historic_graph(
     db_manager, timestamp, net: networkManager.NetworkManager
 ) -> bool:
-    if not db_manager.get_is_sock_logged(net.sock):
-        print("NOT logged in")
-        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
-        return True
     uid = db_manager.get_id_per_sock(net.sock)
     if uid not in historic_id_per_sock:
         print("NO HISTORIC ID for: ", net.sock)
@@ -689,10 +906,13 @@ def handle_historic_graph(
     # format as:("%Y%m%d%H%M%S") from YYYY-MM-DD HH:MM:SS
     dt_obj = datetime.datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
     timestampftm = dt_obj.strftime("%Y%m%d%H%M%S")
-    with open(f"save/{sid}/{timestampftm}/graph.pkl", "rb") as f:
-        data = f.read()
-    dumped_data = base64.b64encode(data).decode()
-    net.send_message(net.build_message("TAKEGRAPH", [dumped_data]))
+    # pickled by the server itself (get_graph), not something a client sent
+    path = f"save/{sid}/{timestampftm}/graph.pkl"
+    graph = []
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            graph = pickle.load(f)
+    net.send_frame("TAKEGRAPH", [net.encode_object(graph)])
     return False
 
 
@@ -734,41 +954,52 @@ def handle_import_gcal(db_manage, *_, net: networkManager.NetworkManager) -> boo
             }
         )
 
-    encoded = base64.b64encode(pickle.dumps(events)).decode()
-    net.send_message(net.build_message("GCAL_EVENTS", [encoded]))
+    net.send_frame("GCAL_EVENTS", [net.encode_object(events)])
+    return False
+
+
+def handle_stats(db_manager, *_, net: networkManager.NetworkManager) -> bool:
+    net.send_frame("STATS", [statsManager.STATS.render()])
     return False
 
 
+def serve_metrics(port: int) -> None:
+    """
+    Answer every connection to the local metrics port with the stats as
+    plain text, curl and nc both work.
+    """
+    metrics_sock = socket.create_server(("127.0.0.1", port))
+    print(f"Metrics on 127.0.0.1:{port}")
+    while True:
+        client_sock, _ = metrics_sock.accept()
+        with client_sock:
+            client_sock.settimeout(0.2)
+            try:
+                client_sock.recv(4096)  # a http request line, if any
+            except socket.timeout:
+                pass
+            try:
+                client_sock.sendall(
+                    b"HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\n\r\n"
+                    + statsManager.STATS.render().encode()
+                )
+            except OSError as e:
+                print(f"Metrics client went away: {e}")
+
+
 def handle_add_font(db_manager, font_data, net: networkManager.NetworkManager) -> bool:
     user_id = db_manager.get_id_per_sock(net.sock)
-    if not db_manager.get_is_sock_logged(net.sock):
-        print("NOT logged in")
-        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
-        return True
     unjsoned = json.loads(font_data)
     font_name = unjsoned["name"]
     from_url = unjsoned["from_url"]
     url = unjsoned["url"]
-    sid = -1
-    for k, v in ids_per_summary_id.items():
-        if user_id in v:
-            sid = k
-            break
-    if sid == -1:
-        net.send_message(net.build_message("ERROR", ["NO SUMMARY OPENED"]))
-        return True
+    sid = get_open_summary(user_id)
 
     db_manager.add_font(sid, font_name if not url else url, from_url, url)
     return False
 
 
-def thread_main(sock, addr, crypt):
-    net: networkManager.NetworkManager | None = handle_key_exchange(sock, crypt)
-    if net is None:
-        print("Client disconnected during key exchange")
-        return
-    net.set_lock(threading.Lock())
-    print("Finished key exchange for: ", addr)
+def create_db_manager() -> DbManager:
     db_manager = DbManager()
     db_manager.id_per_sock = id_per_sock
     # with open("db_config.json", "rb") as f:
@@ -785,64 +1016,560 @@ def thread_main(sock, addr, crypt):
         )
     else:
         db_manager.connect_to_sqlite({"db_type": "sqlite", "database": "dbconved.db"})
-    net.add_handler("EXIT", lambda: True)
-    net.add_handler("LOGIN", handle_login)
-    net.add_handler("REGISTER", handle_register)
-    net.add_handler("GETSUMMARIES", handle_summaries)
-    net.add_handler("SAVE", handle_save)
-    net.add_handler("ADDEVENT", handle_event)
-    net.add_handler("FILE", handle_file)
-    net.add_handler("CHUNK", handle_chunk)
-    net.add_handler("END", handle_end)
-    net.add_handler("GETFILECONTENT", handle_ocr)
-    net.add_handler("SUMMARIZE", handle_summary)
-    net.add_handler("EXPORT", handle_export)
-    net.add_handler("GETSUMMARY", handle_get_summary)
-    net.add_handler("GETEVENTS", handle_get_events)
-    net.add_handler("DELETEEVENT", handle_delete_event)
-    net.add_handler("GETSUMMARYLINK", handle_get_summary_by_link)
-    # net.add_handler("GET_DOCUMENT_CHANGES", handle_get_document_changes)
-    net.add_handler("UPDATEDOC", handle_update_document)
-    net.add_handler("SHARESUMMARY", handle_share_summary)
-    net.add_handler("GETGRAPH", handle_get_graph)
-    net.add_handler("SAVE_EVENTS", handle_saving_events)
-    net.add_handler("GETHISTORICLIST", get_historic_list)
-    net.add_handler("LOADHISTORIC", load_historic_summary)
-    net.add_handler("HISTORICGRAPH", handle_historic_graph)
-    net.add_handler("IMPORT_GCAL", handle_import_gcal)
-    net.add_handler("SETFONT", handle_add_font)
+    return db_manager
+
+
+def get_thread_db_manager() -> DbManager:
+    """
+    A DbManager per worker thread, sqlite connections cant cross threads
+    and the executors keep their threads alive anyway.
+    """
+    if getattr(thread_db, "db_manager", None) is None:
+        thread_db.db_manager = create_db_manager()
+    return thread_db.db_manager
+
+
+@dataclass
+class Command:
+    """
+    A command of the shared registry, the pre dispatch middlewares run
+    before the handler itself.
+    """
+
+    handler: Callable
+    arity: Optional[int] = None  # fields the handler needs, None for any
+    requires_login: bool = True
+    needs_document: bool = False
+    requires_admin: bool = False
+
+    def __call__(self, db_manager, *params, net: networkManager.NetworkManager):
+        for middleware in MIDDLEWARES:
+            if not middleware(self, db_manager, params, net):
+                return True
+        start = time.perf_counter()
+        try:
+            return self.handler(db_manager, *params, net=net)
+        finally:
+            duration = time.perf_counter() - start
+            if duration > SLOW_HANDLER_SECONDS:
+                print(f"Slow handler {self.handler.__name__}: {duration:.3f}s")
+
+
+SLOW_HANDLER_SECONDS = 0.5
+
+
+def require_arity(command: Command, db_manager, params, net) -> bool:
+    if command.arity is not None and len(params) < command.arity:
+        net.send_message(net.build_message("ERROR", ["BAD REQUEST"]))
+        return False
+    return True
+
+
+def require_login(command: Command, db_manager, params, net) -> bool:
+    if command.requires_login and not db_manager.get_is_sock_logged(net.sock):
+        print("NOT logged in")
+        net.send_message(net.build_message("ERROR", ["NOT LOGGED IN"]))
+        return False
+    return True
+
+
+def require_admin(command: Command, db_manager, params, net) -> bool:
+    if command.requires_admin and (
+        db_manager.get_id_per_sock(net.sock) not in ADMIN_USER_IDS
+    ):
+        net.send_message(net.build_message("ERROR", ["NOT ALLOWED"]))
+        return False
+    return True
+
+
+def require_document(command: Command, db_manager, params, net) -> bool:
+    if (
+        command.needs_document
+        and get_open_summary(db_manager.get_id_per_sock(net.sock)) == -1
+    ):
+        net.send_message(net.build_message("ERROR", ["NO SUMMARY OPENED"]))
+        return False
+    return True
+
+
+MIDDLEWARES: List[Callable] = [
+    require_arity,
+    require_login,
+    require_admin,
+    require_document,
+]
+
+# built once at import, every connection's NetworkManager references it
+COMMANDS: Dict[str, Command] = {
+    "LOGIN": Command(handle_login, 2, requires_login=False),
+    "REGISTER": Command(handle_register, 2, requires_login=False),
+    "GETSUMMARIES": Command(handle_summaries),
+    "SAVE": Command(handle_save, 3),
+    "ADDEVENT": Command(handle_event, 2),
+    "FILE": Command(handle_file, 1),
+    "CHUNK": Command(handle_chunk, 2),
+    "END": Command(handle_end, 1),
+    "UPLOAD": Command(handle_upload, 2),
+    "UCHUNK": Command(handle_upload_chunk, 3),
+    "GETFILECONTENT": Command(handle_ocr, 1),
+    "SUMMARIZE": Command(handle_summary, 1),
+    "EXPORT": Command(handle_export, 2),
+    "GETSUMMARY": Command(handle_get_summary, 1),
+    "GETEVENTS": Command(handle_get_events),
+    "DELETEEVENT": Command(handle_delete_event, 1),
+    "GETSUMMARYLINK": Command(handle_get_summary_by_link, 1),
+    # "GET_DOCUMENT_CHANGES": Command(handle_get_document_changes),
+    "UPDATEDOC": Command(handle_update_document, 1),
+    "RESYNC": Command(handle_resync, needs_document=True),
+    "SHARESUMMARY": Command(handle_share_summary, 1, needs_document=True),
+    "GETGRAPH": Command(handle_get_graph, needs_document=True),
+    "SAVE_EVENTS": Command(handle_saving_events, 1),
+    "GETHISTORICLIST": Command(get_historic_list, needs_document=True),
+    "LOADHISTORIC": Command(load_historic_summary, 1, needs_document=True),
+    "HISTORICGRAPH": Command(handle_historic_graph, 1),
+    "IMPORT_GCAL": Command(handle_import_gcal),
+    "SETFONT": Command(handle_add_font, 1, needs_document=True),
+    "STATS": Command(handle_stats, requires_admin=True),
+}
+
+
+def cleanup_session(sock) -> None:
+    """Remove a disconnected socket from every session registry."""
+    user_id = id_per_sock.pop(sock, None)
+    net = net_per_sock.pop(sock, None)
+    if net is not None:
+        net.stop_writer()
+    if net is not None and net.trace is not None:
+        net.trace.close()
+        net.trace = None
+    if net is not None and net.compression_stats:
+        print("Compression ratios: ", net.compression_ratios())
+    state_per_sock.pop(sock, None)
+    if user_id is None:
+        return
+    # delete from ids_per_summary_id
+    close_open_summary(user_id)
+    if user_id in id_per_sock.values():
+        # uploads are per user, another session of theirs may still use them
+        return
+    historic_id_per_sock.pop(user_id, None)
+    for path, f in handlers_per_sock_per_path.pop(user_id, {}).items():
+        print(f"Closing unfinished upload: {path}")
+        f.close()
+
+
+@dataclass
+class SummaryMove:
+    """A summary on its way to the node that owns it now."""
+
+    node: str
+    sent: threading.Event
+    ok: bool = False
+
+
+moving_summaries: Dict[int, SummaryMove] = {}
+
+
+def node_of(sid) -> Optional[str]:
+    """The node owning a summary, None if it is this one or there is no cluster."""
+    owner = ring.owner(sid)
+    return None if owner in (None, NODE_ADDRESS) else owner
+
+
+def route_summary(db_manager, net: networkManager.NetworkManager, code, params):
+    """
+    Move the session to the node, then the worker, owning the summary
+    params[0] before code runs.
+
+    :return: True if the session moved and the owner runs code.
+    """
+    node = node_of(params[0])
+    if node is not None:
+        relay_session(
+            db_manager,
+            net,
+            node,
+            sid=params[0],
+            code=code,
+            params=[networkManager.as_text(param) for param in params],
+        )
+        return True
+    if WORKERS > 1 and workerManager.owner_of(params[0], WORKERS) != worker_index:
+        hand_off(db_manager, net, code, params)
+        return True
+    return False
+
+
+def relay_session(db_manager, net: networkManager.NetworkManager, node, **extra):
+    """
+    Send the session to another node, run_session then relays its bytes
+    there until one side closes.
+    """
+    state = net.detach()
+    state.update(user=db_manager.get_id_per_sock(net.sock), **extra)
+    try:
+        relay_per_sock[net.sock] = clusterManager.send_state(
+            node, state, net.crypt_manager, TICKET_KEY
+        )
+        print(f"Relaying session of {state['user']} to node {node}")
+    except OSError as e:
+        print(f"Relay to node {node} failed: {e}")
+        net._abort()
+
+
+def follow_summary(db_manager, net: networkManager.NetworkManager, sid) -> None:
+    """Move a session after the summary it has open once that arrived."""
+    move = moving_summaries[sid]
+    state = net.detach()
+    if not move.sent.wait(MIGRATE_TIMEOUT) or not move.ok:
+        # the client resumes on a new connection and finds the owner itself
+        net._abort()
+        return
+    state.update(user=db_manager.get_id_per_sock(net.sock), sid=sid, join=True)
+    try:
+        relay_per_sock[net.sock] = clusterManager.send_state(
+            move.node, state, net.crypt_manager, TICKET_KEY
+        )
+    except OSError as e:
+        print(f"Relay to node {move.node} failed: {e}")
+        net._abort()
+
+
+def migrate_summary(sid, node) -> None:
+    """
+    Move a summary this node no longer owns: its sessions stop reading,
+    then the content and the pending doc_changes go to the new owner and
+    the sessions follow.
+    """
+    move = moving_summaries[sid] = SummaryMove(node, threading.Event())
+    nets = [
+        net
+        for sock, net in list(net_per_sock.items())
+        if get_open_summary(id_per_sock.get(sock)) == sid
+    ]
+    deadline = time.monotonic() + MIGRATE_TIMEOUT
+    while not all(net.detached for net in nets) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    try:
+        with lock_per_doc[sid]:
+            changes = doc_changes.pop(sid, {})
+            state = {
+                "kind": "document",
+                "sid": sid,
+                "content": (
+                    str(doc_contents[sid]) if sid in doc_contents else None
+                ),
+                "changes": [[user_id, items] for user_id, items in changes.items()],
+            }
+        conn = clusterManager.send_state(
+            node, state, cryptManager.CryptManager(rsa_key), TICKET_KEY
+        )
+        with conn:
+            clusterManager.wait_ack(conn)
+        move.ok = True
+        print(f"Moved summary {sid} to node {node}")
+    except OSError as e:
+        print(f"Moving summary {sid} to node {node} failed: {e}")
+    finally:
+        move.sent.set()
+        # sessions that have not noticed by now look for the owner on their
+        # next GETSUMMARY
+        time.sleep(MIGRATE_TIMEOUT)
+        moving_summaries.pop(sid, None)
+
+
+def on_cluster_change(nodes: Dict[str, str]) -> None:
+    """Rebuild the ring and move away the open summaries owned elsewhere now."""
+    global ring
+    ring = clusterManager.HashRing(nodes.values())
+    print(f"Cluster nodes: {sorted(nodes.values())}")
+    for sid in list(ids_per_summary_id):
+        if node_of(sid) is not None and sid not in moving_summaries:
+            Thread(target=migrate_summary, args=(sid, node_of(sid))).start()
+
+
+def serve_cluster(port: int) -> None:
+    """Accept summaries and sessions other nodes send to this one."""
+    listener = workerManager.listen_reuseport(port)
+    listener.listen()
+    while True:
+        conn, _ = listener.accept()
+        Thread(target=receive_from_node, args=(conn,), daemon=True).start()
+
+
+def receive_from_node(conn) -> None:
+    try:
+        state = clusterManager.recv_state(
+            conn, cryptManager.CryptManager(rsa_key), TICKET_KEY
+        )
+    except (OSError, ValueError) as e:
+        print(f"Rejected a cluster connection: {e}")
+        conn.close()
+        return
+    owner = workerManager.owner_of(state["sid"], WORKERS)
+    if WORKERS > 1 and owner != worker_index:
+        # the summary belongs to another worker of this node
+        try:
+            workerManager.send_session(
+                workerManager.ipc_path(IPC_DIR, server_port, owner), conn, state
+            )
+        except OSError as e:
+            print(f"Handoff to worker {owner} failed: {e}")
+        conn.close()
+        return
+    adopt_session(conn, state)
+
+
+def install_document(state: dict) -> None:
+    """Take over a summary another node moved here."""
+    sid = state["sid"]
+    with open_summary_lock:
+        if state["content"] is not None:
+            seeded_contents[sid] = state["content"]
+        pending = doc_changes.setdefault(sid, {})
+        for user_id, items in state["changes"]:
+            pending.setdefault(user_id, []).extend(items)
+    print(f"Took over summary {sid}")
+
+
+def hand_off(db_manager, net: networkManager.NetworkManager, code, params) -> None:
+    """
+    Move a session to the worker owning the summary it opens, that worker
+    runs code with params for it. The session loop here ends on
+    net.detached, a failed handoff drops the connection so the client
+    resumes on a fresh one.
+    """
+    owner = workerManager.owner_of(params[0], WORKERS)
+    state = net.detach()
+    state.update(
+        user=db_manager.get_id_per_sock(net.sock),
+        code=code,
+        params=[networkManager.as_text(param) for param in params],
+    )
+    try:
+        workerManager.send_session(
+            workerManager.ipc_path(IPC_DIR, server_port, owner), net.sock, state
+        )
+        print(f"Handed session of {state['user']} to worker {owner}")
+    except OSError as e:
+        print(f"Handoff to worker {owner} failed: {e}")
+        net._abort()
+
+
+def adopt_session(sock, state: dict) -> None:
+    """Carry on with a session another worker or node handed over."""
+    if state.get("kind") == "document":
+        install_document(state)
+        sock.sendall(clusterManager.ACK)
+        sock.close()
+        return
+    net = networkManager.NetworkManager(
+        sock, cryptManager.CryptManager(rsa_key), COMMANDS
+    )
+    net.attach(state, is_server=True)
+    user_id = state["user"]
+    id_per_sock[sock] = user_id
+    state_per_sock[sock] = UserState(user_id, net, None)
+    if state.get("join") and set_open_summary(user_id, state["sid"]):
+        spawn_summary_thread(None, user_id, net, state["sid"])
+    pending = (state["code"], state["params"]) if "code" in state else None
+    run_session(sock, sock.getpeername(), net, pending)
+
+
+def reap_idle_sessions() -> None:
+    """
+    Ping quiet peers and disconnect the ones that stopped answering, their
+    session loop then fails its read and cleans up. Sessions that are not
+    logged in are not pinged, only dropped after LOGIN_TIMEOUT.
+    """
+    while True:
+        time.sleep(max(1, PING_INTERVAL // 3))
+        now = time.monotonic()
+        for sock, net in list(net_per_sock.items()):
+            if net.detached:
+                continue
+            idle = now - net.last_seen
+            if sock not in id_per_sock:
+                if idle >= LOGIN_TIMEOUT:
+                    print(f"Dropping a session that never logged in: {idle:.0f}s")
+                    net._abort()
+                continue
+            if not net.heartbeat:
+                continue
+            if idle >= IDLE_TIMEOUT:
+                print(f"Dropping idle session of {id_per_sock.get(sock)}: {idle:.0f}s")
+                net._abort()
+            elif idle >= PING_INTERVAL:
+                try:
+                    net.send_frame_nowait(
+                        networkManager.PING_CODE, [str(int(time.time()))]
+                    )
+                except OSError:
+                    net._abort()
+
+
+def start_trace(net: networkManager.NetworkManager) -> None:
+    if not TRACE_DIR:
+        return
+    name = f"{int(time.time() * 1000)}-{os.getpid()}-{next(trace_counter)}"
+    try:
+        net.trace = traceManager.TraceWriter(
+            os.path.join(TRACE_DIR, name + ".trace.gz"), sorted(net.caps)
+        )
+    except OSError as e:
+        print(f"Could not start a trace: {e}")
+
+
+def thread_main(sock, addr, crypt):
+    net: networkManager.NetworkManager | None = handle_key_exchange(sock, crypt)
+    if net is None:
+        print("Client disconnected during key exchange")
+        return
+    print("Finished key exchange for: ", addr)
+    run_session(sock, addr, net)
+
+
+def run_session(sock, addr, net: networkManager.NetworkManager, pending=None):
+    """
+    Serve a session after its key exchange until it exits or moves to
+    another worker.
+
+    :param pending: (code, params) to handle before reading, for sessions
+        handed over by another worker.
+    """
+    net.set_lock(threading.Lock())
+    db_manager = create_db_manager()
+    net.handlers = COMMANDS
+    net.start_writer()
+    start_trace(net)
     net_per_sock[sock] = net
-    sock.settimeout(0.5)
+    sock.settimeout(SOCKET_TIMEOUT)
     try:
+        if pending is not None and net.dispatch_frame(*pending, db_manager):
+            return
         while True:
             # with lock_per_sock[sock]:
             try:
-                exited = net.recv_handle_server(db_manager)  # net.wait_recv()
+                # wakes up on a message or every SESSION_WAKEUP for the checks below
+                exited = net.recv_handle_server(db_manager, timeout=SESSION_WAKEUP)
+                sid = get_open_summary(id_per_sock.get(sock))
+                if sid in moving_summaries and not net.detached:
+                    follow_summary(db_manager, net, sid)
+                if net.detached:
+                    print("Session moved: ", addr)
+                    relay = relay_per_sock.pop(sock, None)
+                    if relay is not None:
+                        cleanup_session(sock)
+                        clusterManager.splice(sock, relay)
+                    return
                 if exited:
                     print("Exiting thread")
-
-                    for _, value in ids_per_summary_id.items():
-
-                        if id_per_sock[sock] in value:
-                            value.remove(id_per_sock[sock])
-                            break
-                    if sock in id_per_sock:
-                        del id_per_sock[sock]
-                    # delete from ids_per_summary_id
                     return
                 # time.sleep(1)
             except socket.timeout:
                 print("Timeout lock outght to free")
 
     finally:
-        if sock in id_per_sock:
-            del id_per_sock[sock]
-        # delete from ids_per_summary_id
-        # with doc_changes_lock:
-        for _, value in ids_per_summary_id.items():
-            if id_per_sock[sock] in value:
-                value.remove(id_per_sock[sock])
-                break
+        cleanup_session(sock)
+        sock.close()
+
+
+async def async_key_exchange(
+    client_sock, crypt: cryptManager.CryptManager, pool: ThreadPoolExecutor
+) -> networkManager.AsyncNetworkManager | None:
+    reader, writer = await asyncio.open_connection(sock=client_sock)
+    net = networkManager.AsyncNetworkManager(client_sock, crypt, {}, reader, writer)
+    net.send_message_plain(
+        net.build_message(
+            "KEY", [crypt.get_public_key(), net.offer_caps()], do_size=True
+        )
+    )
+    # a rejected RESUME is followed by a regular KEY reply
+    for _ in range(2):
+        try:
+            plain = await asyncio.wait_for(net.read_plain(), KEY_EXCHANGE_TIMEOUT)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.TimeoutError):
+            writer.close()
+            return None
+        # the RSA decrypt is the expensive part, keep it off the loop
+        if await asyncio.get_running_loop().run_in_executor(
+            pool, complete_key_exchange, net, plain
+        ):
+            return net
+    writer.close()
+    return None
+
+
+def dispatch_in_worker(net: networkManager.NetworkManager, code, params) -> bool:
+    return net.dispatch_frame(code, params, get_thread_db_manager())
+
+
+async def async_client_main(
+    client_sock, addr, rsa_key, pool: ThreadPoolExecutor, blocking_pool
+):
+    loop = asyncio.get_running_loop()
+    crypt = cryptManager.CryptManager(rsa_key)
+    net = await async_key_exchange(client_sock, crypt, pool)
+    if net is None:
+        print("Client disconnected during key exchange")
+        return
+    print("Finished key exchange for: ", addr)
+    net.handlers = COMMANDS
+    net.start_writer()
+    start_trace(net)
+    net_per_sock[client_sock] = net
+    try:
+        while True:
+            try:
+                code, params = await net.read_frame()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                print("Connection reset by peer.")
+                return
+            if net.answer_keepalive(code, params):
+                continue
+            # handlers of one connection still run one after the other,
+            # FILE/CHUNK/END and UPDATEDOC depend on that order
+            exited = await loop.run_in_executor(
+                blocking_pool if code in BLOCKING_CODES else pool,
+                dispatch_in_worker,
+                net,
+                code,
+                params,
+            )
+            if exited:
+                print("Exiting session: ", addr)
+                return
+    except Exception as e:
+        print(f"Error in session {addr}: {e}")
+    finally:
+        cleanup_session(client_sock)
+        net.writer.close()
+
+
+async def async_main(sock, rsa_key, t1):
+    sock.listen(LISTEN_BACKLOG)
+    sock.setblocking(False)
+    loop = asyncio.get_running_loop()
+    pool = ThreadPoolExecutor(MAX_HANDLER_WORKERS, thread_name_prefix="handler")
+    blocking_pool = ThreadPoolExecutor(
+        MAX_BLOCKING_WORKERS, thread_name_prefix="blocking"
+    )
+    print("Starting up time: ", time.time() - t1)
+    print("Listening (async)....")
+    sessions = set()
+    while True:
+        client_sock, addr = await loop.sock_accept(sock)
+        print(f"Connection from {addr}")
+        # the kernel still notices dead peers that never negotiated PING
+        client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if len(sessions) >= MAX_SESSIONS:
+            reject_busy(client_sock, addr)
+            continue
+        task = asyncio.create_task(
+            async_client_main(client_sock, addr, rsa_key, pool, blocking_pool)
+        )
+        sessions.add(task)
+        task.add_done_callback(sessions.discard)
 
 
 def update_insert_coordinates(change_data, start, offset):
@@ -1054,34 +1781,20 @@ def transform_position(pos, change_type, change_start, change_end, content_lengt
     return pos
 
 
-def transform_change(change, prior_change):
+def process_changes2(sid, doc_content: documentRope.Rope):
     """
-    Apply operational transformation to adjust a change based on a prior change
+    Apply the pending changes of a summary. An UPDATEDOC carries the
+    revision its text was at (base_rev). The UPDATEDOCs a user sent on the
+    same revision are composed into as few ops as possible, then transformed
+    against the ops other users got in since and logged with new revisions.
+    Every handled UPDATEDOC is acknowledged in its user's next delta, the
+    client sends the next one only then.
     """
-    start, end = change["cord"]
-    prior_start, prior_end = prior_change["cord"]
-    prior_type = prior_change["type"]
-    prior_content_len = len(prior_change.get("cont", ""))
-
-    # Transform start and end positions
-    new_start = transform_position(
-        start, prior_type, prior_start, prior_end, prior_content_len
-    )
-    new_end = transform_position(
-        end, prior_type, prior_start, prior_end, prior_content_len
-    )
-
-    # Update the change coordinates
-    change["cord"] = [new_start, new_end]
-    return change
-
-
-def process_changes2(sid, doc_content):
-    """Process all pending changes for a summary using operational transformation"""
     changes_processed = False
-    all_changes = []
+    messages = []
+    log = change_history[sid]
 
-    # Gather all changes across all change_ids into a single queue
+    # Gather the pending messages of every user, change_id is the user id
     for change_id, changes in list(doc_changes[sid].items()):
         for change_data in changes:
             change_obj = json.loads(change_data)
@@ -1097,76 +1810,73 @@ def process_changes2(sid, doc_content):
             if "selection" in change_obj:
                 user_selections[sid][client_id] = change_obj["selection"]
 
-            # Process text changes
-            for change in change_obj.get("changes", []):
-                if not change:
-                    continue
-
-                # Add metadata to the change
-                change["change_id"] = change_id
-                change["client_id"] = client_id
-                change["user_id"] = user_id
-                change["timestamp"] = time.time()
-
-                all_changes.append(change)
+            ops = [change for change in change_obj.get("changes", []) if change]
+            if not ops:
+                continue
+            if not change_obj.get("sequential"):
+                # a diff, every change refers to the text before all of them
+                ops = opLog.sequential(ops)
+            # clients that send no revision only know the current text
+            base_rev = change_obj.get("base_rev", log.revision)
+            if (
+                messages
+                and messages[-1][0] == change_id
+                and messages[-1][3] == base_rev
+            ):
+                # typed on before an update came back, one op list on top
+                # of the text at base_rev
+                messages[-1][4].extend(ops)
+            else:
+                messages.append((change_id, client_id, user_id, base_rev, ops))
 
     # Clear the pending changes since we've copied them
     doc_changes[sid].clear()
 
-    if not all_changes:
-        return doc_content, False
-
-    # Sort changes by timestamp if available
-    all_changes.sort(key=lambda x: x.get("timestamp", 0))
-
-    # Process all changes in order with conflict resolution
-    for change in all_changes:
-        start, end = change["cord"]
-        change_type = change["type"]
-        content = change.get("cont", "")
-        change_id = change["change_id"]
-        client_id = change["client_id"]
-        user_id = change["user_id"]
-
-        try:
-            # Apply operational transformation if enabled
-            if ENABLE_OPERATIONAL_TRANSFORM and change_history.get(sid, []):
-                # Apply transformations based on recent history
-                for prior_change in change_history[sid]:
-                    change = transform_change(change, prior_change)
-
-                # Get updated coordinates after transformation
-                start, end = change["cord"]
-
-            # Apply the change
-            if change_type == "INSERT":
-                doc_content = doc_content[:start] + content + doc_content[start:]
-            elif change_type == "DELETE":
-                doc_content = doc_content[:start] + doc_content[end:]
-            elif change_type == "UPDATE":
-                doc_content = doc_content[:start] + content + doc_content[end:]
-            import copy
-
-            # Record in history
-            change_copy = copy.deepcopy(change)
-            change_history[sid].append(change_copy)
+    syncs = peer_syncs.get(sid, {})
+    for change_id, client_id, user_id, base_rev, changes in messages:
+        # even with nothing left to apply, the ack has to go out
+        changes_processed = True
+        ops = opLog.compose(changes)
+        if len(ops) < len(changes):
+            print(f"Composed {len(changes)} changes of user {user_id} into {len(ops)}")
+        if ENABLE_OPERATIONAL_TRANSFORM:
+            ops = log.rebase(ops, base_rev, change_id)
+            if ops is None:
+                # older than the log, the next update replaces the text they have
+                print(
+                    f"Dropped changes of user {user_id} on revision {base_rev}, "
+                    f"the log starts at {log.base}"
+                )
+                syncs.pop(change_id, None)
+                continue
+        if change_id in syncs:
+            syncs[change_id].acked = True
+        for change in ops:
+            start, end = change["cord"]
+            change_type = change["type"]
+            content = change.get("cont", "")
 
-            # Limit history size
-            if len(change_history[sid]) > MAX_HISTORY_LENGTH:
-                change_history[sid] = change_history[sid][-MAX_HISTORY_LENGTH:]
+            try:
+                # Apply the change, the rope edits in place
+                doc_content.apply(change_type, start, end, content)
+                change["change_id"] = change_id
+                change["client_id"] = client_id
+                change["user_id"] = change_id
+                change["timestamp"] = time.time()
+                log.append(change)
 
-            # Update all user cursors and selections based on this change
-            update_cursors_and_selections(
-                sid, client_id, change_type, start, end, len(content)
-            )
+                # Update all user cursors and selections based on this change
+                update_cursors_and_selections(
+                    sid, client_id, change_type, start, end, len(content)
+                )
 
-            changes_processed = True
-            print(
-                f"Applied change type {change_type} at position {start}-{end} for change ID {change_id} from user {user_id}"
-            )
+                print(
+                    f"Applied change type {change_type} at position {start}-{end} "
+                    f"as revision {log.revision} from user {user_id}"
+                )
 
-        except Exception as e:
-            print(f"Error applying change: {e}")
+            except Exception as e:
+                print(f"Error applying change: {e}")
 
     return doc_content, changes_processed
 
@@ -1209,7 +1919,7 @@ def update_cursors_and_selections(
             user_selections[sid][client_id] = [new_sel_start, new_sel_end]
 
 
-def apply_change(doc_content, change):
+def apply_change(doc_content: documentRope.Rope, change):
     """Apply a single change to the document content"""
     start, end = change["cord"]
     change_type = change["type"]
@@ -1217,69 +1927,118 @@ def apply_change(doc_content, change):
 
     if change_type == "INSERT":
         # Insert content at the specified position
-        new_content = doc_content[:start] + content + doc_content[start:]
         offset = len(content)
     elif change_type == "DELETE":
         # Remove content between start and end
-        new_content = doc_content[:start] + doc_content[end:]
         offset = start - end
     else:  # UPDATE
         # Replace content between start and end
-        new_content = doc_content[:start] + content + doc_content[end:]
         offset = len(content) - (end - start)
+    doc_content.apply(
+        change_type if change_type in ("INSERT", "DELETE") else "UPDATE",
+        start,
+        end,
+        content,
+    )
 
-    return new_content, offset, change_type, start, end
-
+    return doc_content, offset, change_type, start, end
+
+
+def update_message(sid, client_id, **update) -> dict:
+    """A TAKEUPDATE or TAKEDELTA for a peer, with the others' cursors."""
+    return {
+        "type": "document_update",
+        "summary_id": sid,
+        "cursors": {
+            cid: pos
+            for cid, pos in user_cursors.get(sid, {}).items()
+            if cid != client_id
+        },
+        "selections": {
+            cid: sel
+            for cid, sel in user_selections.get(sid, {}).items()
+            if cid != client_id
+        },
+        **update,
+    }
+
+
+def send_updates_to_users(sid, doc_content: documentRope.Rope, font_info):
+    """
+    Bring every peer of a summary to the current revision. A peer gets the
+    ops applied since the revision it has (TAKEDELTA), or the whole text
+    (TAKEUPDATE) when it has none or the ops are no longer kept. A
+    TAKEUPDATE drops what the client did not send yet, so a delta is sent
+    even when its ops are bigger than the text, and the periodic check is
+    a checksum in a delta. A delta marks
+    the peer's own ops and acknowledges its last UPDATEDOC, a peer with
+    neither new ops nor an ack gets nothing.
+    Only the summary thread edits doc_content, so it needs no lock here.
+    """
+    print("Sockets: ", ids_per_summary_id.get(sid))
+    sock_per_id = {v: k for k, v in id_per_sock.items()}
+    log = change_history[sid]
+    syncs = peer_syncs.setdefault(sid, {})
+    text = None
+
+    def whole_text() -> str:
+        nonlocal text
+        if text is None:
+            # the rope caches it, a resync may build it at the same time
+            with lock_per_doc[sid]:
+                text = str(doc_content)
+        return text
 
-def send_updates_to_users(sid, doc_content, font_info):
-    """Send document updates to all connected users including cursor positions"""
-    # Implementation depends on the websocket/communication framework
-    print("Sockets: ", ids_per_summary_id[sid])
-    for client_id in ids_per_summary_id.get(sid, set()):
+    for client_id in list(ids_per_summary_id.get(sid, [])):
         try:
-            # Create a snapshot of all other users' cursors and selections
-            other_cursors = {
-                cid: pos
-                for cid, pos in user_cursors.get(sid, {}).items()
-                if cid != client_id
-            }
-            other_selections = {
-                cid: sel
-                for cid, sel in user_selections.get(sid, {}).items()
-                if cid != client_id
-            }
-
-            # Get recent changes for this document
-            recent_changes = change_history.get(sid, [])[-5:]  # Last 5 changes
-
             # Assume we have a send_message function that sends to specific clients
-            sock = {v: k for k, v in id_per_sock.items()}.get(client_id, None)
+            sock = sock_per_id.get(client_id, None)
             net = net_per_sock.get(sock)
             if net is None:
                 print(f"No network manager found for client {client_id}")
                 continue
-                # base64.b64encode(
-                #     json.dumps({"doc_content": doc_content}).encode()
-                # ).decode()
-            js = json.dumps(
-                {
-                    "type": "document_update",
-                    "summary_id": sid,
-                    "doc_content": doc_content,
-                    "cursors": other_cursors,
-                    "selections": other_selections,
-                    "recent_changes": recent_changes,
+            sync = syncs.get(client_id)
+            ops = None
+            if sync is not None:
+                ops = log.since(sync.revision)
+            if ops is not None:
+                if not ops and not sync.acked:
+                    continue
+                code = "TAKEDELTA"
+                update = {
+                    "base": sync.revision,
+                    "ops": [
+                        {
+                            "cord": op["cord"],
+                            "type": op["type"],
+                            "cont": op["cont"],
+                            "own": op["user_id"] == client_id,
+                        }
+                        for op in ops
+                    ],
+                    # the client checks its copy against it
+                    "length": len(doc_content),
+                    "ack": sync.acked,
+                }
+                sync.deltas += 1
+                sync.acked = False
+                if sync.deltas >= FULL_SYNC_EVERY:
+                    update["checksum"] = opLog.checksum(whole_text())
+                    sync.deltas = 0
+            else:
+                code = "TAKEUPDATE"
+                update = {
+                    "doc_content": whole_text(),
+                    "recent_changes": log.recent(5),
                     "font": font_info,
                 }
+                sync = syncs[client_id] = PeerSync(log.revision)
+            sync.revision = log.revision
+            js = json.dumps(
+                update_message(sid, client_id, revision=log.revision, **update)
             )
-            print("Sending2: ", js)
-            net.send_message(
-                net.build_message(
-                    "TAKEUPDATE",
-                    [base64.b64encode(js.encode()).decode()],
-                )
-            )
-            # print("Final state: \n", doc_content)
+            # queued, a slow client must not hold up the others
+            net.send_frame_nowait(code, [js.encode()])
         except Exception as e:
             print(f"Error sending update to client {client_id}: {e}")
 
@@ -1289,24 +2048,7 @@ def summary_thread(sid, db_manager: DbManager | None):
     Main thread function that processes document changes for a given summary ID
     """
     if db_manager is None:
-        db_manager = DbManager()
-        db_manager.id_per_sock = id_per_sock
-        # with open("db_config.json", "rb") as f:
-        #     db_manager.connect_to_db(json.loads(f.read()))
-        if USE_MYSQL:
-            db_manager.connect_to_db(
-                {
-                    "host": os.getenv("DB_HOST"),
-                    "user": os.getenv("DB_USERNAME"),
-                    "password": (os.getenv("DB_PASSWORD")),
-                    "database": os.getenv("DB_NAME"),
-                    "port": os.getenv("DB_PORT"),
-                }
-            )
-        else:
-            db_manager.connect_to_sqlite(
-                {"db_type": "sqlite", "database": "dbconved.db"}
-            )
+        db_manager = create_db_manager()
 
     doc_content = ""
     try:
@@ -1317,25 +2059,35 @@ def summary_thread(sid, db_manager: DbManager | None):
         with lock_per_doc[sid]:  # doc_changes_lock:
             doc = db_manager.get_summary(sid)
             doc_content = doc.content if doc and doc.content else ""
+            if sid in seeded_contents:
+                # moved here from another node with edits not saved yet
+                doc_content = seeded_contents.pop(sid)
+            # edited in place from here on, str() when the whole text is needed
+            doc_content = documentRope.Rope(doc_content)
+            doc_contents[sid] = doc_content
             if sid not in user_cursors:
                 user_cursors[sid] = {}
             if sid not in user_selections:
                 user_selections[sid] = {}
             if sid not in change_history:
-                change_history[sid] = []
+                change_history[sid] = opLog.OpLog(MAX_HISTORY_LENGTH)
         print("Entering the processing loop")
 
         # Continue as long as clients are connected to this summary
-        while ids_per_summary_id[sid]:
-            changes_found = False
-            with lock_per_doc[sid]:
-                if sid in doc_changes and doc_changes[sid]:
-                    changes_found = True
-            if not changes_found:
-                time.sleep(0.5)
-                continue
-            with lock_per_doc[sid]:
-                if sid not in doc_changes or not doc_changes[sid]:
+        while not release_summary(sid, db_manager, doc_content):
+            cond = lock_per_doc[sid]
+            with cond:
+                cond.wait_for(
+                    lambda: has_pending_changes(sid)
+                    or not ids_per_summary_id.get(sid),
+                    DOC_IDLE_WAKEUP,
+                )
+                if not has_pending_changes(sid):
+                    continue
+            if DOC_BATCH_WINDOW:
+                time.sleep(DOC_BATCH_WINDOW)
+            with cond:
+                if not has_pending_changes(sid):
                     continue
                 doc_content, changes_processed = process_changes2(sid, doc_content)
                 if changes_processed:
@@ -1361,7 +2113,7 @@ def summary_thread(sid, db_manager: DbManager | None):
         print(f"Summary thread terminated for summary ID: {sid}")
         # Save final document state before exiting
         try:
-            db_manager.save_summary(sid, doc_content)
+            db_manager.save_summary(sid, str(doc_content))
             print(f"Final document state saved for summary {sid}")
         except Exception as e:
             print(f"Failed to save final state: {e}")
@@ -1369,30 +2121,78 @@ def summary_thread(sid, db_manager: DbManager | None):
 
 def spawn_summary_thread(summ, uid, net, sid):
     global threads
-    lock_per_doc[sid] = threading.Lock()
+    lock_per_doc[sid] = threading.Condition()
     thread = Thread(target=summary_thread, args=(sid, None))
     thread.start()
     # thread.join()
+    threads = [th for th in threads if th.is_alive()]
     threads.append(thread)
 
 
+def reject_busy(client_sock, addr) -> None:
+    """Tell a client over MAX_SESSIONS when to retry, before any key exchange"""
+    print(f"At capacity, rejecting {addr}")
+    message = f"BUSY~{BUSY_RETRY_SECONDS}"
+    try:
+        client_sock.sendall(f"{len(message):10}{message}".encode())
+    except OSError:
+        pass
+    finally:
+        client_sock.close()
+
+
 def main(sock, crypt, t1):
-    sock.listen(5)
-    global threads
-    threads = []
+    sock.listen(LISTEN_BACKLOG)
+    # sessions run on reused pool threads, the semaphore counts the running
+    # ones so the accept loop never queues more than MAX_SESSIONS
+    session_pool = ThreadPoolExecutor(MAX_SESSIONS, thread_name_prefix="session")
+    free_sessions = threading.BoundedSemaphore(MAX_SESSIONS)
+    print("Starting up time: ", time.time() - t1)
+
+    def session_done(session) -> None:
+        free_sessions.release()
+        if session.exception() is not None:
+            print(f"Session crashed: {session.exception()!r}")
+
     while True:
-        t2 = time.time()
-        print("Starting up time: ", t2 - t1)
         print("Listening....")
         client_sock, addr = sock.accept()
         print(f"Connection from {addr}")
+        # the kernel still notices dead peers that never negotiated PING
+        client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if not free_sessions.acquire(blocking=False):
+            reject_busy(client_sock, addr)
+            continue
         # lock_per_sock[client_sock] = threading.Lock()
         crypt = cryptManager.CryptManager(rsa_key)
-        thread = Thread(target=thread_main, args=(client_sock, addr, crypt))
-        thread.start()
-        threads.append(thread)
-    for th in threads:
-        th.join()
+        session = session_pool.submit(thread_main, client_sock, addr, crypt)
+        session.add_done_callback(session_done)
+
+
+def start_background_threads(metrics_port: int, directory=None) -> None:
+    if metrics_port:
+        Thread(target=serve_metrics, args=(metrics_port,), daemon=True).start()
+    if PING_INTERVAL:
+        Thread(target=reap_idle_sessions, daemon=True).start()
+    if CLUSTER_DIRECTORY:
+        port = clusterManager.parse_address(NODE_ADDRESS)[1]
+        Thread(target=serve_cluster, args=(port,), daemon=True).start()
+        directory = directory or clusterManager.FileDirectory(CLUSTER_DIRECTORY)
+        directory.subscribe(on_cluster_change)
+
+
+def worker_main(index: int, t1) -> None:
+    """A forked worker process of the multi-process mode."""
+    global worker_index
+    worker_index = index
+    Thread(
+        target=workerManager.serve_handoffs,
+        args=(workerManager.ipc_path(IPC_DIR, server_port, index), adopt_session),
+        daemon=True,
+    ).start()
+    # every worker gets its own metrics port, counted up from METRICS_PORT
+    start_background_threads(METRICS_PORT + index if METRICS_PORT else 0)
+    main(workerManager.listen_reuseport(server_port), rsa_key, t1)
 
 
 if __name__ == "__main__":
@@ -1418,11 +2218,15 @@ if __name__ == "__main__":
     elif not USE_MYSQL and not os.path.isfile("dbconved.db"):
         print("Create the db")
         sys.exit()
+    if CLUSTER_DIRECTORY and not os.getenv("TICKET_KEY"):
+        # a random key per node, no node could open what another sealed
+        print("Cluster mode needs the same TICKET_KEY on every node")
+        sys.exit(1)
 
-    port = int(sys.argv[1]) if len(sys.argv) > 1 else 12345
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind(("0.0.0.0", port))
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if "--async" in sys.argv:
+        SERVER_MODE = "async"
+    server_port = int(args[0]) if args else 12345
 
     if os.path.isfile("private.pem"):
         print("Using existing key")
@@ -1437,4 +2241,27 @@ if __name__ == "__main__":
     #     else RSA.generate(2048)
     # )
 
-    main(sock, rsa_key, t1)
+    directory = None
+    if CLUSTER_DIRECTORY:
+        directory = clusterManager.FileDirectory(CLUSTER_DIRECTORY)
+        directory.join(NODE_ADDRESS, NODE_ADDRESS)
+        atexit.register(directory.leave, NODE_ADDRESS)
+        # leave the directory on a plain kill as well
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+    if (WORKERS > 1 or CLUSTER_DIRECTORY) and SERVER_MODE == "async":
+        # sessions move between processes as plain sockets
+        print("Multi-process and cluster mode run in thread mode")
+        SERVER_MODE = "thread"
+    if WORKERS > 1:
+        print(f"Starting {WORKERS} workers on port {server_port}")
+        workerManager.run_workers(WORKERS, worker_main, t1)
+        sys.exit()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", server_port))
+    start_background_threads(METRICS_PORT, directory)
+    if SERVER_MODE == "async":
+        asyncio.run(async_main(sock, rsa_key, t1))
+    else:
+        main(sock, rsa_key, t1)
@@ -0,0 +1,176 @@
+"""
+Per message code counters and latency histograms: bytes in and out,
+decrypt/encrypt time, handler time and errors. NetworkManager records into
+the process wide STATS, the server exposes it through STATS and a metrics
+port.
+"""
+
+import bisect
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+# upper bounds of the latency buckets in seconds, the last bucket is +Inf
+BUCKETS = [
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+]
+UNKNOWN_CODE = "UNKNOWN"
+
+
+@dataclass
+class Histogram:
+    counts: List[int] = field(default_factory=lambda: [0] * (len(BUCKETS) + 1))
+    total: float = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q quantile."""
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS + [float("inf")], self.counts):
+            seen += count
+            if count and seen >= target:
+                return bound
+        return 0.0
+
+
+@dataclass
+class CodeStats:
+    received: int = 0
+    sent: int = 0
+    errors: int = 0
+    coalesced: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    decrypt: Histogram = field(default_factory=Histogram)
+    encrypt: Histogram = field(default_factory=Histogram)
+    handler: Histogram = field(default_factory=Histogram)
+
+
+class Stats:
+    """
+    Thread safe counters per message code.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.per_code: Dict[str, CodeStats] = {}
+
+    def _get(self, code: str) -> CodeStats:
+        stats = self.per_code.get(code)
+        if stats is None:
+            stats = self.per_code[code] = CodeStats()
+        return stats
+
+    def record_recv(self, code: str, size: int, seconds: float) -> None:
+        with self.lock:
+            stats = self._get(code)
+            stats.received += 1
+            stats.bytes_in += size
+            stats.decrypt.observe(seconds)
+
+    def record_send(self, code: str, size: int, seconds: float) -> None:
+        with self.lock:
+            stats = self._get(code)
+            stats.sent += 1
+            stats.bytes_out += size
+            stats.encrypt.observe(seconds)
+
+    def record_handler(self, code: str, seconds: float, error: bool) -> None:
+        with self.lock:
+            stats = self._get(code)
+            stats.handler.observe(seconds)
+            stats.errors += error
+
+    def record_coalesced(self, code: str, count: int) -> None:
+        if not count:
+            return
+        with self.lock:
+            self._get(code).coalesced += count
+
+    def record_error(self, code: str) -> None:
+        with self.lock:
+            self._get(code).errors += 1
+
+    def reset(self) -> None:
+        with self.lock:
+            self.per_code.clear()
+
+    def render(self) -> str:
+        """
+        Plain text, one ``name{code="..."} value`` line per metric.
+        """
+        lines = []
+        with self.lock:
+            for code, stats in sorted(self.per_code.items()):
+                label = f'code="{code}"'
+                for name in (
+                    "received",
+                    "sent",
+                    "errors",
+                    "coalesced",
+                    "bytes_in",
+                    "bytes_out",
+                ):
+                    lines.append(f"{name}{{{label}}} {getattr(stats, name)}")
+                for name in ("decrypt", "encrypt", "handler"):
+                    histogram: Histogram = getattr(stats, name)
+                    if not histogram.count:
+                        continue
+                    lines.append(f"{name}_seconds_count{{{label}}} {histogram.count}")
+                    lines.append(
+                        f"{name}_seconds_sum{{{label}}} {histogram.total:.6f}"
+                    )
+                    for q in (0.5, 0.99):
+                        lines.append(
+                            f'{name}_seconds{{{label},quantile="{q}"}}'
+                            f" {histogram.quantile(q)}"
+                        )
+        return "\n".join(lines) + "\n"
+
+
+STATS = Stats()
+
+
+def test_histogram_buckets_and_quantiles():
+    histogram = Histogram()
+    for seconds in [0.00005, 0.0003, 0.0003, 0.002, 10]:
+        histogram.observe(seconds)
+    assert histogram.count == 5
+    assert histogram.counts[0] == 1 and histogram.counts[-1] == 1
+    assert histogram.quantile(0.5) == 0.0005
+    assert histogram.quantile(1.0) == float("inf")
+
+
+def test_render_lists_codes():
+    stats = Stats()
+    stats.record_recv("LOGIN", 120, 0.0002)
+    stats.record_handler("LOGIN", 0.03, error=True)
+    stats.record_send("TAKESUMMARIES", 5000, 0.001)
+    text = stats.render()
+    assert 'bytes_in{code="LOGIN"} 120' in text
+    assert 'errors{code="LOGIN"} 1' in text
+    assert 'handler_seconds{code="LOGIN",quantile="0.5"} 0.05' in text
+    assert 'bytes_out{code="TAKESUMMARIES"} 5000' in text
+    assert "~" not in text
@@ -0,0 +1,95 @@
+"""
+Traces of the decrypted messages a session received, for replaying real
+command mixes offline (see replayTrace.py). A trace is a gzip file: a
+header record, then one record per message with its time since the session
+started. Records are length prefixed wireCodec values.
+"""
+
+import gzip
+import struct
+import time
+from typing import Iterator, List, Tuple
+
+import wireCodec
+
+TRACE_VERSION = 1
+RECORD_HEADER = struct.Struct("!I")
+# fields that never go into a trace, code -> field indexes
+REDACTED_FIELDS = {"LOGIN": [1], "REGISTER": [1]}
+
+
+class TraceWriter:
+    """
+    Appends the messages of one session to a trace file. Only the thread
+    reading the session calls record, so there is no lock.
+    """
+
+    def __init__(self, path: str, caps) -> None:
+        self.file = gzip.open(path, "wb", compresslevel=6)
+        self.start = time.monotonic()
+        self._write({"version": TRACE_VERSION, "started": time.time(), "caps": caps})
+
+    def _write(self, value) -> None:
+        data = wireCodec.dumps(value)
+        self.file.write(RECORD_HEADER.pack(len(data)) + data)
+
+    def record(self, code: str, params) -> None:
+        fields = [
+            bytes(param) if isinstance(param, memoryview) else param
+            for param in params
+        ]
+        for index in REDACTED_FIELDS.get(code, []):
+            if index < len(fields):
+                fields[index] = ""
+        self._write([time.monotonic() - self.start, code, fields])
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def read_trace(path: str) -> Tuple[dict, List[Tuple[float, str, list]]]:
+    """
+    Read a whole trace.
+
+    :return: The header and the (seconds, code, fields) records.
+    """
+    records = iter_records(path)
+    header = next(records)
+    return header, [tuple(record) for record in records]
+
+
+def iter_records(path: str) -> Iterator:
+    with gzip.open(path, "rb") as f:
+        while header := f.read(RECORD_HEADER.size):
+            if len(header) < RECORD_HEADER.size:
+                # the session ended mid write, keep what is complete
+                return
+            (size,) = RECORD_HEADER.unpack(header)
+            data = f.read(size)
+            if len(data) < size:
+                return
+            yield wireCodec.loads(data)
+
+
+def test_trace_roundtrip_redacts_passwords(tmp_path):
+    path = str(tmp_path / "session.trace.gz")
+    writer = TraceWriter(path, ["BIN", "GCM"])
+    writer.record("LOGIN", ["alice", "secret"])
+    writer.record("UCHUNK", ["scan.png", "0", memoryview(b"\x00\x01")])
+    writer.close()
+    header, records = read_trace(path)
+    assert header["caps"] == ["BIN", "GCM"]
+    assert [(code, fields) for _, code, fields in records] == [
+        ("LOGIN", ["alice", ""]),
+        ("UCHUNK", ["scan.png", "0", b"\x00\x01"]),
+    ]
+    assert 0 <= records[0][0] <= records[1][0]
+
+
+def test_truncated_trace_keeps_complete_records(tmp_path):
+    path = str(tmp_path / "cut.trace.gz")
+    writer = TraceWriter(path, [])
+    writer.record("GETSUMMARIES", [""])
+    writer.file.write(RECORD_HEADER.pack(100) + b"partial")
+    writer.close()
+    assert [code for _, code, _ in read_trace(path)[1]] == ["GETSUMMARIES"]
@@ -0,0 +1,434 @@
+"""
+Compact, schema based encoding for what the server sends back: summaries,
+graph nodes, event dicts and lists of them. A replacement for pickle on the
+wire, decoding only ever builds plain values, Summary and Node objects.
+
+Lists of records with the same fields are packed column by column, so a
+list of 10k summaries costs one struct call per int column instead of one
+pickle per summary.
+"""
+
+import datetime
+import struct
+from dataclasses import fields
+from typing import Any, Callable, Dict, List, Tuple
+
+from dbManager import Node, Summary
+
+WIRE_VERSION = 1
+
+# value tags
+T_NONE = 0
+T_FALSE = 1
+T_TRUE = 2
+T_INT = 3
+T_FLOAT = 4
+T_STR = 5
+T_BYTES = 6
+T_DATETIME = 7
+T_DATE = 8
+T_LIST = 9
+T_DICT = 10
+T_RECORD = 11
+T_TABLE = 12
+
+# column kinds of a table
+C_INT = 0
+C_STR = 1
+C_DATETIME = 2
+C_DATE = 3
+C_ANY = 4
+
+# record kinds, decoding never builds anything else
+KIND_DICT = 0
+KIND_SUMMARY = 1
+KIND_NODE = 2
+RECORD_TYPES: Dict[int, type] = {KIND_SUMMARY: Summary, KIND_NODE: Node}
+KIND_PER_TYPE = {cls: kind for kind, cls in RECORD_TYPES.items()}
+SCHEMAS: Dict[int, Tuple[str, ...]] = {
+    kind: tuple(f.name for f in fields(cls)) for kind, cls in RECORD_TYPES.items()
+}
+
+INT = struct.Struct("!q")
+FLOAT = struct.Struct("!d")
+COUNT = struct.Struct("!I")
+TABLE_HEADER = struct.Struct("!BIH")
+NULL = -(2**63)  # None in an int, datetime or date column
+# ints the codec carries, NULL itself is not one of them
+MIN_INT, MAX_INT = NULL + 1, 2**63 - 1
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+MAX_DEPTH = 32
+
+
+def dumps(value: Any) -> bytes:
+    """
+    Encode a value, raises TypeError for anything without a wire format.
+    """
+    out = [bytes([WIRE_VERSION])]
+    _encode(value, out)
+    return b"".join(out)
+
+
+def loads(data: bytes) -> Any:
+    """
+    Decode what dumps produced.
+
+    :raises ValueError: On a different version, truncated or malformed data.
+    """
+    data = bytes(data)
+    if not data or data[0] != WIRE_VERSION:
+        raise ValueError("Unsupported wire version.")
+    reader = _Reader(data, 1)
+    value = reader.value(0)
+    if reader.pos != len(data):
+        raise ValueError("Trailing bytes after the encoded value.")
+    return value
+
+
+def _encode_str(value: str, out: List[bytes]) -> None:
+    data = value.encode()
+    out.append(COUNT.pack(len(data)))
+    out.append(data)
+
+
+def _encode(value: Any, out: List[bytes]) -> None:
+    kind = type(value)
+    if value is None:
+        out.append(bytes([T_NONE]))
+    elif kind is bool:
+        out.append(bytes([T_TRUE if value else T_FALSE]))
+    elif kind is int:
+        _check_ints(value, value)
+        out.append(bytes([T_INT]) + INT.pack(value))
+    elif kind is float:
+        out.append(bytes([T_FLOAT]) + FLOAT.pack(value))
+    elif kind is str:
+        out.append(bytes([T_STR]))
+        _encode_str(value, out)
+    elif kind in (bytes, bytearray):
+        out.append(bytes([T_BYTES]) + COUNT.pack(len(value)))
+        out.append(bytes(value))
+    elif kind is datetime.datetime and value.tzinfo is None:
+        out.append(bytes([T_DATETIME]) + INT.pack((value - EPOCH) // MICROSECOND))
+    elif kind is datetime.date:
+        out.append(bytes([T_DATE]) + INT.pack(value.toordinal()))
+    elif kind in KIND_PER_TYPE:
+        record = KIND_PER_TYPE[kind]
+        names = SCHEMAS[record]
+        out.append(bytes([T_RECORD, record, len(names)]))
+        for name in names:
+            _encode_str(name, out)
+            _encode(getattr(value, name), out)
+    elif kind in (list, tuple):
+        if not _encode_table(value, out):
+            out.append(bytes([T_LIST]) + COUNT.pack(len(value)))
+            for item in value:
+                _encode(item, out)
+    elif kind is dict:
+        out.append(bytes([T_DICT]) + COUNT.pack(len(value)))
+        for key, item in value.items():
+            if type(key) is not str:
+                raise TypeError(f"Dict keys must be str, got {type(key)}")
+            _encode_str(key, out)
+            _encode(item, out)
+    else:
+        raise TypeError(f"No wire format for {kind}")
+
+
+def _encode_table(items, out: List[bytes]) -> bool:
+    """
+    Pack a list of records that share their fields column by column.
+
+    :return: False if the items are not such a list.
+    """
+    if not items:
+        return False
+    first = items[0]
+    kind = type(first)
+    if kind is dict:
+        names = tuple(first)
+        if not all(type(item) is dict and tuple(item) == names for item in items):
+            return False
+        if not all(type(name) is str for name in names):
+            return False
+        record = KIND_DICT
+        columns = [[item[name] for item in items] for name in names]
+    elif kind in KIND_PER_TYPE:
+        if not all(type(item) is kind for item in items):
+            return False
+        record = KIND_PER_TYPE[kind]
+        names = SCHEMAS[record]
+        columns = [[getattr(item, name) for item in items] for name in names]
+    else:
+        return False
+    out.append(bytes([T_TABLE]) + TABLE_HEADER.pack(record, len(items), len(names)))
+    for name in names:
+        _encode_str(name, out)
+    for column in columns:
+        _encode_column(column, out)
+    return True
+
+
+def _column_kind(column: list) -> int:
+    kinds = {type(value) for value in column if value is not None}
+    if not kinds or kinds == {str}:
+        return C_STR
+    if kinds == {int}:
+        return C_INT
+    if kinds == {datetime.datetime}:
+        if all(value is None or value.tzinfo is None for value in column):
+            return C_DATETIME
+    if kinds == {datetime.date}:
+        return C_DATE
+    return C_ANY
+
+
+def _check_ints(low: int, high: int) -> None:
+    if low < MIN_INT or high > MAX_INT:
+        raise TypeError(f"No wire format for ints outside [{MIN_INT}, {MAX_INT}]")
+
+
+def _encode_column(column: list, out: List[bytes]) -> None:
+    kind = _column_kind(column)
+    out.append(bytes([kind]))
+    count = len(column)
+    if kind == C_INT:
+        ints = [v for v in column if v is not None]
+        _check_ints(min(ints), max(ints))
+        out.append(
+            struct.pack(f"!{count}q", *[NULL if v is None else v for v in column])
+        )
+    elif kind == C_DATETIME:
+        out.append(
+            struct.pack(
+                f"!{count}q",
+                *[NULL if v is None else (v - EPOCH) // MICROSECOND for v in column],
+            )
+        )
+    elif kind == C_DATE:
+        out.append(
+            struct.pack(
+                f"!{count}q", *[NULL if v is None else v.toordinal() for v in column]
+            )
+        )
+    elif kind == C_STR:
+        encoded = [None if v is None else v.encode() for v in column]
+        out.append(
+            struct.pack(f"!{count}i", *[-1 if v is None else len(v) for v in encoded])
+        )
+        out.append(b"".join(v for v in encoded if v))
+    else:
+        for value in column:
+            _encode(value, out)
+
+
+class _Reader:
+    def __init__(self, data: bytes, pos: int) -> None:
+        self.data = data
+        self.pos = pos
+
+    def take(self, size: int) -> bytes:
+        end = self.pos + size
+        if size < 0 or end > len(self.data):
+            raise ValueError("Truncated wire data.")
+        chunk = self.data[self.pos : end]
+        self.pos = end
+        return chunk
+
+    def byte(self) -> int:
+        return self.take(1)[0]
+
+    def count(self) -> int:
+        return COUNT.unpack(self.take(COUNT.size))[0]
+
+    def str(self) -> str:
+        return self.take(self.count()).decode()
+
+    def value(self, depth: int) -> Any:
+        if depth > MAX_DEPTH:
+            raise ValueError("Wire data nested too deep.")
+        tag = self.byte()
+        if tag == T_NONE:
+            return None
+        if tag in (T_FALSE, T_TRUE):
+            return tag == T_TRUE
+        if tag == T_INT:
+            return INT.unpack(self.take(INT.size))[0]
+        if tag == T_FLOAT:
+            return FLOAT.unpack(self.take(FLOAT.size))[0]
+        if tag == T_STR:
+            return self.str()
+        if tag == T_BYTES:
+            return self.take(self.count())
+        if tag == T_DATETIME:
+            return EPOCH + INT.unpack(self.take(INT.size))[0] * MICROSECOND
+        if tag == T_DATE:
+            return datetime.date.fromordinal(INT.unpack(self.take(INT.size))[0])
+        if tag == T_LIST:
+            return [self.value(depth + 1) for _ in range(self.count())]
+        if tag == T_DICT:
+            return {self.str(): self.value(depth + 1) for _ in range(self.count())}
+        if tag == T_RECORD:
+            record, size = self.byte(), self.byte()
+            values = {self.str(): self.value(depth + 1) for _ in range(size)}
+            return self.build(record, [values])[0]
+        if tag == T_TABLE:
+            return self.table(depth)
+        raise ValueError(f"Unknown wire tag {tag}.")
+
+    def table(self, depth: int) -> list:
+        record, rows, size = TABLE_HEADER.unpack(self.take(TABLE_HEADER.size))
+        names = [self.str() for _ in range(size)]
+        columns = [self.column(rows, depth) for _ in names]
+        if record == KIND_DICT:
+            return [dict(zip(names, row)) for row in zip(*columns)]
+        if record in SCHEMAS and tuple(names) == SCHEMAS[record]:
+            return [RECORD_TYPES[record](*row) for row in zip(*columns)]
+        return self.build(record, [dict(zip(names, row)) for row in zip(*columns)])
+
+    def build(self, record: int, rows: List[dict]) -> list:
+        # unknown fields from a newer peer are dropped, missing ones defaulted
+        if record not in SCHEMAS:
+            raise ValueError(f"Unknown record kind {record}.")
+        known = set(SCHEMAS[record])
+        cls = RECORD_TYPES[record]
+        try:
+            return [
+                cls(**{k: v for k, v in row.items() if k in known}) for row in rows
+            ]
+        except TypeError as e:
+            raise ValueError(f"Bad {cls.__name__} record: {e}") from e
+
+    def column(self, rows: int, depth: int) -> list:
+        kind = self.byte()
+        if kind in (C_INT, C_DATETIME, C_DATE):
+            values = struct.unpack(f"!{rows}q", self.take(8 * rows))
+            convert: Callable = {
+                C_INT: lambda v: v,
+                C_DATETIME: lambda v: EPOCH + v * MICROSECOND,
+                C_DATE: datetime.date.fromordinal,
+            }[kind]
+            if kind == C_INT and NULL not in values:
+                return list(values)
+            return [None if v == NULL else convert(v) for v in values]
+        if kind == C_STR:
+            lengths = struct.unpack(f"!{rows}i", self.take(4 * rows))
+            blob = self.take(sum(size for size in lengths if size > 0))
+            values, pos = [], 0
+            for size in lengths:
+                if size < 0:
+                    values.append(None)
+                else:
+                    values.append(blob[pos : pos + size].decode())
+                    pos += size
+            return values
+        if kind == C_ANY:
+            return [self.value(depth + 1) for _ in range(rows)]
+        raise ValueError(f"Unknown column kind {kind}.")
+
+
+import base64
+import pickle
+import time
+
+import pytest
+
+
+def _summary(i: int) -> Summary:
+    return Summary(
+        id=i,
+        ownerId=i % 7,
+        shareLink=f"link-{i:08x}",
+        path_to_summary=f"./data/{i % 7}/summaries/{i}.md",
+        font="Arial" if i % 3 else None,
+        createTime=datetime.datetime(2024, 5, 1, 12, 30, 15, 250) if i % 2 else None,
+        updateTime=datetime.datetime(2024, 5, 2, 8, 0) + i * MICROSECOND,
+        content="",
+    )
+
+
+def test_roundtrip_plain_values():
+    value = {
+        "none": None,
+        "flags": [True, False],
+        "int": -(2**40),
+        "float": 1.5,
+        "text": "héllo ~ world",
+        "raw": b"\x00\xff",
+        "when": datetime.datetime(2024, 1, 2, 3, 4, 5, 6),
+        "day": datetime.date(2024, 1, 2),
+        "mixed": [1, "a", None],
+    }
+    assert loads(dumps(value)) == value
+
+
+def test_roundtrip_records_and_tables():
+    summaries = [_summary(i) for i in range(50)]
+    assert loads(dumps(summaries)) == summaries
+    assert loads(dumps(summaries[1])) == summaries[1]
+    child = Node(2, "child", "summary")
+    graph = [Node(1, "root", "summary", [child]), Node(3, "x", "y")]
+    decoded = loads(dumps(graph))
+    assert decoded == graph and decoded[0].children == graph[0].children
+    events = [
+        {"id": i, "title": f"t{i}", "event_date": datetime.datetime(2024, 1, i + 1)}
+        for i in range(5)
+    ]
+    assert loads(dumps(events)) == events
+
+
+def test_rejects_bad_input():
+    with pytest.raises(TypeError):
+        dumps({"obj": object()})
+    # NULL would come back as None, and struct cannot pack past int64
+    for value in (NULL, 2**63, -(2**64)):
+        with pytest.raises(TypeError):
+            dumps(value)
+        with pytest.raises(TypeError):
+            dumps([{"id": 1}, {"id": value}])
+    assert loads(dumps([MIN_INT, MAX_INT])) == [MIN_INT, MAX_INT]
+    with pytest.raises(ValueError):
+        loads(pickle.dumps([1, 2]))
+    data = dumps([_summary(i) for i in range(3)])
+    with pytest.raises(ValueError):
+        loads(data[:-3])
+    with pytest.raises(ValueError):
+        loads(bytes([WIRE_VERSION, 99]))
+
+
+def test_newer_schema_fields_are_ignored():
+    out = [bytes([WIRE_VERSION, T_RECORD, KIND_NODE, 4])]
+    for name, value in [("id", 1), ("name", "n"), ("type", "t"), ("weight", 2)]:
+        _encode_str(name, out)
+        _encode(value, out)
+    assert loads(b"".join(out)) == Node(1, "n", "t")
+
+
+def test_benchmark_against_pickle_base64():
+    """Encodes and decodes 10k summaries like GETSUMMARIES used to."""
+    summaries = [_summary(i) for i in range(10_000)]
+
+    def timed(func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        return result, time.perf_counter() - start
+
+    pickled, pickle_encode = timed(
+        lambda: [base64.b64encode(pickle.dumps(s)).decode() for s in summaries]
+    )
+    _, pickle_decode = timed(
+        lambda: [pickle.loads(base64.b64decode(p)) for p in pickled]
+    )
+    encoded, wire_encode = timed(dumps, summaries)
+    decoded, wire_decode = timed(loads, encoded)
+    pickle_size = sum(len(p) + 1 for p in pickled)
+    print(
+        f"\n  pickle+base64: {pickle_size} bytes, {pickle_encode:.4f}s encode,"
+        f" {pickle_decode:.4f}s decode"
+        f"\n  wireCodec:     {len(encoded)} bytes, {wire_encode:.4f}s encode,"
+        f" {wire_decode:.4f}s decode"
+    )
+    assert decoded == summaries
+    # the timings are only printed, they depend on the machine and its load
+    assert len(encoded) * 3 < pickle_size
@@ -0,0 +1,167 @@
+"""
+Multi-process mode: worker processes share the listening port through
+SO_REUSEPORT and every summary is owned by exactly one of them. A connection
+that opens a summary owned by another worker is handed to that worker over
+a unix socket, the socket itself goes along as an SCM_RIGHTS fd and the
+session state (see NetworkManager.detach) as a wireCodec blob.
+"""
+
+import multiprocessing
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+from typing import Callable, Tuple
+
+import wireCodec
+
+# size of the session state that follows the fd
+STATE_HEADER = struct.Struct("!I")
+MAX_STATE_SIZE = 64 * 1024 * 1024
+# seconds between checks for dead workers
+SUPERVISE_INTERVAL = 1
+
+
+def owner_of(sid, workers: int) -> int:
+    """
+    The index of the worker that owns a summary.
+
+    :param sid: The summary id, as an int or as sent by a client.
+    :param workers: How many workers there are.
+    """
+    return zlib.crc32(str(sid).encode()) % workers
+
+
+def ipc_path(directory: str, port: int, index: int) -> str:
+    return os.path.join(directory, f"summary-server-{port}-{index}.sock")
+
+
+def listen_reuseport(port: int) -> socket.socket:
+    """A listening socket bound next to the other workers' on the same port."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("0.0.0.0", port))
+    return sock
+
+
+def _recv_exactly(channel: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = channel.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Handoff channel closed early.")
+        data += chunk
+    return bytes(data)
+
+
+def send_session(path: str, sock: socket.socket, state: dict) -> None:
+    """
+    Hand a client socket and its session state to the worker listening on
+    path. The caller still closes its own copy of the socket.
+    """
+    data = wireCodec.dumps(state)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as channel:
+        channel.connect(path)
+        socket.send_fds(channel, [STATE_HEADER.pack(len(data))], [sock.fileno()])
+        channel.sendall(data)
+
+
+def recv_session(channel: socket.socket) -> Tuple[socket.socket, dict]:
+    """
+    Receive what send_session sent.
+
+    :return: The client socket and its session state.
+    """
+    header, fds, _, _ = socket.recv_fds(channel, STATE_HEADER.size, 1)
+    if not fds:
+        raise ConnectionError("Handoff without a socket.")
+    sock = socket.socket(fileno=fds[0])
+    try:
+        header += _recv_exactly(channel, STATE_HEADER.size - len(header))
+        (size,) = STATE_HEADER.unpack(header)
+        if size > MAX_STATE_SIZE:
+            raise ValueError("Handoff state is too large.")
+        return sock, wireCodec.loads(_recv_exactly(channel, size))
+    except BaseException:
+        sock.close()
+        raise
+
+
+def serve_handoffs(path: str, adopt: Callable[[socket.socket, dict], None]) -> None:
+    """
+    Accept sessions handed over by other workers, each one is adopted on
+    its own thread.
+
+    :param path: The unix socket path of this worker.
+    :param adopt: Called with the client socket and its session state.
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen()
+    while True:
+        channel, _ = listener.accept()
+        try:
+            with channel:
+                sock, state = recv_session(channel)
+        except (OSError, ValueError) as e:
+            print(f"Failed to receive a session: {e}")
+            continue
+        threading.Thread(target=adopt, args=(sock, state), daemon=True).start()
+
+
+def run_workers(count: int, target: Callable, *args) -> None:
+    """
+    Run target(index, *args) in count forked worker processes and restart
+    the ones that die. Forking keeps what the parent set up, like the rsa
+    key and the ticket key, the same in every worker.
+    """
+    context = multiprocessing.get_context("fork")
+
+    def start(index: int):
+        process = context.Process(
+            target=target, args=(index, *args), name=f"worker-{index}", daemon=True
+        )
+        process.start()
+        return process
+
+    workers = [start(index) for index in range(count)]
+    while True:
+        time.sleep(SUPERVISE_INTERVAL)
+        for index, process in enumerate(workers):
+            if not process.is_alive():
+                print(f"Worker {index} exited with {process.exitcode}, restarting")
+                workers[index] = start(index)
+
+
+def test_owner_is_stable_and_spread():
+    owners = [owner_of(sid, 4) for sid in range(1000)]
+    assert owners == [owner_of(str(sid), 4) for sid in range(1000)]
+    assert all(150 < owners.count(index) < 350 for index in range(4))
+
+
+def test_session_handoff_over_unix_socket(tmp_path):
+    path = str(tmp_path / "worker.sock")
+    adopted = []
+    done = threading.Event()
+
+    def adopt(sock, state):
+        adopted.append((sock.recv(5), state))
+        sock.close()
+        done.set()
+
+    threading.Thread(target=serve_handoffs, args=(path, adopt), daemon=True).start()
+    while not os.path.exists(path):
+        time.sleep(0.01)
+    left, right = socket.socketpair()
+    state = {"key": b"k" * 16, "caps": ["BIN"], "pending": b"\x00" * 100_000}
+    send_session(path, right, state)
+    right.close()
+    left.sendall(b"hello")
+    assert done.wait(5)
+    assert adopted == [(b"hello", state)]
+    left.close()